@@ -1,5 +1,6 @@
 import React, { useState } from 'react';
 import { parseEDF } from './utils/edfParser.js';
+import { isBundleFile, resultFromBundle } from './utils/bundleLoader.js';
 import {
   analyzeFlowLimitation,
   estimateArousals,
@@ -25,10 +26,16 @@ const SleepAnalyzer = () => {
 
   const handleFileUpload = async (event) => {
     const uploadedFiles = Array.from(event.target.files);
-    const validFiles = uploadedFiles.filter(f => f.name.endsWith('BRP.edf'));
+    // A night with a precomputed .wat bundle is loaded from the bundle instead of its EDF
+    const bundleNames = new Set(
+      uploadedFiles.filter(isBundleFile).map(f => f.name.slice(0, -'.wat'.length))
+    );
+    const validFiles = uploadedFiles.filter(f =>
+      isBundleFile(f) || (f.name.endsWith('BRP.edf') && !bundleNames.has(f.name.slice(0, -'.edf'.length)))
+    );
 
     if (validFiles.length === 0) {
-      setError(`No valid BRP.edf files found`);
+      setError(`No valid BRP.edf or .wat files found`);
       return;
     }
 
@@ -44,29 +51,37 @@ const SleepAnalyzer = () => {
       try {
         const file = validFiles[i];
         const buffer = await file.arrayBuffer();
-        const { flowData, samplingRate, recordingDate, durationMinutes } = await parseEDF(buffer);
+        let newResult;
+
+        if (isBundleFile(file)) {
+          newResult = resultFromBundle(buffer, file.name);
+        } else {
+          const { flowData, samplingRate, recordingDate, durationMinutes } = await parseEDF(buffer);
+
+          if (durationMinutes >= minDurationMinutes) {
+            const { flScore, breaths } = analyzeFlowLimitation(flowData, samplingRate);
+            const eai = estimateArousals(breaths, flowData, samplingRate, durationMinutes * 60);
+            const minuteVent = calculateMinuteVent(flowData, samplingRate);
+            const { periodicityIndex, regularityScore } = analyzeNight(minuteVent);
+
+            newResult = {
+              date: recordingDate,
+              filename: file.name,
+              flScore,
+              periodicityIndex,
+              regularityScore,
+              eai,
+              durationMinutes
+            };
+          }
+        }
 
-        if (durationMinutes < minDurationMinutes) {
+        if (!newResult || newResult.durationMinutes < minDurationMinutes) {
           skippedCount++;
           setProgress({ current: i + 1, total: validFiles.length });
           continue;
         }
 
-        const { flScore, breaths } = analyzeFlowLimitation(flowData, samplingRate);
-        const eai = estimateArousals(breaths, flowData, samplingRate, durationMinutes * 60);
-        const minuteVent = calculateMinuteVent(flowData, samplingRate);
-        const { periodicityIndex, regularityScore } = analyzeNight(minuteVent);
-
-        const newResult = {
-          date: recordingDate,
-          filename: file.name,
-          flScore,
-          periodicityIndex,
-          regularityScore,
-          eai,
-          durationMinutes
-        };
-
         nightResults.push(newResult);
 
         setResults(prev => {
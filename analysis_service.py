@@ -0,0 +1,358 @@
+import numpy as np
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, CancelledError, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from process_flow import calculate_wave_metrics, find_periodic_segments
+from recording import Recording
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+HASH_CHUNK_BYTES = 1 << 20
+MAX_UPLOAD_BYTES = 1 << 30
+MAX_CACHED_RESULTS = 256
+# Path-to-hash entries kept; the least recently submitted paths are forgotten first.
+MAX_CACHED_HASHES = 4096
+STAGES = ('read', 'valid_regions', 'spectrum', 'wave_metrics', 'segments')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analyze_night(path, job_id, progress_queue, min_cycles=2, amplitude_threshold_percent=0.1,
+                  period_tolerance_percent=80):
+    """
+    Runs one night through the envelope pipeline in a pool worker and returns a JSON-safe dict.
+    Each finished stage is reported on progress_queue as (job_id, stage) when one is given;
+    pipeline prints are captured so they do not interleave across workers.
+    """
+    def report(stage):
+        if progress_queue is not None:
+            progress_queue.put((job_id, stage))
+
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        recording = Recording.from_file(path)
+        if recording is None:
+            last_line = (log.getvalue().strip().splitlines() or ['unknown error'])[-1]
+            raise ValueError(f"Could not read {os.path.basename(path)}: {last_line}")
+        report('read')
+        valid_mask = recording.valid_mask
+        report('valid_regions')
+        dominant_period_sec = recording.dominant_period()
+        report('spectrum')
+
+        result = {
+            'duration_sec': recording.duration_sec,
+            'valid_sec': float(np.count_nonzero(valid_mask) / recording.sampling_rate),
+            'sampling_rate': recording.sampling_rate,
+            'dominant_period_sec': dominant_period_sec,
+        }
+        if dominant_period_sec is None:
+            return result
+
+        average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = calculate_wave_metrics(
+            recording.analysis_flow, recording.sampling_rate, dominant_period_sec, smoothed_abs_flow=recording.envelope
+        )
+        report('wave_metrics')
+        if average_depth is None:
+            return result
+
+        total_periodic_time, periodic_percentage, segments = find_periodic_segments(
+            recording.flow_data, recording.sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs,
+            min_cycles=min_cycles,
+            amplitude_threshold_percent=amplitude_threshold_percent,
+            period_tolerance_percent=period_tolerance_percent,
+            valid_mask=valid_mask
+        )
+        report('segments')
+
+    result.update({
+        'average_depth': float(average_depth),
+        'average_period_sec': float(average_wave_period),
+        'periodic_time_sec': float(total_periodic_time),
+        'periodic_percentage': float(periodic_percentage),
+        'segments_sec': [[start_idx / recording.sampling_rate, end_idx / recording.sampling_rate]
+                         for start_idx, end_idx in segments],
+    })
+    return result
+
+
+class AnalysisService:
+    """
+    Job bookkeeping for the HTTP front end. Jobs are keyed by the SHA-256 of the EDF, so the same
+    night submitted twice (by path or upload, concurrently or later) shares one job and one result.
+    """
+
+    def __init__(self, max_workers=None, spool_dir=None):
+        self._manager = multiprocessing.Manager()
+        self._progress_queue = self._manager.Queue()
+        self._max_workers = max_workers
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._executor_lock = threading.Lock()
+        self._spool_dir = spool_dir or tempfile.mkdtemp(prefix='wat_service_')
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # job_id -> {'status', 'stages', 'result', 'error', 'path'}; finished jobs are the results cache.
+        self._jobs = OrderedDict()
+        # (path, size, mtime_ns) -> sha256, so resubmitting an unchanged file skips rehashing it.
+        self._path_hashes = OrderedDict()
+        self._pump = threading.Thread(target=self._pump_progress, daemon=True)
+        self._pump.start()
+
+    def _pump_progress(self):
+        while True:
+            item = self._progress_queue.get()
+            if item is None:
+                return
+            job_id, stage = item
+            with self._changed:
+                if job_id in self._jobs:
+                    self._jobs[job_id]['stages'].append(stage)
+                    self._changed.notify_all()
+
+    def _hash_path(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._path_hashes.get(key)
+            if digest is not None:
+                self._path_hashes.move_to_end(key)
+                return digest
+        digest = file_sha256(path)
+        with self._lock:
+            self._path_hashes[key] = digest
+            while len(self._path_hashes) > MAX_CACHED_HASHES:
+                self._path_hashes.popitem(last=False)
+        return digest
+
+    def _discard_upload(self, path):
+        """Deletes a spooled upload once no job needs it; files submitted by path are left alone."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self._spool_dir):
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(len(finished) - MAX_CACHED_RESULTS, 0)]:
+            self._discard_upload(self._jobs.pop(job_id)['path'])
+
+    def _replace_executor(self, broken):
+        """Swaps in a fresh pool for one whose worker died; the first caller to notice replaces it."""
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+                broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, path, job_id=None):
+        """
+        Queues path unless a running or finished job for the same content exists; a failed job is
+        retried. Returns (job_id, is_new).
+        """
+        if job_id is None:
+            job_id = self._hash_path(path)
+        with self._changed:
+            if job_id in self._jobs and self._jobs[job_id]['status'] != 'failed':
+                self._jobs.move_to_end(job_id)
+                return job_id, False
+            self._jobs[job_id] = {'status': 'running', 'stages': [], 'result': None, 'error': None, 'path': path}
+            self._jobs.move_to_end(job_id)
+            self._evict()
+
+        # A worker killed mid-job (e.g. by the OOM killer) breaks the whole pool, so a broken pool
+        # is replaced and the submit tried once more before the job is given up as failed.
+        future = None
+        for _ in range(2):
+            executor = self._executor
+            try:
+                future = executor.submit(analyze_night, path, job_id, self._progress_queue)
+                break
+            except BrokenExecutor as e:
+                self._replace_executor(executor)
+                error = e
+        if future is None:
+            with self._changed:
+                self._jobs[job_id]['status'], self._jobs[job_id]['error'] = 'failed', f"Worker pool unavailable: {error}"
+                self._changed.notify_all()
+            return job_id, True
+        future.add_done_callback(lambda f: self._finish(job_id, f, executor))
+        return job_id, True
+
+    def submit_upload(self, stream, length):
+        """Spools an uploaded EDF to disk while hashing it, then submits it."""
+        if length > MAX_UPLOAD_BYTES:
+            raise ValueError(f"Upload of {length} bytes exceeds the {MAX_UPLOAD_BYTES} byte limit.")
+        digest = hashlib.sha256()
+        fd, partial_path = tempfile.mkstemp(dir=self._spool_dir, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            remaining = length
+            while remaining > 0:
+                chunk = stream.read(min(HASH_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining > 0:
+            os.remove(partial_path)
+            raise ValueError(f"Upload ended after {length - remaining} of the {length} bytes announced.")
+        job_id = digest.hexdigest()
+        path = os.path.join(self._spool_dir, job_id + '.edf')
+        os.replace(partial_path, path)
+        job_id, is_new = self.submit(path, job_id)
+        with self._lock:
+            finished = self._jobs.get(job_id, {}).get('status') != 'running'
+        if not is_new and finished:
+            # The same night was already analyzed; its result is cached and the copy is not needed.
+            self._discard_upload(path)
+        return job_id, is_new
+
+    def _finish(self, job_id, future, executor):
+        # Jobs still queued at shutdown are cancelled rather than run.
+        error = CancelledError("Service shut down before the job ran.") if future.cancelled() else future.exception()
+        if isinstance(error, BrokenExecutor):
+            self._replace_executor(executor)
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if error is None:
+                job['status'], job['result'] = 'done', future.result()
+            else:
+                job['status'], job['error'] = 'failed', str(error)
+            self._changed.notify_all()
+        # The result is cached now; a failed upload is retried by uploading it again.
+        self._discard_upload(job['path'])
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {'job_id': job_id, 'status': job['status'], 'stages': list(job['stages']),
+                    'total_stages': len(STAGES), 'result': job['result'], 'error': job['error']}
+
+    def watch(self, job_id):
+        """Yields a status dict whenever the job advances, ending with its final state."""
+        seen = -1
+        while True:
+            with self._changed:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                while job['status'] == 'running' and len(job['stages']) == seen:
+                    self._changed.wait()
+                seen = len(job['stages'])
+                finished = job['status'] != 'running'
+            yield self.status(job_id)
+            if finished:
+                return
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._progress_queue.put(None)
+        self._pump.join()
+        self._manager.shutdown()
+        shutil.rmtree(self._spool_dir, ignore_errors=True)
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /analyze          JSON {"path": "..."} for a file on this machine, or the raw EDF bytes
+    GET  /jobs/<id>        current status, with the result once done
+    GET  /jobs/<id>/events newline-delimited JSON status updates until the job finishes
+    """
+    service = None
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/analyze':
+            self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                path = json.loads(self.rfile.read(length)).get('path')
+                if not path or not os.path.isfile(path):
+                    self._send_json(400, {'error': f'No such file: {path}'})
+                    return
+                job_id, is_new = self.service.submit(path)
+            else:
+                job_id, is_new = self.service.submit_upload(self.rfile, length)
+        except (ValueError, OSError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202 if is_new else 200, self.service.status(job_id))
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            status = self.service.status(parts[1])
+            if status is None:
+                self._send_json(404, {'error': f'Unknown job {parts[1]}'})
+            else:
+                self._send_json(200, status)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            if self.service.status(parts[1]) is None:
+                self._send_json(404, {'error': f'Unknown job {parts[1]}'})
+                return
+            # No Content-Length: the body ends when the connection closes after the final update.
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for status in self.service.watch(parts[1]):
+                self.wfile.write(json.dumps(status).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        elif parts == ['health']:
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, max_workers=None):
+    service = AnalysisService(max_workers=max_workers)
+    handler = type('BoundAnalysisRequestHandler', (AnalysisRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"Analysis service listening on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.")
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON service running the PB analysis pipeline.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help="Pool size (default: one per CPU)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,170 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import os
+
+from process_flow import select_single_file, read_edf
+
+MIN_BREATH_SEC = 1
+MAX_BREATH_SEC = 20
+# Zero crossings are taken on flow smoothed over this long so sensor noise around zero does not split breaths.
+CROSSING_SMOOTH_SEC = 0.2
+DEFAULT_WINDOW_BREATHS = 60
+MAX_AUTOCORRELATION_LAG = 20
+
+
+def breath_table(flow_data, sampling_rate):
+    """
+    Splits flow into breaths at upward zero crossings of lightly smoothed flow; inspiration ends at
+    the downward crossing in between. Breaths shorter than MIN_BREATH_SEC or longer than MAX_BREATH_SEC (pauses, mask
+    off) are dropped.
+
+    Returns a breath table as a dict of equal-length contiguous arrays:
+      'start', 'insp_end', 'end' (sample indices, int32), 'ti', 'te', 'ttot' (s),
+      'vt' (inspired volume, flow units x s) and 'peak_flow'.
+    """
+    width = max(int(CROSSING_SMOOTH_SEC * sampling_rate), 1)
+    smoothed = np.convolve(flow_data, np.ones(width) / width, mode='same')
+    ups = np.flatnonzero((smoothed[1:] > 0) & (smoothed[:-1] <= 0)) + 1
+    downs = np.flatnonzero((smoothed[1:] <= 0) & (smoothed[:-1] > 0)) + 1
+    if len(ups) < 2:
+        starts = ends = insp_ends = np.empty(0, dtype=np.int64)
+    else:
+        starts, ends = ups[:-1], ups[1:]
+        next_down = np.searchsorted(downs, starts, side='right')
+        insp_ends = downs[np.minimum(next_down, len(downs) - 1)] if len(downs) else ends
+        ttot = (ends - starts) / sampling_rate
+        keep = (next_down < len(downs)) & (insp_ends < ends) & (ttot >= MIN_BREATH_SEC) & (ttot <= MAX_BREATH_SEC)
+        starts, ends, insp_ends = starts[keep], ends[keep], insp_ends[keep]
+
+    table = {
+        'start': starts.astype(np.int32),
+        'insp_end': insp_ends.astype(np.int32),
+        'end': ends.astype(np.int32),
+        'ti': (insp_ends - starts) / sampling_rate,
+        'te': (ends - insp_ends) / sampling_rate,
+        'ttot': (ends - starts) / sampling_rate,
+    }
+    if len(starts) == 0:
+        table['vt'] = np.empty(0)
+        table['peak_flow'] = np.empty(0)
+        return table
+
+    cumulative = np.concatenate(([0.0], np.cumsum(flow_data)))
+    table['vt'] = (cumulative[insp_ends] - cumulative[starts]) / sampling_rate
+    # Inspirations never overlap, so interleaved (start, insp_end) bounds let reduceat take each alone.
+    table['peak_flow'] = np.maximum.reduceat(flow_data, np.column_stack((starts, insp_ends)).ravel())[0::2]
+    return table
+
+
+def rolling_cv(values, window=DEFAULT_WINDOW_BREATHS):
+    """Coefficient of variation (std / mean) of every run of `window` consecutive breaths."""
+    if len(values) < window:
+        return np.empty(0)
+    windows = sliding_window_view(values, window)
+    means = windows.mean(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return windows.std(axis=1) / means
+
+
+def rolling_autocorrelation(values, window=DEFAULT_WINDOW_BREATHS, lag=1):
+    """Lag-`lag` autocorrelation within every run of `window` consecutive breaths."""
+    if len(values) < window or lag >= window:
+        return np.empty(0)
+    windows = sliding_window_view(values, window)
+    centred = windows - windows.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(centred[:, lag:] * centred[:, :-lag], axis=1) / np.sum(centred * centred, axis=1)
+
+
+def autocorrelation(values, max_lag=MAX_AUTOCORRELATION_LAG):
+    """Whole-night autocorrelation for lags 0..max_lag, one strided dot product per lag."""
+    centred = values - np.mean(values)
+    max_lag = min(max_lag, len(values) - 1)
+    if max_lag < 0:
+        return np.empty(0)
+    variance = np.dot(centred, centred)
+    if variance == 0:
+        return np.zeros(max_lag + 1)
+    # Zero-padding the end makes row i of the view centred[i:i + max_lag + 1] for every breath,
+    # so column k of the product pairs each breath with the one k later.
+    padded = np.concatenate((centred, np.zeros(max_lag)))
+    lagged = sliding_window_view(padded, max_lag + 1)
+    return (centred @ lagged) / variance
+
+
+def poincare(values):
+    """Poincare (SD1, SD2) of successive breaths: spread across and along the identity line."""
+    if len(values) < 2:
+        return None, None
+    return float(np.std(np.diff(values)) / np.sqrt(2)), float(np.std(values[1:] + values[:-1]) / np.sqrt(2))
+
+
+def rolling_poincare(values, window=DEFAULT_WINDOW_BREATHS):
+    """
+    Poincare SD1 (short-term, across the identity line) and SD2 (long-term, along it) of each run
+    of `window` consecutive breaths, from successive-pair differences and sums.
+    """
+    if len(values) < window + 1:
+        return np.empty(0), np.empty(0)
+    pairs = sliding_window_view(values, window + 1)
+    diffs = np.diff(pairs, axis=1)
+    sums = pairs[:, 1:] + pairs[:, :-1]
+    sd1 = np.std(diffs, axis=1) / np.sqrt(2)
+    sd2 = np.std(sums, axis=1) / np.sqrt(2)
+    return sd1, sd2
+
+
+def breath_variability(flow_data, sampling_rate, window=DEFAULT_WINDOW_BREATHS):
+    """
+    Night summary: median rolling CV of Ttot and VT, median rolling lag-1 VT autocorrelation,
+    whole-night and median rolling Poincare SD1/SD2 of Ttot and VT and the VT autocorrelation
+    function. The whole-night SD2 also carries slow drift across the night; the rolling medians
+    describe breath-to-breath variability within a window.
+
+    Returns (table, summary), or (table, None) when there are fewer breaths than one window.
+    """
+    table = breath_table(flow_data, sampling_rate)
+    if len(table['start']) <= window:
+        print(f"Only {len(table['start'])} breaths; need more than {window} for variability metrics.")
+        return table, None
+
+    summary = {'n_breaths': len(table['start']), 'breaths_per_min': 60 / np.mean(table['ttot'])}
+    for name in ('ttot', 'vt'):
+        values = table[name]
+        summary[f'{name}_cv'] = float(np.nanmedian(rolling_cv(values, window)))
+        summary[f'{name}_sd1'], summary[f'{name}_sd2'] = poincare(values)
+        rolling_sd1, rolling_sd2 = rolling_poincare(values, window)
+        summary[f'{name}_rolling_sd1'] = float(np.median(rolling_sd1))
+        summary[f'{name}_rolling_sd2'] = float(np.median(rolling_sd2))
+    summary['vt_lag1_autocorrelation'] = float(np.nanmedian(rolling_autocorrelation(table['vt'], window)))
+    summary['vt_autocorrelation'] = autocorrelation(table['vt'])
+    return table, summary
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate = read_edf(filepath)
+
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            table, summary = breath_variability(flow_data, sampling_rate)
+            if summary is not None:
+                print(f"\n--- Breath Variability ({summary['n_breaths']} breaths, {summary['breaths_per_min']:.1f}/min) ---")
+                print(f"Median rolling CV: Ttot {summary['ttot_cv']:.3f}, VT {summary['vt_cv']:.3f}")
+                print(f"Poincare Ttot: SD1 {summary['ttot_sd1']:.3f}s, SD2 {summary['ttot_sd2']:.3f}s")
+                print(f"Poincare VT: SD1 {summary['vt_sd1']:.3f}, SD2 {summary['vt_sd2']:.3f}")
+                print(f"Median rolling Poincare Ttot: SD1 {summary['ttot_rolling_sd1']:.3f}s, SD2 {summary['ttot_rolling_sd2']:.3f}s")
+                print(f"Median rolling Poincare VT: SD1 {summary['vt_rolling_sd1']:.3f}, SD2 {summary['vt_rolling_sd2']:.3f}")
+                print(f"Median rolling lag-1 VT autocorrelation: {summary['vt_lag1_autocorrelation']:.3f}")
+                acf = summary['vt_autocorrelation']
+                peak_lag = int(np.argmax(acf[2:])) + 2 if len(acf) > 2 else None
+                if peak_lag is not None:
+                    print(f"Strongest VT autocorrelation beyond lag 1: {acf[peak_lag]:.3f} at {peak_lag} breaths")
+        else:
+            print(f"Failed to process {filename}.")
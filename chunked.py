@@ -0,0 +1,115 @@
+import numpy as np
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from extrema import _candidates_from_slopes, _zigzag_signal, find_alternating_extrema
+
+DEFAULT_BLOCK_SEC = 3600
+
+
+def _blocks(n_samples, block_size):
+    """Yields (start, end) of consecutive [start, end) blocks covering n_samples."""
+    for start in range(0, n_samples, block_size):
+        yield start, min(start + block_size, n_samples)
+
+
+def chunked_alternating_extrema(x, prominence, distance, block_size, max_workers=None):
+    """
+    Parallel counterpart of extrema.find_alternating_extrema. Each block's slopes and the candidate
+    extrema between them are found in a thread pool; the candidates that span block edges, such as
+    a zeroed mask-off stretch longer than a block, are then joined serially from each block's first
+    and last slope, and the short merged candidate list is walked once, so the result is the same
+    as the serial path.
+    """
+    x = np.asarray(x)
+    blocks = list(_blocks(len(x), block_size))
+
+    def block_candidates(block):
+        start, end = block
+        # Slopes between the block's samples and the first sample of the next block.
+        d = np.diff(x[start:end + 1])
+        slope_idx = np.flatnonzero(d)
+        if len(slope_idx) == 0:
+            return None
+        rising = d[slope_idx] > 0
+        slope_idx = slope_idx + start
+        indices, is_peak = _candidates_from_slopes(slope_idx, rising)
+        return indices, is_peak, (slope_idx[0], rising[0]), (slope_idx[-1], rising[-1])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = [result for result in executor.map(block_candidates, blocks) if result is not None]
+
+    all_indices, all_is_peak = [], []
+    previous_last = None
+    for indices, is_peak, first, last in results:
+        if previous_last is not None:
+            # The candidate, if any, between the previous block's last slope and this block's first.
+            joined = _candidates_from_slopes(np.array([previous_last[0], first[0]]),
+                                             np.array([previous_last[1], first[1]]))
+            all_indices.append(joined[0])
+            all_is_peak.append(joined[1])
+        all_indices.append(indices)
+        all_is_peak.append(is_peak)
+        previous_last = last
+
+    if not all_indices:
+        return np.empty(0, dtype=np.int32), True
+    indices = np.concatenate(all_indices).astype(np.int32)
+    is_peak = np.concatenate(all_is_peak)
+    return _zigzag_signal(x, indices, is_peak, prominence, max(int(distance), 1))
+
+
+def chunk_layout(sampling_rate, block_sec=DEFAULT_BLOCK_SEC):
+    """Block size in samples for a night at this sampling rate."""
+    return max(int(block_sec * sampling_rate), 1)
+
+
+def matches_serial(x, prominence, distance, block_size, max_workers=None):
+    """Whether chunked_alternating_extrema gives exactly extrema.find_alternating_extrema's result on x."""
+    serial = find_alternating_extrema(x, prominence=prominence, distance=distance)
+    chunked = chunked_alternating_extrema(x, prominence, distance, block_size, max_workers)
+    return np.array_equal(serial[0], chunked[0]) and serial[1] == chunked[1]
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file, read_edf, smooth_abs_flow
+    from valid_regions import detect_valid_regions
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate, clip_limits = read_edf(filepath, return_limits=True)
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            valid_mask, intervals, reasons = detect_valid_regions(flow_data, sampling_rate, clip_limits)
+            analysis_flow = np.where(valid_mask, flow_data, 0.0)
+            window_size_samples = min(max(int(30 * sampling_rate), 1), len(flow_data))
+            distance = max(int(5 * sampling_rate), 1)
+            block_size = chunk_layout(sampling_rate)
+
+            envelope = smooth_abs_flow(np.abs(analysis_flow), window_size_samples)
+            t0 = time.perf_counter()
+            serial = find_alternating_extrema(envelope, prominence=0.01, distance=distance)
+            print(f"serial: {time.perf_counter() - t0:.3f}s  {len(serial[0])} extrema")
+            t0 = time.perf_counter()
+            chunked = chunked_alternating_extrema(envelope, 0.01, distance, block_size, os.cpu_count())
+            print(f"chunked ({os.cpu_count()} threads): {time.perf_counter() - t0:.3f}s  {len(chunked[0])} extrema")
+            if not np.array_equal(serial[0], chunked[0]) or serial[1] != chunked[1]:
+                print("Error: Chunked extrema differ from the serial ones.")
+
+            # Zeroed stretches across block edges are where candidates have to be joined between
+            # blocks: one a block and a half long over the first edge, and a short one on the next.
+            masked = analysis_flow.copy()
+            masked[block_size // 2:2 * block_size] = 0
+            masked[3 * block_size - window_size_samples:3 * block_size + window_size_samples] = 0
+            masked_envelope = smooth_abs_flow(np.abs(masked), window_size_samples)
+            for size in (block_size, block_size // 7 + 1, window_size_samples):
+                if not matches_serial(masked_envelope, 0.01, distance, size, os.cpu_count()):
+                    print(f"Error: Chunked extrema differ from the serial ones on the masked flow (block {size}).")
+        else:
+            print(f"Failed to process {filename}.")
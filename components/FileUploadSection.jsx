@@ -52,7 +52,7 @@ const FileUploadSection = ({
           <input
             type="file"
             className="hidden"
-            accept=".edf"
+            accept=".edf,.wat"
             multiple
             webkitdirectory=""
             directory=""
@@ -0,0 +1,221 @@
+import numpy as np
+import glob
+import os
+from datetime import datetime, timedelta
+
+from valid_regions import _runs
+
+# Reasons a cycle failed, OR-ed together in the 'flags' column. A cycle with flags == 0 passed.
+FAIL_PERIOD = 1
+FAIL_AMPLITUDE = 2
+NO_TROUGH = 4
+INVALID_REGION = 8
+
+CYCLE_DTYPE = np.dtype([
+    ('start', np.int32),
+    ('end', np.int32),
+    ('period', np.float32),
+    ('depth', np.float32),
+    ('flags', np.uint8),
+    ('in_segment', np.bool_),
+])
+
+CYCLE_TABLE_SUFFIX = '.cycles.npz'
+# Fixed naive epoch so night-to-night comparisons are in device clock time, free of DST shifts.
+CLOCK_EPOCH = datetime(1970, 1, 1)
+
+
+def build_cycle_table(smoothed_abs_flow, peaks, troughs, sampling_rate, min_amplitude,
+                      period_lower_bound, period_upper_bound, min_cycles=2, valid_mask=None):
+    """
+    Applies the find_periodic_segments checks to every peak-to-peak cycle at once.
+
+    Returns (table, segments): table is a CYCLE_DTYPE structured array with one row per cycle and
+    segments is the list of (start_idx, end_idx) runs of at least min_cycles passing cycles.
+    """
+    peaks = np.sort(peaks)
+    troughs = np.sort(troughs)
+    n_cycles = max(len(peaks) - 1, 0)
+    table = np.zeros(n_cycles, dtype=CYCLE_DTYPE)
+    if n_cycles == 0:
+        return table, []
+
+    starts = peaks[:-1]
+    ends = peaks[1:]
+    table['start'] = starts
+    table['end'] = ends
+    table['period'] = (ends - starts) / sampling_rate
+
+    # Troughs strictly inside cycle i are troughs[lo[i]:hi[i]]; take the lowest of each group.
+    lo = np.searchsorted(troughs, starts, side='right')
+    hi = np.searchsorted(troughs, ends, side='left')
+    has_trough = hi > lo
+    depth = np.zeros(n_cycles)
+    if np.any(has_trough):
+        trough_vals = smoothed_abs_flow[troughs[:hi[has_trough][-1]]]
+        lowest = np.minimum.reduceat(trough_vals, lo[has_trough])
+        depth[has_trough] = smoothed_abs_flow[starts[has_trough]] - lowest
+    table['depth'] = depth
+
+    invalid = None
+    if valid_mask is not None:
+        invalid_prefix = np.concatenate(([0], np.cumsum(~valid_mask)))
+        invalid = invalid_prefix[ends + 1] - invalid_prefix[starts] > 0
+    flags = cycle_flags((ends - starts) / sampling_rate, depth, has_trough, min_amplitude,
+                        period_lower_bound, period_upper_bound, invalid)
+    table['flags'] = flags
+
+    segments = []
+    for a, b in passing_runs(flags, min_cycles):
+        table['in_segment'][a:b] = True
+        segments.append((peaks[a], peaks[b]))
+    return table, segments
+
+
+def cycle_flags(period, depth, has_trough, min_amplitude, period_lower_bound, period_upper_bound, invalid=None):
+    """Per-cycle FAIL_PERIOD / NO_TROUGH / FAIL_AMPLITUDE / INVALID_REGION flags, 0 for a passing cycle."""
+    flags = np.zeros(len(period), dtype=np.uint8)
+    flags[(period < period_lower_bound) | (period > period_upper_bound)] |= FAIL_PERIOD
+    flags[~has_trough] |= NO_TROUGH
+    flags[has_trough & (depth < min_amplitude)] |= FAIL_AMPLITUDE
+    if invalid is not None:
+        flags[invalid] |= INVALID_REGION
+    return flags
+
+
+def passing_runs(flags, min_cycles):
+    """(a, b) row ranges of the runs of at least min_cycles consecutive passing cycles; b is exclusive."""
+    run_starts, run_ends = _runs(flags == 0)
+    long_enough = (run_ends - run_starts) >= min_cycles
+    return list(zip(run_starts[long_enough], run_ends[long_enough]))
+
+
+def recording_start(edf_header):
+    """Recording start as a naive datetime from the EDF 'dd.mm.yy' / 'hh.mm.ss' header fields."""
+    try:
+        day, month, year = (int(part) for part in edf_header['start_date'].split('.'))
+        hour, minute, second = (int(part) for part in edf_header['start_time'].split('.'))
+    except ValueError:
+        print(f"Warning: Could not parse start date/time '{edf_header['start_date']} {edf_header['start_time']}'.")
+        return None
+    year += 1900 if year >= 85 else 2000
+    return datetime(year, month, day, hour, minute, second)
+
+
+def save_cycle_table(path, table, sampling_rate, start_datetime):
+    """Stores one night's cycle table with what is needed to place it on the clock."""
+    start_clock_sec = (start_datetime - CLOCK_EPOCH).total_seconds()
+    np.savez(path, cycles=table, sampling_rate=sampling_rate, start_clock_sec=start_clock_sec)
+
+
+def cycle_table_path(edf_path, out_dir=None):
+    base = os.path.splitext(os.path.basename(edf_path))[0] + CYCLE_TABLE_SUFFIX
+    return os.path.join(out_dir if out_dir is not None else os.path.dirname(edf_path), base)
+
+
+class CycleIndex:
+    """
+    Cycles from many nights in one set of arrays sorted by clock start time, so any time range,
+    or the same clock window on every night, resolves with a couple of binary searches.
+    """
+
+    def __init__(self, paths):
+        self.nights = []
+        night_starts = []
+        columns = {name: [] for name in ('clock_start', 'clock_end', 'night', 'period', 'depth', 'flags', 'in_segment')}
+        for night_id, path in enumerate(sorted(paths)):
+            with np.load(path) as stored:
+                table = stored['cycles']
+                sampling_rate = float(stored['sampling_rate'])
+                start_clock_sec = float(stored['start_clock_sec'])
+            self.nights.append(path)
+            night_starts.append(start_clock_sec)
+            columns['clock_start'].append(start_clock_sec + table['start'] / sampling_rate)
+            columns['clock_end'].append(start_clock_sec + table['end'] / sampling_rate)
+            columns['night'].append(np.full(len(table), night_id, dtype=np.int32))
+            for name in ('period', 'depth', 'flags', 'in_segment'):
+                columns[name].append(table[name])
+
+        self.night_starts = np.asarray(night_starts, dtype=float)
+        if self.nights:
+            merged = {name: np.concatenate(parts) for name, parts in columns.items()}
+        else:
+            merged = {name: np.empty(0) for name in columns}
+        order = np.argsort(merged['clock_start'], kind='stable')
+        for name, values in merged.items():
+            setattr(self, name, values[order])
+        self.max_duration = float(np.max(self.clock_end - self.clock_start)) if len(order) else 0.0
+
+    @classmethod
+    def from_directory(cls, directory):
+        return cls(glob.glob(os.path.join(directory, '*' + CYCLE_TABLE_SUFFIX)))
+
+    def _overlapping(self, window_starts, window_ends, pb_only):
+        # Any cycle overlapping [t0, t1) must start after t0 - max_duration and before t1.
+        lo = np.searchsorted(self.clock_start, window_starts - self.max_duration, side='left')
+        hi = np.searchsorted(self.clock_start, window_ends, side='left')
+        if len(lo) == 0 or np.sum(hi - lo) == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)])
+        window_of = np.repeat(np.arange(len(lo)), hi - lo)
+        keep = self.clock_end[candidates] > window_starts[window_of]
+        if pb_only:
+            keep &= self.in_segment[candidates]
+        return np.unique(candidates[keep])
+
+    def query(self, start_datetime, end_datetime, pb_only=True):
+        """Row indices of cycles overlapping [start_datetime, end_datetime)."""
+        t0 = (start_datetime - CLOCK_EPOCH).total_seconds()
+        t1 = (end_datetime - CLOCK_EPOCH).total_seconds()
+        return self._overlapping(np.array([t0]), np.array([t1]), pb_only)
+
+    def query_clock_window(self, start_time, end_time, last_nights=None, pb_only=True):
+        """
+        Row indices of cycles overlapping the clock window start_time-end_time (datetime.time) on
+        each night, optionally only the most recent last_nights. A window earlier in the day than
+        the night's start (02:00 for a 22:00 start) is taken on the following morning.
+        """
+        night_ids = np.argsort(self.night_starts)
+        if last_nights is not None:
+            night_ids = night_ids[-last_nights:]
+        window_starts = []
+        window_ends = []
+        for night_id in night_ids:
+            night_start = CLOCK_EPOCH + timedelta(seconds=float(self.night_starts[night_id]))
+            window_start = datetime.combine(night_start.date(), start_time)
+            if window_start < night_start:
+                window_start += timedelta(days=1)
+            window_end = datetime.combine(window_start.date(), end_time)
+            if window_end <= window_start:
+                window_end += timedelta(days=1)
+            window_starts.append((window_start - CLOCK_EPOCH).total_seconds())
+            window_ends.append((window_end - CLOCK_EPOCH).total_seconds())
+        return self._overlapping(np.asarray(window_starts), np.asarray(window_ends), pb_only)
+
+
+if __name__ == "__main__":
+    # process_flow and recording both import this module, so only pull them in when run as a script.
+    from process_flow import select_single_file, read_edf_header
+    from recording import Recording, envelope_detector
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_edf(filepath)
+        with open(filepath, 'rb') as f:
+            start_datetime = recording_start(read_edf_header(f, filepath))
+        if recording is None or start_datetime is None:
+            print(f"Failed to process {filename}.")
+        else:
+            result = envelope_detector(recording)
+            if 'cycles' in result:
+                out_path = cycle_table_path(filepath)
+                save_cycle_table(out_path, result['cycles'], recording.sampling_rate, start_datetime)
+                print(f"Saved {len(result['cycles'])} cycles to {out_path}")
+            else:
+                print("No cycle table could be built for this night.")
@@ -0,0 +1,287 @@
+import numpy as np
+import glob
+import os
+import re
+import sys
+from datetime import datetime
+
+from process_flow import select_single_file, read_edf_signal
+from event_detector import APNEA, HYPOPNEA
+
+# Device event kinds; APNEA and HYPOPNEA share event_detector's codes so the two tables join directly.
+OTHER = 0
+CENTRAL_APNEA = 3
+OBSTRUCTIVE_APNEA = 4
+AROUSAL = 5
+CSR = 6
+KIND_NAMES = {OTHER: 'Other', APNEA: 'Apnea', HYPOPNEA: 'Hypopnea', CENTRAL_APNEA: 'Central apnea',
+              OBSTRUCTIVE_APNEA: 'Obstructive apnea', AROUSAL: 'Arousal', CSR: 'Cheyne-Stokes'}
+# Matched in order against the lower-cased annotation text; the first hit wins.
+KIND_PATTERNS = (
+    ('central', CENTRAL_APNEA),
+    ('obstructive', OBSTRUCTIVE_APNEA),
+    ('hypopnea', HYPOPNEA),
+    ('apnea', APNEA),
+    ('arousal', AROUSAL),
+    ('csr', CSR),
+    ('cheyne', CSR),
+)
+
+ANNOTATION_DTYPE = np.dtype([
+    ('onset', np.float64),      # seconds from the file's start
+    ('duration', np.float32),   # seconds, 0 when the annotation has none
+    ('kind', np.uint8),
+    ('text', np.int32),         # index into the texts list returned alongside the table
+])
+
+# One TAL: +onset[\x15duration]\x14annotation\x14[annotation\x14...]\x00 (EDF+ spec, section 2.2.2).
+_TAL = re.compile(rb'([+-]\d+(?:\.\d*)?)(?:\x15(\d+(?:\.\d*)?))?\x14((?:[^\x14\x00]*\x14)*)\x00')
+# ResMed session files are named YYYYMMDD_HHMMSS_<type>.edf.
+_SESSION_STAMP = re.compile(r'^(\d{8}_\d{6})_')
+
+
+def parse_tal(raw):
+    """
+    Parses every TAL in the bytes of an 'EDF Annotations' signal in one regex pass over the buffer.
+    Timekeeping TALs (no annotation text) are dropped; a TAL carrying several annotations yields
+    one row each. Returns (onsets, durations, texts) with texts a list of str.
+    """
+    matches = _TAL.findall(raw)
+    if not matches:
+        return np.empty(0), np.empty(0), []
+    onsets, durations, bodies = zip(*matches)
+    onsets = np.array(onsets).astype(np.float64)
+    durations = np.array([d or b'0' for d in durations]).astype(np.float64)
+    bodies = [[part for part in body.split(b'\x14') if part] for body in bodies]
+    counts = np.array([len(parts) for parts in bodies])
+    texts = [part.decode('utf-8', errors='replace').strip() for parts in bodies for part in parts]
+    return np.repeat(onsets, counts), np.repeat(durations, counts), texts
+
+
+def classify(text):
+    lowered = text.lower()
+    for pattern, kind in KIND_PATTERNS:
+        if pattern in lowered:
+            return kind
+    return OTHER
+
+
+def _pair_csr_markers(onsets, durations, kinds, texts):
+    """Turns 'CSR Start' / 'CSR End' marker pairs into single CSR rows with a duration."""
+    lowered = np.array([text.lower() for text in texts]) if texts else np.empty(0, dtype=str)
+    markers = kinds == CSR
+    is_start = markers & np.char.endswith(lowered, 'start')
+    is_end = markers & np.char.endswith(lowered, 'end')
+    starts = np.flatnonzero(is_start)
+    ends = np.flatnonzero(is_end)
+    if len(starts) == 0 and len(ends) == 0:
+        return np.ones(len(onsets), dtype=bool), durations
+    # Walk the markers in time order: a start opens a CSR run, repeated starts while it is open
+    # are dropped, and an end closes the open run; ends with nothing open are dropped too.
+    marker_rows = np.concatenate((starts, ends))
+    marker_rows = marker_rows[np.argsort(onsets[marker_rows], kind='stable')]
+    durations = durations.copy()
+    keep = ~is_end
+    open_row = None
+    for row in marker_rows:
+        if is_start[row]:
+            if open_row is None:
+                open_row = row
+            else:
+                keep[row] = False
+        elif open_row is not None:
+            durations[open_row] = onsets[row] - onsets[open_row]
+            open_row = None
+    if open_row is not None:
+        print("Warning: A CSR start marker has no end marker; ignoring it.")
+        keep[open_row] = False
+    return keep, durations
+
+
+def read_annotations(filepath):
+    """
+    Device-scored events of an EDF+ file (ResMed EVE/CSL). Returns (events, texts, edf_header):
+    events is an ANNOTATION_DTYPE table sorted by onset, texts the distinct annotation strings it
+    indexes. Returns (None, None, None) when the file has no annotation signal.
+    """
+    digital, signal_info, edf_header = read_edf_signal(filepath, 'EDF Annotations')
+    if digital is None:
+        return None, None, None
+    # The annotation signal is text stored in the 2-byte sample slots; take the bytes back as written.
+    onsets, durations, texts = parse_tal(digital.astype('<i2').tobytes())
+
+    # Classify each distinct text once rather than every row.
+    unique_texts, text_ids = np.unique(np.array(texts, dtype=str), return_inverse=True)
+    unique_kinds = np.array([classify(text) for text in unique_texts], dtype=np.uint8)
+    kinds = unique_kinds[text_ids]
+    keep, durations = _pair_csr_markers(onsets, durations, kinds, texts)
+
+    events = np.zeros(np.count_nonzero(keep), dtype=ANNOTATION_DTYPE)
+    events['onset'] = onsets[keep]
+    events['duration'] = durations[keep]
+    events['kind'] = kinds[keep]
+    events['text'] = text_ids[keep]
+    events = events[np.argsort(events['onset'], kind='stable')]
+    return events, [str(text) for text in unique_texts], edf_header
+
+
+def merge_intervals(starts, ends):
+    """Sorts intervals and merges the overlapping or touching ones into a disjoint set."""
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+    order = np.argsort(starts, kind='stable')
+    starts, ends = np.asarray(starts, dtype=float)[order], np.asarray(ends, dtype=float)[order]
+    reach = np.maximum.accumulate(ends)
+    # A new interval begins wherever a start lies past every end before it.
+    first = np.concatenate(([True], starts[1:] > reach[:-1]))
+    last = np.concatenate((first[1:], [True]))
+    return starts[first], reach[last]
+
+
+def interval_overlap(a_starts, a_ends, b_starts, b_ends):
+    """
+    Total length of the intersection of two sets of intervals (each set sorted and disjoint),
+    computed over the merged boundary grid without a loop over intervals.
+    """
+    if len(a_starts) == 0 or len(b_starts) == 0:
+        return 0.0
+    points = np.unique(np.concatenate((a_starts, a_ends, b_starts, b_ends)))
+    mids = (points[:-1] + points[1:]) / 2
+
+    def covered(starts, ends):
+        i = np.searchsorted(starts, mids, side='right') - 1
+        return (i >= 0) & (mids < ends[np.maximum(i, 0)])
+
+    return float(np.sum(np.diff(points)[covered(a_starts, a_ends) & covered(b_starts, b_ends)]))
+
+
+def align_events(events, offset_sec, sampling_rate, segments, cycles=None):
+    """
+    Places device events on a flow recording that started offset_sec after the annotation file.
+    Returns (segment_of, cycle_of): for each event, the index of the PB segment (from a
+    detector's 'segments') and of the cycle (a cycle table) containing its onset, or -1.
+    """
+    onset_samples = (events['onset'] - offset_sec) * sampling_rate
+    segments = np.asarray(segments, dtype=np.int64).reshape(-1, 2)
+    segment_of = np.full(len(events), -1, dtype=np.int64)
+    if len(segments):
+        position = np.searchsorted(segments[:, 0], onset_samples, side='right') - 1
+        inside = (position >= 0) & (onset_samples < segments[np.maximum(position, 0), 1])
+        segment_of[inside] = position[inside]
+
+    cycle_of = np.full(len(events), -1, dtype=np.int64)
+    if cycles is not None and len(cycles):
+        order = np.argsort(cycles['start'], kind='stable')
+        position = np.searchsorted(cycles['start'][order], onset_samples, side='right') - 1
+        candidate = order[np.maximum(position, 0)]
+        inside = (position >= 0) & (onset_samples < cycles['end'][candidate])
+        cycle_of[inside] = candidate[inside]
+    return segment_of, cycle_of
+
+
+def session_stamp(filepath):
+    """Start of a ResMed session file from its YYYYMMDD_HHMMSS name prefix, or None."""
+    match = _SESSION_STAMP.match(os.path.basename(filepath))
+    return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S') if match else None
+
+
+def session_annotation_files(brp_path):
+    """The EVE and CSL files of the session a BRP file belongs to: the latest ones not after it."""
+    brp_stamp = session_stamp(brp_path)
+    if brp_stamp is None:
+        return []
+    directory = os.path.dirname(brp_path)
+    found = []
+    for suffix in ('EVE', 'CSL'):
+        candidates = [(session_stamp(path), path) for path in glob.glob(os.path.join(directory, f'*_{suffix}.edf'))]
+        candidates = [(stamp, path) for stamp, path in candidates if stamp is not None and stamp <= brp_stamp]
+        if candidates:
+            found.append(max(candidates)[1])
+    return found
+
+
+def compare_night(brp_path, annotation_paths=None):
+    """
+    One row joining our envelope detector with the device's events over a BRP file's span:
+    our periodic_percentage against the share of valid time the device flagged as CSR, their
+    overlap, device event counts and how many device events fell inside our PB segments.
+    Returns None if the flow recording cannot be read.
+    """
+    from recording import Recording, envelope_detector
+
+    recording = Recording.from_edf(brp_path)
+    if recording is None:
+        return None
+    result = envelope_detector(recording)
+    sampling_rate = recording.sampling_rate
+    segments = np.asarray(result.get('segments', []), dtype=np.int64).reshape(-1, 2)
+    row = {'filename': os.path.basename(brp_path), 'periodic_percentage': result.get('periodic_percentage')}
+
+    if annotation_paths is None:
+        annotation_paths = session_annotation_files(brp_path)
+    tables = []
+    brp_stamp = session_stamp(brp_path)
+    for path in annotation_paths:
+        events, texts, _ = read_annotations(path)
+        stamp = session_stamp(path)
+        if events is None:
+            continue
+        offset_sec = (brp_stamp - stamp).total_seconds() if brp_stamp is not None and stamp is not None else 0.0
+        # Shift onto the BRP clock and keep what falls inside this recording.
+        events = events.copy()
+        events['onset'] -= offset_sec
+        tables.append(events[(events['onset'] >= 0) & (events['onset'] < recording.duration_sec)])
+    events = np.concatenate(tables) if tables else np.zeros(0, dtype=ANNOTATION_DTYPE)
+    events = events[np.argsort(events['onset'], kind='stable')]
+
+    valid_sec = np.count_nonzero(recording.valid_mask) / sampling_rate
+    csr = events[events['kind'] == CSR]
+    csr_starts = csr['onset']
+    csr_ends = np.minimum(csr['onset'] + csr['duration'], recording.duration_sec)
+    # The same run can be scored in several files (EVE and CSL), so merge before summing.
+    csr_starts, csr_ends = merge_intervals(csr_starts, csr_ends)
+    csr_sec = float(np.sum(csr_ends - csr_starts))
+    overlap_sec = interval_overlap(csr_starts, csr_ends, segments[:, 0] / sampling_rate, segments[:, 1] / sampling_rate)
+    segment_of, cycle_of = align_events(events, 0.0, sampling_rate, segments, result.get('cycles'))
+
+    row.update({
+        'device_csr_percentage': csr_sec / valid_sec * 100 if valid_sec > 0 else None,
+        'overlap_percentage': overlap_sec / valid_sec * 100 if valid_sec > 0 else None,
+        'device_events': {KIND_NAMES[kind]: int(np.count_nonzero(events['kind'] == kind)) for kind in np.unique(events['kind'])},
+        'events_in_pb_segments': int(np.count_nonzero((segment_of >= 0) & (events['kind'] != CSR))),
+    })
+    return row
+
+
+if __name__ == "__main__":
+    # Usage: python edf_annotations.py [directory of ResMed session files]; with no argument, pick
+    # one EVE/CSL file and list its events.
+    if len(sys.argv) > 1:
+        for brp_path in sorted(glob.glob(os.path.join(sys.argv[1], '**', '*_BRP.edf'), recursive=True)):
+            row = compare_night(brp_path)
+            if row is None:
+                print(f"Failed to process {os.path.basename(brp_path)}.")
+                continue
+            ours = f"{row['periodic_percentage']:.1f}%" if row['periodic_percentage'] is not None else "n/a"
+            device = f"{row['device_csr_percentage']:.1f}%" if row['device_csr_percentage'] is not None else "n/a"
+            overlap = f"{row['overlap_percentage']:.1f}%" if row['overlap_percentage'] is not None else "n/a"
+            print(f"{row['filename']}: PB {ours}, device CSR {device}, overlap {overlap}, "
+                  f"events {row['device_events']} ({row['events_in_pb_segments']} inside PB segments)")
+    else:
+        filepath = select_single_file()
+
+        if not filepath:
+            print("No file selected. Exiting script.")
+        else:
+            filename = os.path.basename(filepath)
+            print(f"\nSelected file: {filename}")
+
+            events, texts, edf_header = read_annotations(filepath)
+            if events is None:
+                print(f"Failed to process {filename}.")
+            else:
+                print(f"\n--- Device Events ({len(events)}) ---")
+                for kind in np.unique(events['kind']):
+                    print(f"{KIND_NAMES[kind]}: {np.count_nonzero(events['kind'] == kind)}")
+                for event in events[:20]:
+                    print(f"  {event['onset']:.1f}s +{event['duration']:.1f}s  {texts[event['text']]}")
@@ -0,0 +1,138 @@
+import numpy as np
+import os
+
+from valid_regions import _long_runs
+
+# Breath amplitude is the mean |flow| over about one breath; the baseline is its mean over the
+# preceding two minutes of valid breathing.
+AMPLITUDE_WINDOW_SEC = 4
+BASELINE_WINDOW_SEC = 120
+MIN_EVENT_SEC = 10
+APNEA_REDUCTION = 0.90
+HYPOPNEA_REDUCTION = 0.30
+
+APNEA = 1
+HYPOPNEA = 2
+
+EVENT_DTYPE = np.dtype([
+    ('start', np.int32),
+    ('end', np.int32),
+    ('kind', np.uint8),
+    ('nadir_ratio', np.float32),
+])
+
+
+def _window_sums(prefix, starts, ends):
+    return prefix[ends] - prefix[starts]
+
+
+def amplitude_ratio(flow_data, sampling_rate, valid_mask=None):
+    """
+    Breath amplitude divided by its trailing baseline, sample by sample. Both come from one
+    cumulative sum each, so the whole night is a handful of linear passes. Samples without a
+    baseline (start of the night, or no valid breathing in the last two minutes) get NaN.
+    """
+    n_samples = len(flow_data)
+    if valid_mask is None:
+        valid_mask = np.ones(n_samples, dtype=bool)
+    index = np.arange(n_samples)
+
+    half = max(int(AMPLITUDE_WINDOW_SEC * sampling_rate) // 2, 1)
+    abs_prefix = np.concatenate(([0.0], np.cumsum(np.abs(flow_data))))
+    lo = np.maximum(index - half, 0)
+    hi = np.minimum(index + half + 1, n_samples)
+    amplitude = _window_sums(abs_prefix, lo, hi) / (hi - lo)
+
+    # Invalid stretches contribute neither amplitude nor weight to the baseline.
+    baseline_window = int(BASELINE_WINDOW_SEC * sampling_rate)
+    weighted_prefix = np.concatenate(([0.0], np.cumsum(np.where(valid_mask, amplitude, 0.0))))
+    count_prefix = np.concatenate(([0], np.cumsum(valid_mask)))
+    lo = np.maximum(index - baseline_window, 0)
+    counts = _window_sums(count_prefix, lo, index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        baseline = _window_sums(weighted_prefix, lo, index) / counts
+        ratio = amplitude / baseline
+    # Require at least half a window of valid baseline before judging a drop.
+    ratio[(counts < baseline_window // 2) | ~(baseline > 0)] = np.nan
+    return ratio
+
+
+def detect_events(flow_data, sampling_rate, valid_mask=None):
+    """
+    Flow-only apneas (amplitude down by at least APNEA_REDUCTION for MIN_EVENT_SEC) and hypopneas
+    (down by at least HYPOPNEA_REDUCTION for MIN_EVENT_SEC). No oximetry or arousal criterion is
+    applied. Events touching invalid regions are dropped.
+
+    Returns an EVENT_DTYPE table sorted by start; nadir_ratio is the lowest amplitude/baseline
+    ratio reached during the event.
+    """
+    ratio = amplitude_ratio(flow_data, sampling_rate, valid_mask)
+    min_samples = int(MIN_EVENT_SEC * sampling_rate)
+    with np.errstate(invalid='ignore'):
+        reduced = ratio <= 1 - HYPOPNEA_REDUCTION
+        absent = ratio <= 1 - APNEA_REDUCTION
+
+    starts, ends = _long_runs(reduced, min_samples)
+    table = np.zeros(len(starts), dtype=EVENT_DTYPE)
+    if len(starts) == 0:
+        return table
+    table['start'] = starts
+    table['end'] = ends
+    # Runs never overlap, so interleaved (start, end) bounds let reduceat take each one alone.
+    padded = np.append(ratio, np.inf)
+    table['nadir_ratio'] = np.minimum.reduceat(padded, np.column_stack((starts, ends)).ravel())[0::2]
+
+    # An event is an apnea when a long enough run of near-absent flow sits inside it.
+    apnea_starts, apnea_ends = _long_runs(absent, min_samples)
+    is_apnea = np.zeros(len(starts), dtype=bool)
+    is_apnea[np.searchsorted(starts, apnea_starts, side='right') - 1] = True
+    table['kind'] = np.where(is_apnea, APNEA, HYPOPNEA)
+
+    if valid_mask is not None:
+        invalid_prefix = np.concatenate(([0], np.cumsum(~valid_mask)))
+        table = table[_window_sums(invalid_prefix, starts, ends) == 0]
+    return table
+
+
+def event_indices(events, valid_mask, sampling_rate):
+    """Events per hour of valid breathing: {'ahi', 'apnea_index', 'hypopnea_index', 'valid_hours'}."""
+    valid_hours = np.count_nonzero(valid_mask) / sampling_rate / 3600
+    n_apneas = int(np.count_nonzero(events['kind'] == APNEA))
+    n_hypopneas = len(events) - n_apneas
+    if valid_hours <= 0:
+        return {'ahi': None, 'apnea_index': None, 'hypopnea_index': None, 'valid_hours': 0.0}
+    return {
+        'ahi': len(events) / valid_hours,
+        'apnea_index': n_apneas / valid_hours,
+        'hypopnea_index': n_hypopneas / valid_hours,
+        'valid_hours': valid_hours,
+    }
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file
+    from recording import Recording
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_edf(filepath)
+        if recording is None:
+            print(f"Failed to process {filename}.")
+        else:
+            events = detect_events(recording.flow_data, recording.sampling_rate, recording.valid_mask)
+            indices = event_indices(events, recording.valid_mask, recording.sampling_rate)
+            print(f"\n--- Respiratory Events (flow only) ---")
+            print(f"Apneas: {np.count_nonzero(events['kind'] == APNEA)}, Hypopneas: {np.count_nonzero(events['kind'] == HYPOPNEA)}")
+            if indices['ahi'] is not None:
+                print(f"AHI: {indices['ahi']:.1f}/h (AI {indices['apnea_index']:.1f}, HI {indices['hypopnea_index']:.1f}) "
+                      f"over {indices['valid_hours']:.2f} valid hours")
+            for event in events[:20]:
+                kind = 'Apnea' if event['kind'] == APNEA else 'Hypopnea'
+                print(f"  {kind}: {event['start'] / recording.sampling_rate:.1f}s - {event['end'] / recording.sampling_rate:.1f}s "
+                      f"(nadir {event['nadir_ratio'] * 100:.0f}% of baseline)")
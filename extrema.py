@@ -0,0 +1,90 @@
+import numpy as np
+
+from kernels import zigzag
+
+
+def _local_extrema_candidates(x):
+    """
+    Returns (indices, is_peak) for every local extremum of x, found from the slope sign changes.
+    Flat runs are collapsed onto their middle sample, the same convention find_peaks uses.
+    """
+    d = np.diff(x)
+    slope_idx = np.flatnonzero(d)
+    return _candidates_from_slopes(slope_idx, d[slope_idx] > 0)
+
+
+def _candidates_from_slopes(slope_idx, rising):
+    """
+    (indices, is_peak) of the extrema between consecutive non-zero slopes, given the positions in
+    np.diff(x) of those slopes and their signs. Split out so a growing signal can be scanned a piece
+    at a time by carrying its last slope over to the next piece.
+    """
+    if len(slope_idx) < 2:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=bool)
+
+    turns = np.flatnonzero(rising[1:] != rising[:-1])
+
+    # The extremum spans from the end of one slope run to the start of the next.
+    left = slope_idx[turns] + 1
+    right = slope_idx[turns + 1]
+    indices = ((left + right) // 2).astype(np.int32)
+    is_peak = rising[turns]
+    return indices, is_peak
+
+
+def _zigzag(indices, values, is_peak, prominence, distance):
+    """
+    Walks the candidate extrema once and keeps a strictly alternating peak/trough sequence.
+    A reversal is only accepted once the signal has moved at least `prominence` away from the
+    extreme being tracked and is at least `distance` samples past the previous extremum of its kind.
+    The extreme still being tracked when the candidates run out has no confirmed reversal and is
+    dropped. The walk itself is kernels.zigzag (Numba-compiled when available).
+    """
+    if len(indices) == 0:
+        return np.empty(0, dtype=np.int32), True
+
+    kept, tracked = zigzag(indices, values, is_peak, prominence, distance)
+    if len(kept) == 0:
+        return np.empty(0, dtype=np.int32), True
+    return np.asarray(indices)[kept].astype(np.int32), bool(is_peak[kept[0]])
+
+
+def _zigzag_signal(x, indices, is_peak, prominence, distance):
+    """
+    _zigzag over the candidates of x, with the same base rule as find_peaks at both ends of the
+    night: the last extremum is kept only if x moves `prominence` away from it before the end, and
+    the first only if it lies `prominence` beyond the opposite extreme of the samples before it.
+    """
+    if len(indices) == 0:
+        return np.empty(0, dtype=np.int32), True
+    # Candidates come from slope changes, so none sits on the last sample.
+    indices = np.append(indices, len(x) - 1).astype(np.int32)
+    is_peak = np.append(is_peak, not is_peak[-1])
+    extrema, first_is_peak = _zigzag(indices, x[indices], is_peak, prominence, distance)
+    if len(extrema) > 0:
+        head = x[:extrema[0] + 1]
+        rise = head[-1] - head.min() if first_is_peak else head.max() - head[-1]
+        if rise < prominence:
+            extrema, first_is_peak = extrema[1:], not first_is_peak
+    if len(extrema) == 0:
+        return extrema, True
+    return extrema, first_is_peak
+
+
+def find_alternating_extrema(x, prominence=0.01, distance=1):
+    """
+    Single-pass peak/trough detector.
+
+    Returns (extrema, first_is_peak): extrema is an int32 array of sample indices that strictly
+    alternates between peaks and troughs, starting with a peak when first_is_peak is True.
+    """
+    x = np.asarray(x)
+    indices, is_peak = _local_extrema_candidates(x)
+    return _zigzag_signal(x, indices, is_peak, prominence, max(int(distance), 1))
+
+
+def split_extrema(extrema, first_is_peak):
+    """Splits an alternating extrema sequence into (peaks, troughs) views."""
+    if first_is_peak:
+        return extrema[0::2], extrema[1::2]
+    return extrema[1::2], extrema[0::2]
@@ -0,0 +1,144 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft as sp_fft
+import glob
+import os
+import sys
+
+# Threads per transform; -1 uses every core. scipy.fft splits a 2-D transform's rows across them.
+FFT_WORKERS = -1
+# Upper bound on the complex output of one stacked transform, so a cohort is cut into batches.
+MAX_BATCH_BYTES = 256 * 2**20
+
+
+def fast_length(n_points):
+    """Smallest length >= n_points whose real FFT is fast (only factors 2, 3, 5)."""
+    return sp_fft.next_fast_len(int(n_points), real=True)
+
+
+def rfft_magnitudes(data, sampling_rate, n_fft=None, workers=FFT_WORKERS):
+    """
+    |rfft| of a signal, or of every row of a 2-D stack of equal-length segments in one call.
+    Each row's mean is removed first so zero padding up to n_fft (the next fast length by default)
+    does not leak the DC term into low frequencies. Padding also puts the bins on the n_fft grid,
+    so the same signal padded to a different n_fft peaks at a slightly different frequency.
+
+    Returns (freqs, magnitudes) with magnitudes shaped like data but with n_fft // 2 + 1 columns.
+    """
+    data = np.asarray(data, dtype=float)
+    if n_fft is None:
+        n_fft = fast_length(data.shape[-1])
+    centred = data - data.mean(axis=-1, keepdims=True)
+    magnitudes = np.abs(sp_fft.rfft(centred, n=n_fft, axis=-1, workers=workers))
+    return sp_fft.rfftfreq(n_fft, 1 / sampling_rate), magnitudes
+
+
+def band_peak(freqs, magnitudes, min_period_sec, max_period_sec):
+    """Frequency of the largest magnitude with a period in range, per row; NaN when no bin is in range."""
+    in_range = np.flatnonzero((freqs > 0) & (freqs >= 1 / max_period_sec) & (freqs <= 1 / min_period_sec))
+    if len(in_range) == 0:
+        return np.full(magnitudes.shape[:-1], np.nan)
+    return freqs[in_range[np.argmax(magnitudes[..., in_range], axis=-1)]]
+
+
+def dominant_frequency(data, sampling_rate, min_period_sec=30, max_period_sec=90, workers=FFT_WORKERS):
+    """Dominant frequency (Hz) of one signal within the period range, or None."""
+    freqs, magnitudes = rfft_magnitudes(data, sampling_rate, workers=workers)
+    peak = band_peak(freqs, magnitudes, min_period_sec, max_period_sec)
+    return None if np.isnan(peak) else float(peak)
+
+
+def _batches(n_rows, n_fft):
+    rows_per_batch = max(MAX_BATCH_BYTES // ((n_fft // 2 + 1) * 16), 1)
+    for start in range(0, n_rows, rows_per_batch):
+        yield start, min(start + rows_per_batch, n_rows)
+
+
+def _length_buckets(lengths):
+    """Groups signal indices by the fast length each signal pads to on its own."""
+    buckets = {}
+    for i, n_points in enumerate(lengths):
+        buckets.setdefault(fast_length(n_points), []).append(i)
+    return buckets
+
+
+def dominant_frequencies(signals, sampling_rate, min_period_sec=30, max_period_sec=90, workers=FFT_WORKERS):
+    """
+    Dominant frequency of each signal in a list (e.g. one night per entry across a cohort), all at
+    one sampling rate. Signals that pad to the same fast length (e.g. nights of equal duration)
+    are transformed as the rows of one 2-D array, so the cohort costs a few large multithreaded
+    calls and each FFT size is planned once rather than once per night. Every signal keeps its own
+    fast length, so each result equals dominant_frequency on that signal alone.
+
+    Returns an array with one frequency per signal, NaN where a signal has no bin in range.
+    """
+    lengths = np.array([len(signal) for signal in signals])
+    result = np.full(len(signals), np.nan)
+    for n_fft, bucket in _length_buckets(lengths).items():
+        bucket = [i for i in bucket if lengths[i] >= 2]
+        if not bucket:
+            continue
+        for start, end in _batches(len(bucket), n_fft):
+            rows = bucket[start:end]
+            stacked = np.zeros((len(rows), n_fft))
+            for row, i in enumerate(rows):
+                signal = np.asarray(signals[i], dtype=float)
+                # Centre each night on its own mean before padding; rfft_magnitudes would otherwise
+                # take the mean over the zero padding too.
+                stacked[row, :len(signal)] = signal - signal.mean()
+            freqs, magnitudes = rfft_magnitudes(stacked, sampling_rate, n_fft, workers)
+            result[rows] = band_peak(freqs, magnitudes, min_period_sec, max_period_sec)
+    return result
+
+
+def windowed_spectra(data, sampling_rate, window_sec, step_sec=None, workers=FFT_WORKERS):
+    """
+    Spectra of sliding windows across a night, stacked as rows of one transform per batch.
+    Windows are strided views into data, so only each batch's rows are copied.
+
+    Returns (window_starts, freqs, magnitudes): start sample of each window, the frequency axis
+    and an (n_windows, n_freqs) magnitude array. Empty arrays when data is shorter than a window.
+    """
+    window = int(window_sec * sampling_rate)
+    step = max(int((step_sec if step_sec is not None else window_sec) * sampling_rate), 1)
+    n_fft = fast_length(max(window, 1))
+    freqs = sp_fft.rfftfreq(n_fft, 1 / sampling_rate)
+    if window < 2 or len(data) < window:
+        return np.empty(0, dtype=np.int64), freqs, np.empty((0, len(freqs)))
+
+    windows = sliding_window_view(np.asarray(data, dtype=float), window)[::step]
+    window_starts = np.arange(len(windows)) * step
+    magnitudes = np.empty((len(windows), len(freqs)))
+    for start, end in _batches(len(windows), n_fft):
+        magnitudes[start:end] = rfft_magnitudes(windows[start:end], sampling_rate, n_fft, workers)[1]
+    return window_starts, freqs, magnitudes
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file, read_edf
+
+    # Usage: python fft_engine.py [directory of EDFs]; with no argument, pick a single file.
+    if len(sys.argv) > 1:
+        filepaths = sorted(glob.glob(os.path.join(sys.argv[1], '**', '*BRP.edf'), recursive=True))
+    else:
+        filepath = select_single_file()
+        filepaths = [filepath] if filepath else []
+
+    if not filepaths:
+        print("No files selected. Exiting script.")
+    else:
+        # The batched call needs one sampling rate, so group nights by it.
+        by_rate = {}
+        for filepath in filepaths:
+            flow_data, sampling_rate = read_edf(filepath)
+            if flow_data is None or sampling_rate is None or sampling_rate <= 0:
+                print(f"Failed to process {os.path.basename(filepath)}.")
+                continue
+            by_rate.setdefault(sampling_rate, []).append((os.path.basename(filepath), flow_data))
+
+        print(f"\n--- Dominant Periods (30-90 s) ---")
+        for sampling_rate, nights in by_rate.items():
+            frequencies = dominant_frequencies([flow for _, flow in nights], sampling_rate)
+            for (filename, _), frequency in zip(nights, frequencies):
+                period = f"{1 / frequency:.2f} s" if not np.isnan(frequency) else "none in range"
+                print(f"{filename}: {period}")
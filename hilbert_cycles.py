@@ -0,0 +1,141 @@
+import numpy as np
+from scipy.fft import next_fast_len
+import os
+
+from process_flow import select_single_file, read_edf
+
+
+def analytic_ventilation_signal(flow_data, sampling_rate, min_period_sec=30, max_period_sec=90):
+    """
+    Band-limits the ventilation signal (absolute flow) to the periodic breathing range and
+    returns its analytic signal from a single forward/inverse FFT pair.
+
+    Returns (band_signal, amplitude, phase), each the same length as flow_data.
+    Phase is wrapped to (-pi, pi]; 0 is the crest of a wave and +/-pi its trough.
+    """
+    if flow_data is None or sampling_rate is None or sampling_rate <= 0 or len(flow_data) < 2:
+        print("Invalid flow data or sampling rate for analytic signal.")
+        return None, None, None
+
+    n_points = len(flow_data)
+    n_fft = next_fast_len(n_points)
+
+    ventilation = np.abs(flow_data)
+    spectrum = np.fft.rfft(ventilation - np.mean(ventilation), n=n_fft)
+    freqs = np.fft.rfftfreq(n_fft, 1 / sampling_rate)
+
+    min_freq_hz = 1 / max_period_sec
+    max_freq_hz = 1 / min_period_sec
+    in_band = (freqs >= min_freq_hz) & (freqs <= max_freq_hz)
+    if not np.any(in_band):
+        print(f"No frequency bins between {min_freq_hz:.4f} and {max_freq_hz:.4f} Hz; recording too short for the analytic signal.")
+        return None, None, None
+
+    # Analytic signal: keep positive in-band frequencies only, doubled, and zero the rest.
+    analytic_spectrum = np.zeros(n_fft, dtype=complex)
+    band_idx = np.flatnonzero(in_band)
+    analytic_spectrum[band_idx] = 2 * spectrum[band_idx]
+    analytic = np.fft.ifft(analytic_spectrum)[:n_points]
+
+    band_signal = analytic.real
+    amplitude = np.abs(analytic)
+    phase = np.angle(analytic)
+    return band_signal, amplitude, phase
+
+
+def cycles_from_phase(band_signal, amplitude, phase, sampling_rate):
+    """
+    Splits the night into trough-to-trough cycles wherever the wrapped phase jumps from +pi to -pi.
+
+    Returns a cycle table as a dict of equal-length arrays:
+      'start', 'end', 'peak' (sample indices, int32), 'period' (s),
+      'depth' (crest-to-trough of the band-limited signal) and 'amplitude' (mean envelope).
+    """
+    boundaries = np.flatnonzero(np.diff(phase) < -np.pi) + 1
+    if len(boundaries) < 2:
+        return {
+            'start': np.empty(0, dtype=np.int32),
+            'end': np.empty(0, dtype=np.int32),
+            'peak': np.empty(0, dtype=np.int32),
+            'period': np.empty(0),
+            'depth': np.empty(0),
+            'amplitude': np.empty(0),
+        }
+
+    starts = boundaries[:-1]
+    ends = boundaries[1:]
+    lengths = ends - starts
+
+    # reduceat over the boundaries gives one value per cycle (plus the tail, which is dropped).
+    cycle_max = np.maximum.reduceat(band_signal, boundaries)[:-1]
+    cycle_min = np.minimum.reduceat(band_signal, boundaries)[:-1]
+    cycle_amp = np.add.reduceat(amplitude, boundaries)[:-1] / lengths
+
+    # Crest of each cycle is where the phase crosses zero going upwards.
+    crests = np.flatnonzero((phase[:-1] < 0) & (phase[1:] >= 0)) + 1
+    crest_pos = np.searchsorted(crests, starts)
+    crest_pos = np.minimum(crest_pos, max(len(crests) - 1, 0))
+    if len(crests) > 0:
+        peaks = crests[crest_pos]
+        peaks = np.where((peaks >= starts) & (peaks < ends), peaks, starts + lengths // 2)
+    else:
+        peaks = starts + lengths // 2
+
+    return {
+        'start': starts.astype(np.int32),
+        'end': ends.astype(np.int32),
+        'peak': peaks.astype(np.int32),
+        'period': lengths / sampling_rate,
+        'depth': cycle_max - cycle_min,
+        'amplitude': cycle_amp,
+    }
+
+
+def hilbert_wave_metrics(flow_data, sampling_rate, min_period_sec=30, max_period_sec=90):
+    """
+    Phase-based alternative to calculate_wave_metrics.
+
+    Returns (average_depth, average_wave_period_sec, amplitude, cycle_table), where only cycles
+    whose period falls inside the analysis band contribute to the averages.
+    """
+    band_signal, amplitude, phase = analytic_ventilation_signal(flow_data, sampling_rate, min_period_sec, max_period_sec)
+    if band_signal is None:
+        return None, None, None, None
+
+    cycle_table = cycles_from_phase(band_signal, amplitude, phase, sampling_rate)
+    periods = cycle_table['period']
+    in_range = (periods >= min_period_sec) & (periods <= max_period_sec)
+
+    print(f"DEBUG: Hilbert phase found {len(periods)} cycles, {int(np.sum(in_range))} within {min_period_sec}-{max_period_sec}s.")
+
+    if not np.any(in_range):
+        print("No cycles within the expected period range.")
+        return 0, None, amplitude, cycle_table
+
+    average_depth = np.mean(cycle_table['depth'][in_range])
+    average_wave_period_sec = np.mean(periods[in_range])
+    return average_depth, average_wave_period_sec, amplitude, cycle_table
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate = read_edf(filepath)
+
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            average_depth, average_wave_period, amplitude, cycle_table = hilbert_wave_metrics(flow_data, sampling_rate)
+            if average_wave_period is not None:
+                print(f"\n--- Hilbert Wave Metrics ---")
+                print(f"Average Crest-Trough Depth: {average_depth:.2f}")
+                print(f"Average Wave Period: {average_wave_period:.2f} seconds")
+                print(f"Cycles in table: {len(cycle_table['start'])}")
+            else:
+                print("Could not derive wave metrics from the analytic signal.")
+        else:
+            print(f"Failed to process {filename}.")
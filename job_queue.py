@@ -0,0 +1,290 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from analysis_service import analyze_night
+
+DEFAULT_LEASE_SEC = 600
+DEFAULT_MAX_ATTEMPTS = 3
+BACKOFF_BASE_SEC = 30
+BACKOFF_MAX_SEC = 3600
+IDLE_POLL_SEC = 5
+STATES = ('pending', 'running', 'done', 'failed')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    state TEXT NOT NULL DEFAULT 'pending' CHECK (state IN ('pending', 'running', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT,
+    result TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (state, not_before);
+"""
+
+
+def backoff_sec(attempts):
+    return min(BACKOFF_BASE_SEC * 2 ** max(attempts - 1, 0), BACKOFF_MAX_SEC)
+
+
+class JobQueue:
+    """
+    One row per EDF in a SQLite file. Workers claim a job by taking a time-limited lease inside a
+    write transaction, so any number of processes can drain the same queue; a lease that runs out
+    (crash, OOM, reboot) puts the job back as a failed attempt. Results are written in the same
+    statement that marks the job done, so a job is either done with its result or not done.
+
+    WAL mode is used for local databases. With shared_filesystem=True the database stays in
+    rollback-journal mode, which only needs the filesystem's byte-range locks; WAL's shared-memory
+    index does not work across machines. Locking on network filesystems is only as reliable as the
+    filesystem's, so prefer one queue file per machine when that is in doubt.
+    """
+
+    def __init__(self, db_path, shared_filesystem=False):
+        self.db_path = db_path
+        self.shared_filesystem = shared_filesystem
+        # The journal mode cannot change inside a transaction, so set up outside _connect.
+        conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        try:
+            conn.execute(f"PRAGMA journal_mode={'DELETE' if shared_filesystem else 'WAL'}")
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA synchronous=FULL" if self.shared_filesystem else "PRAGMA synchronous=NORMAL")
+        return _Transaction(conn)
+
+    def enqueue(self, paths, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Adds paths not already queued. Returns how many were new."""
+        now = time.time()
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (path, max_attempts, updated) VALUES (?, ?, ?)",
+                [(os.path.abspath(path), max_attempts, now) for path in paths]
+            )
+            return conn.total_changes - before
+
+    def _expire_leases(self, conn, now):
+        # A worker that lost its lease counts as a failed attempt; it may have crashed on this file.
+        conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+            "error = 'Lease expired (worker ' || lease_owner || ' stopped responding)', "
+            "not_before = ? + MIN(? * (1 << (attempts - 1)), ?), lease_owner = NULL, lease_expires = NULL, updated = ? "
+            "WHERE state = 'running' AND lease_expires < ?",
+            (now, BACKOFF_BASE_SEC, BACKOFF_MAX_SEC, now, now)
+        )
+
+    def claim(self, worker_id, lease_sec=DEFAULT_LEASE_SEC):
+        """Leases the oldest due pending job to worker_id. Returns (job_id, path, attempt) or None."""
+        now = time.time()
+        with self._connect() as conn:
+            self._expire_leases(conn, now)
+            row = conn.execute(
+                "SELECT id, path, attempts FROM jobs WHERE state = 'pending' AND not_before <= ? ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, path, attempts = row
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = ?, lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ?",
+                (attempts + 1, worker_id, now + lease_sec, now, job_id)
+            )
+            return job_id, path, attempts + 1
+
+    def heartbeat(self, job_id, worker_id, lease_sec=DEFAULT_LEASE_SEC):
+        """Extends the lease. Returns False if the job is no longer leased to worker_id."""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                (now + lease_sec, now, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        """Stores the result and marks the job done. Returns False if the lease was lost meanwhile."""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'done', result = ?, error = NULL, lease_owner = NULL, lease_expires = NULL, "
+                "updated = ? WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                (json.dumps(result), now, job_id, worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        """Records a failed attempt; the job is retried after a backoff until max_attempts is reached."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND state = 'running' AND lease_owner = ?",
+                (job_id, worker_id)
+            ).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, not_before = ?, lease_owner = NULL, lease_expires = NULL, "
+                "updated = ? WHERE id = ?",
+                ('failed' if attempts >= max_attempts else 'pending', str(error), now + backoff_sec(attempts), now, job_id)
+            )
+            return True
+
+    def retry_failed(self):
+        """Puts every failed job back to pending with a fresh set of attempts. Returns the count."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0, updated = ? WHERE state = 'failed'",
+                (time.time(),)
+            )
+            return cursor.rowcount
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(rows)
+        return counts
+
+    def next_due(self):
+        """Seconds until the next pending or leased job could be claimed, or None when nothing is left."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT MIN(CASE WHEN state = 'pending' THEN not_before ELSE lease_expires END) FROM jobs "
+                "WHERE state IN ('pending', 'running')"
+            ).fetchone()
+        return None if row[0] is None else max(row[0] - time.time(), 0)
+
+    def failures(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT path, attempts, error FROM jobs WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def results(self):
+        """(path, result dict) for every finished job."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT path, result FROM jobs WHERE state = 'done' ORDER BY id").fetchall()
+        return [(path, json.loads(result)) for path, result in rows]
+
+
+class _Transaction:
+    """Connection context that holds a write lock for the whole block (BEGIN IMMEDIATE)."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.conn.close()
+
+
+def run_worker(db_path, shared_filesystem=False, worker_id=None, lease_sec=DEFAULT_LEASE_SEC, task=None):
+    """
+    Claims and runs jobs until none are pending or leased elsewhere. task(path) returns a
+    JSON-serializable result; by default it is the analysis service's envelope pipeline.
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if task is None:
+        task = lambda path: analyze_night(path, None, None)
+    queue = JobQueue(db_path, shared_filesystem)
+
+    while True:
+        claimed = queue.claim(worker_id, lease_sec)
+        if claimed is None:
+            wait_sec = queue.next_due()
+            if wait_sec is None:
+                return
+            time.sleep(min(max(wait_sec, 0.1), IDLE_POLL_SEC))
+            continue
+
+        job_id, path, attempt = claimed
+        print(f"[{worker_id}] {os.path.basename(path)} (attempt {attempt})")
+        stop = threading.Event()
+
+        def keep_leased():
+            while not stop.wait(lease_sec / 3):
+                if not queue.heartbeat(job_id, worker_id, lease_sec):
+                    return
+
+        heartbeat = threading.Thread(target=keep_leased, daemon=True)
+        heartbeat.start()
+        try:
+            result = task(path)
+        except Exception as e:
+            outcome = queue.fail(job_id, worker_id, f"{type(e).__name__}: {e}")
+        else:
+            outcome = queue.complete(job_id, worker_id, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        if not outcome:
+            print(f"[{worker_id}] Lease on {os.path.basename(path)} was lost; its result was discarded.")
+
+
+def _expand_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '**', '*BRP.edf'), recursive=True))
+        else:
+            yield path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumable SQLite-backed batch queue for EDF analysis.")
+    parser.add_argument('db', help="Queue database file")
+    parser.add_argument('--shared-filesystem', action='store_true',
+                        help="Database lives on a filesystem shared between machines (disables WAL)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = commands.add_parser('enqueue', help="Add EDF files, or every *BRP.edf under directories")
+    enqueue_parser.add_argument('paths', nargs='+')
+    enqueue_parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    work_parser = commands.add_parser('work', help="Drain the queue")
+    work_parser.add_argument('--workers', type=int, default=1)
+    work_parser.add_argument('--lease-sec', type=float, default=DEFAULT_LEASE_SEC)
+    commands.add_parser('status', help="Show job counts and failures")
+    commands.add_parser('retry-failed', help="Requeue failed jobs")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db, args.shared_filesystem)
+    if args.command == 'enqueue':
+        added = queue.enqueue(_expand_paths(args.paths), args.max_attempts)
+        print(f"Queued {added} new files.")
+    elif args.command == 'work':
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(args.db, args.shared_filesystem, None, args.lease_sec))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elif args.command == 'retry-failed':
+        print(f"Requeued {queue.retry_failed()} failed jobs.")
+
+    print(", ".join(f"{state}: {count}" for state, count in queue.counts().items()))
+    if args.command == 'status':
+        for path, attempts, error in queue.failures():
+            print(f"  FAILED after {attempts} attempts: {path}: {error}")
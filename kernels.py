@@ -0,0 +1,194 @@
+import numpy as np
+import os
+import time
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Sequential state machines that cannot be expressed as whole-array operations. Each is written
+# once as a plain loop over arrays; with Numba installed the loop is compiled on first use,
+# otherwise the NumPy fallback runs. Both paths return identical results.
+BACKENDS = ('numba', 'numpy')
+_backend = 'numba' if numba is not None else 'numpy'
+_compiled = {}
+# First/last index for a breath with no sample above half its peak.
+_NO_SAMPLE = np.iinfo(np.int64).max
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(name=None):
+    """Forces 'numba' or 'numpy' kernels; None restores the default (numba when importable)."""
+    global _backend
+    if name is None:
+        name = 'numba' if numba is not None else 'numpy'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend '{name}'; expected one of {BACKENDS}.")
+    if name == 'numba' and numba is None:
+        raise ValueError("The numba kernel backend was requested but numba is not installed.")
+    _backend = name
+
+
+def _compiled_or_none(loop):
+    if _backend != 'numba':
+        return None
+    if loop not in _compiled:
+        _compiled[loop] = numba.njit(cache=True, nogil=True)(loop)
+    return _compiled[loop]
+
+
+def _zigzag_loop(indices, values, is_peak, prominence, distance):
+    kept = np.empty(len(indices), dtype=np.int64)
+    n_kept = 0
+    tracked = 0
+    for j in range(1, len(indices)):
+        if is_peak[j] == is_peak[tracked]:
+            if (is_peak[j] and values[j] > values[tracked]) or (not is_peak[j] and values[j] < values[tracked]):
+                tracked = j
+        elif abs(values[j] - values[tracked]) >= prominence and \
+                (n_kept == 0 or indices[j] - indices[kept[n_kept - 1]] >= distance):
+            kept[n_kept] = tracked
+            n_kept += 1
+            tracked = j
+    return kept[:n_kept], tracked
+
+
+def zigzag(indices, values, is_peak, prominence, distance):
+    """
+    (kept, tracked): positions (into the candidate arrays) of the alternating extrema
+    extrema._zigzag keeps, empty when the signal never reverses by `prominence`, and of the extreme
+    still being tracked at the end. Only extrema whose reversal a later candidate confirms are kept;
+    the tracked one lets a walk over a growing signal resume where it stopped. The walk is
+    inherently sequential, so the NumPy fallback is the same loop run by the interpreter.
+    """
+    indices = np.ascontiguousarray(indices, dtype=np.int64)
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    is_peak = np.ascontiguousarray(is_peak, dtype=np.bool_)
+    loop = _compiled_or_none(_zigzag_loop) or _zigzag_loop
+    return loop(indices, values, is_peak, float(prominence), int(distance))
+
+
+def _top_half_loop(flow_data, starts, ends, peak_flow):
+    first = np.empty(len(starts), dtype=np.int64)
+    last = np.empty(len(starts), dtype=np.int64)
+    for i in range(len(starts)):
+        threshold = 0.5 * peak_flow[i]
+        first[i] = _NO_SAMPLE
+        for k in range(starts[i], ends[i]):
+            if flow_data[k] > threshold:
+                first[i] = k
+                break
+        last[i] = 0
+        for k in range(ends[i] - 1, starts[i] - 1, -1):
+            if flow_data[k] > threshold:
+                last[i] = k + 1
+                break
+    return first, last
+
+
+def _top_half_numpy(flow_data, starts, ends, peak_flow):
+    lengths = ends - starts
+    breath_of = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # Sample positions of every breath laid end to end, without a Python loop over breaths.
+    positions = np.arange(np.sum(lengths)) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    above = flow_data[positions] > 0.5 * peak_flow[breath_of]
+    first = np.minimum.reduceat(np.where(above, positions, _NO_SAMPLE), offsets)
+    last = np.maximum.reduceat(np.where(above, positions, -1), offsets) + 1
+    return first, last
+
+
+def top_half_bounds(flow_data, starts, ends, peak_flow):
+    """
+    (first, last) per breath: the first sample above half the breath's peak flow and one past the
+    last, within [start, end). Breaths must be non-empty. A breath with no such sample gets
+    first = int64 max and last = 0.
+    """
+    flow_data = np.ascontiguousarray(flow_data, dtype=np.float64)
+    starts = np.ascontiguousarray(starts, dtype=np.int64)
+    ends = np.ascontiguousarray(ends, dtype=np.int64)
+    peak_flow = np.ascontiguousarray(peak_flow, dtype=np.float64)
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    loop = _compiled_or_none(_top_half_loop)
+    if loop is None:
+        return _top_half_numpy(flow_data, starts, ends, peak_flow)
+    return loop(flow_data, starts, ends, peak_flow)
+
+
+def _refractory_loop(times, refractory_sec):
+    count = 0
+    last_time = -np.inf
+    for t in times:
+        if t - last_time >= refractory_sec:
+            count += 1
+            last_time = t
+    return count
+
+
+def _refractory_numpy(times, refractory_sec):
+    n = len(times)
+    if n == 0:
+        return 0
+    # next_index[i] is the first candidate far enough after i to count. searchsorted on times + R can
+    # land one off from the t - last >= R test because of rounding; one step either way fixes it,
+    # since strictly increasing times are much further apart than that rounding.
+    index = np.arange(n)
+    next_index = np.searchsorted(times, times + refractory_sec, side='left')
+    back = (next_index - 1 > index) & (times[np.maximum(next_index - 1, 0)] - times >= refractory_sec)
+    next_index[back] -= 1
+    forward = (next_index < n) & (times[np.minimum(next_index, n - 1)] - times < refractory_sec)
+    next_index[forward] += 1
+    # Only the counted arousals are visited, not every candidate.
+    count, i = 0, 0
+    while i < n:
+        count += 1
+        i = next_index[i]
+    return count
+
+
+def refractory_count(times, refractory_sec):
+    """
+    Events counted from strictly increasing candidate times when each one must come at least
+    refractory_sec after the previous counted event (estimateArousals' refractory rule).
+    """
+    times = np.ascontiguousarray(times, dtype=np.float64)
+    loop = _compiled_or_none(_refractory_loop)
+    if loop is None:
+        return int(_refractory_numpy(times, float(refractory_sec)))
+    return int(loop(times, float(refractory_sec)))
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file, read_edf
+    from wat_metrics import browser_metrics
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate = read_edf(filepath)
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            backends = [name for name in BACKENDS if name != 'numba' or numba is not None]
+            results = {}
+            for name in backends:
+                set_backend(name)
+                browser_metrics(flow_data, sampling_rate, len(flow_data) / sampling_rate)  # warm-up and JIT compile
+                t0 = time.perf_counter()
+                results[name] = browser_metrics(flow_data, sampling_rate, len(flow_data) / sampling_rate)[0]
+                print(f"{name}: {time.perf_counter() - t0:.3f}s  {results[name]}")
+            set_backend()
+            if numba is None:
+                print("numba is not installed; only the NumPy kernels were run.")
+            elif results['numba'] != results['numpy']:
+                print("Error: Kernel backends disagree.")
+        else:
+            print(f"Failed to process {filename}.")
@@ -0,0 +1,491 @@
+import numpy as np
+import os
+import time
+from bisect import bisect_right
+
+from process_flow import select_single_file, read_edf_header, signal_limits, signal_scaling, smooth_abs_flow
+from extrema import _candidates_from_slopes
+from kernels import zigzag
+from cycle_table import CYCLE_DTYPE, cycle_flags, passing_runs
+from valid_regions import FLATLINE_MIN_SEC, FLATLINE_SMOOTHING_SEC, INVALID_MARGIN_SEC, _runs, find_invalid_intervals, intervals_to_mask
+from fft_engine import dominant_frequency
+
+SMOOTHING_WINDOW_SEC = 30
+MIN_PEAK_DISTANCE_SEC = 5
+# Prominence in L/s of envelope, the same threshold as process_flow.calculate_wave_metrics.
+PEAK_PROMINENCE = 0.01
+# The typical flow level the validity checks compare against is taken from this first stretch of
+# data, and the dominant period is first estimated then unless it is given up front.
+PERIOD_ESTIMATE_AFTER_SEC = 600
+# An estimated period is then updated from the spectrum of all the masked flow settled so far each
+# time this much more has settled, and the cycle table is re-tagged with it.
+PERIOD_UPDATE_SEC = 300
+# Rate of the running spectrum's signal: settled masked flow averaged into bins. Breathing and the
+# 30-90 s PB band both sit well below its Nyquist frequency.
+SPECTRUM_RATE_HZ = 1.0
+DEFAULT_POLL_INTERVAL_SEC = 5
+# Whether a sample is valid depends on the flow up to a flatline, its smoothing and its margin on either side.
+VALIDITY_LAG_SEC = FLATLINE_MIN_SEC + FLATLINE_SMOOTHING_SEC + INVALID_MARGIN_SEC
+
+
+def _print_event(event):
+    print(f"[{event['type']}] {event['start_sec']:.1f}s - {event['end_sec']:.1f}s ({event['cycles']} cycles)")
+
+
+class EdfFollower:
+    """
+    Follows an EDF that is still being written. Each poll decodes only the data records appended
+    since the last one and carries every stage forward from where the previous poll left it: the
+    validity mask, the envelope of the masked flow, the candidate scan, the peak/trough walk and the
+    cycle table only ever extend at the tail. Samples are settled in that order, each stage trailing
+    the previous one by what it needs to see ahead (VALIDITY_LAG_SEC, then half a smoothing window),
+    so nothing already settled is revisited. PB segments are re-tagged from the cycle table, with a
+    dominant period kept up to date from a running spectrum of the settled flow unless one was
+    given, and segments that opened or closed are reported through on_event.
+    """
+
+    def __init__(self, filepath, dominant_period_sec=None, on_event=_print_event,
+                 min_cycles=2, amplitude_threshold_percent=0.1, period_tolerance_percent=80,
+                 max_records_per_poll=None):
+        self.filepath = filepath
+        self.dominant_period_sec = dominant_period_sec
+        self._period_given = dominant_period_sec is not None
+        self.on_event = on_event
+        self.min_cycles = min_cycles
+        self.amplitude_threshold_percent = amplitude_threshold_percent
+        self.period_tolerance_percent = period_tolerance_percent
+        # Caps the records decoded per poll, so a finished night can be streamed in bounded blocks.
+        self.max_records_per_poll = max_records_per_poll
+
+        self.sampling_rate = None
+        self._header = None
+        self._data_offset = None
+        self._record_bytes = None
+        self._flow_samples_per_record = None
+        self._gain = None
+        self._offset = None
+        self._read_offset = None
+        self._clip_limits = None
+        self._typical_flow = None
+
+        # Buffers of the samples from _buffer_start on. They grow with amortized doubling, and once
+        # the typical flow is known the settled samples no stage will look back at are dropped, so
+        # they hold minutes of data rather than the night.
+        self._flow = np.empty(0)
+        self._valid = np.empty(0, dtype=bool)
+        self._envelope = np.empty(0)
+        self._buffer_start = 0
+        self.n_samples = 0
+        # Samples before each frontier are final: validity, then envelope, then scanned for candidates.
+        self._valid_stable = 0
+        self._envelope_stable = 0
+        self._invalid_runs = []
+        self._invalid_samples = 0
+        self._valid_envelope_sum = 0.0
+        self._valid_envelope_count = 0
+
+        # Settled masked flow averaged into bins of _bin_samples, for the running spectrum; the
+        # samples of a bin not yet complete wait in _bin_remainder.
+        self._bin_samples = None
+        self._bin_remainder = np.empty(0)
+        self._spectrum_signal = []
+        self._spectrum_bins = 0
+        self._period_estimated_bins = None
+
+        # Scan and walk state: the last non-zero envelope slope (position, rising), the last extremum
+        # the walk kept and the one it is tracking, each (index, value, is_peak). The first extremum
+        # needs a prominence-sized move from the samples before it, as in extrema._zigzag_signal, so
+        # their extremes are kept until it is settled.
+        self._last_slope = None
+        self._last_candidate_is_peak = None
+        self._last_kept = None
+        self._tracked = None
+        self._head_range = None
+        self._extrema = []
+        self._extrema_is_peak = []
+
+        # One entry per peak-to-peak cycle, appended as each closing peak is confirmed.
+        self._cycle_start = []
+        self._cycle_end = []
+        self._cycle_depth = []
+        self._cycle_invalid = []
+        self._last_peak = None
+        self._last_trough_value = None
+
+        self.peaks = np.empty(0, dtype=np.int32)
+        self.troughs = np.empty(0, dtype=np.int32)
+        self.cycles = None
+        self.segments = []
+        self._announced = {}
+
+    def _open_header(self):
+        size = os.path.getsize(self.filepath)
+        if size < 256:
+            return False
+        with open(self.filepath, 'rb') as f:
+            header = read_edf_header(f, self.filepath)
+            data_offset = f.tell()
+        if size < data_offset:
+            return False
+
+        signal_headers = header['signal_headers']
+        flow_info = signal_headers[0]
+        if flow_info['digital_maximum'] == flow_info['digital_minimum']:
+            raise ValueError(f"Digital min and max are equal for signal '{flow_info['label']}'. Cannot calculate gain.")
+
+        self._header = header
+        self._data_offset = data_offset
+        self._read_offset = data_offset
+        self._record_bytes = sum(max(h['num_samples_in_data_record'], 0) for h in signal_headers) * 2
+        self._flow_samples_per_record = flow_info['num_samples_in_data_record']
+        self._gain, self._offset = signal_scaling(flow_info)
+        self._clip_limits = signal_limits(flow_info)
+        self.sampling_rate = self._flow_samples_per_record / header['duration_data_record']
+        self._bin_samples = max(int(round(self.sampling_rate / SPECTRUM_RATE_HZ)), 1)
+        return True
+
+    def _resize_buffers(self, keep_from, capacity):
+        """Moves the samples from keep_from on into buffers of the given capacity."""
+        used = slice(keep_from - self._buffer_start, self.n_samples - self._buffer_start)
+        for name, dtype in (('_flow', float), ('_envelope', float), ('_valid', bool)):
+            resized = np.empty(capacity, dtype=dtype)
+            resized[:self.n_samples - keep_from] = getattr(self, name)[used]
+            setattr(self, name, resized)
+        self._buffer_start = keep_from
+
+    def _append(self, new_flow):
+        needed = self.n_samples + len(new_flow) - self._buffer_start
+        if needed > len(self._flow):
+            self._resize_buffers(self._buffer_start, max(needed, 2 * len(self._flow), 1))
+        self._flow[self.n_samples - self._buffer_start:needed] = new_flow
+        self.n_samples += len(new_flow)
+
+    def _trim_buffers(self):
+        """Drops the samples before the earliest one a later poll can read, once they fill half the buffers."""
+        window = max(int(SMOOTHING_WINDOW_SEC * self.sampling_rate), 1)
+        lag = int(VALIDITY_LAG_SEC * self.sampling_rate) + 1
+        keep_from = max(min(self._valid_stable - lag, self._envelope_stable - window - 1), self._buffer_start)
+        if keep_from - self._buffer_start > len(self._flow) // 2:
+            self._resize_buffers(keep_from, len(self._flow))
+
+    def _read_new_records(self):
+        """Decodes the complete records written since the last poll, up to max_records_per_poll. Returns the new flow samples."""
+        size = os.path.getsize(self.filepath)
+        if size < self._read_offset:
+            raise ValueError(f"{os.path.basename(self.filepath)} shrank while being followed; it was probably replaced.")
+        n_records = (size - self._read_offset) // self._record_bytes
+        if self.max_records_per_poll is not None:
+            n_records = min(n_records, self.max_records_per_poll)
+        if n_records == 0:
+            return np.empty(0)
+
+        with open(self.filepath, 'rb') as f:
+            f.seek(self._read_offset)
+            raw = f.read(n_records * self._record_bytes)
+        n_records = len(raw) // self._record_bytes
+        self._read_offset += n_records * self._record_bytes
+
+        # Flow is signal 0, so it is the first block of every record.
+        records = np.frombuffer(raw[:n_records * self._record_bytes], dtype='<i2').reshape(n_records, -1)
+        return records[:, :self._flow_samples_per_record].ravel() * self._gain + self._offset
+
+    def _update_validity(self, final=False):
+        """Settles the validity mask up to VALIDITY_LAG_SEC before the end of the data, or to the end when final."""
+        lag = int(VALIDITY_LAG_SEC * self.sampling_rate) + 1
+        stable = self.n_samples if final else self.n_samples - lag
+        if stable <= self._valid_stable:
+            return
+        start = max(self._valid_stable - lag, 0)
+        offset = self._buffer_start
+        intervals, reasons = find_invalid_intervals(self._flow[start - offset:self.n_samples - offset], self.sampling_rate,
+                                                    self._clip_limits, typical_flow=self._typical_flow)
+        valid = intervals_to_mask(intervals, self.n_samples - start)[self._valid_stable - start:stable - start]
+        self._valid[self._valid_stable - offset:stable - offset] = valid
+        self._extend_spectrum_signal(np.where(valid, self._flow[self._valid_stable - offset:stable - offset], 0.0))
+
+        for run_start, run_end in zip(*_runs(~valid)):
+            run_start += self._valid_stable
+            run_end += self._valid_stable
+            if self._invalid_runs and self._invalid_runs[-1][1] == run_start:
+                self._invalid_runs[-1][1] = run_end
+            else:
+                self._invalid_runs.append([run_start, run_end])
+            self._invalid_samples += run_end - run_start
+        self._valid_stable = stable
+
+    def _update_envelope(self, final=False):
+        """
+        Settles the envelope of the masked flow up to half a window before the validity frontier,
+        or to the end of the data when final.
+        """
+        window = max(int(SMOOTHING_WINDOW_SEC * self.sampling_rate), 1)
+        stable = self._valid_stable if final else max(self._valid_stable - (window - window // 2), 0)
+        if stable <= self._envelope_stable:
+            return
+        start = max(self._envelope_stable - window, 0)
+        offset = self._buffer_start
+        # Invalid stretches are zeroed before smoothing, as in the whole-night pipeline.
+        masked = np.where(self._valid[start - offset:self._valid_stable - offset],
+                          self._flow[start - offset:self._valid_stable - offset], 0.0)
+        recomputed = smooth_abs_flow(np.abs(masked), window)
+        settled = recomputed[self._envelope_stable - start:stable - start]
+        self._envelope[self._envelope_stable - offset:stable - offset] = settled
+
+        valid = self._valid[self._envelope_stable - offset:stable - offset]
+        self._valid_envelope_sum += float(np.sum(settled[valid]))
+        self._valid_envelope_count += int(np.count_nonzero(valid))
+        if self._envelope_stable == 0:
+            self._head_range = (settled[0], settled[0])
+        previous_stable = self._envelope_stable
+        self._envelope_stable = stable
+        self._update_extrema(previous_stable, stable)
+
+    def _update_extrema(self, start, end):
+        """Scans envelope samples start..end-1 for candidates and walks them, extending the extrema."""
+        first = max(start - 1, 0)
+        d = np.diff(self._envelope[first - self._buffer_start:end - self._buffer_start])
+        slope_idx = np.flatnonzero(d)
+        rising = d[slope_idx] > 0
+        slope_idx = slope_idx + first
+        if self._last_slope is not None:
+            slope_idx = np.concatenate(([self._last_slope[0]], slope_idx))
+            rising = np.concatenate(([self._last_slope[1]], rising))
+        if len(slope_idx) == 0:
+            return
+        self._last_slope = (int(slope_idx[-1]), bool(rising[-1]))
+        indices, is_peak = _candidates_from_slopes(slope_idx, rising)
+        if len(indices) == 0:
+            return
+        self._last_candidate_is_peak = bool(is_peak[-1])
+
+        # A flat run has one value throughout, so a candidate's value is that of the sample where
+        # the next slope starts, which lies in this scan even when the candidate does not.
+        next_slope = slope_idx[np.searchsorted(slope_idx, indices)]
+        self._walk(indices, self._envelope[next_slope - self._buffer_start], is_peak)
+
+    def _walk(self, indices, values, is_peak):
+        """Extends the peak/trough walk over candidates that come after every one walked so far."""
+        # The walk resumes by replaying the last kept extremum and the tracked one ahead of the new
+        # candidates; the replayed extremum is always kept again and is dropped from the output.
+        resumed = [state for state in (self._last_kept, self._tracked) if state is not None]
+        all_indices = np.concatenate(([state[0] for state in resumed], indices)).astype(np.int64)
+        all_values = np.concatenate(([state[1] for state in resumed], values))
+        all_is_peak = np.concatenate(([state[2] for state in resumed], is_peak)).astype(bool)
+        min_distance = max(int(MIN_PEAK_DISTANCE_SEC * self.sampling_rate), 1)
+        kept, tracked = zigzag(all_indices, all_values, all_is_peak, PEAK_PROMINENCE, min_distance)
+        if self._last_kept is not None:
+            kept = kept[1:]
+        self._tracked = (int(all_indices[tracked]), float(all_values[tracked]), bool(all_is_peak[tracked]))
+
+        if self._head_range is not None:
+            low, high = self._head_range
+            head = all_values[:kept[0] + 1] if len(kept) > 0 else all_values
+            low, high = min(low, np.min(head)), max(high, np.max(head))
+            self._head_range = (low, high)
+            if len(kept) > 0:
+                first_value = all_values[kept[0]]
+                rise = first_value - low if all_is_peak[kept[0]] else high - first_value
+                self._head_range = None
+                self._last_kept = (int(all_indices[kept[0]]), float(first_value), bool(all_is_peak[kept[0]]))
+                if rise < PEAK_PROMINENCE:
+                    kept = kept[1:]
+
+        for position in kept:
+            self._last_kept = (int(all_indices[position]), float(all_values[position]), bool(all_is_peak[position]))
+            self._add_extremum(*self._last_kept)
+
+    def _add_extremum(self, index, value, is_peak):
+        self._extrema.append(index)
+        self._extrema_is_peak.append(is_peak)
+        if not is_peak:
+            self._last_trough_value = value
+            return
+        if self._last_peak is not None:
+            start, start_value = self._last_peak
+            self._cycle_start.append(start)
+            self._cycle_end.append(index)
+            # Extrema alternate, so exactly one trough lies between consecutive peaks.
+            self._cycle_depth.append(start_value - self._last_trough_value)
+            # The cycle fails if any sample from its first peak to its closing one is invalid.
+            # Runs are disjoint and sorted, so only the last one starting by the closing peak can reach back.
+            run = bisect_right(self._invalid_runs, [index + 1]) - 1
+            self._cycle_invalid.append(run >= 0 and self._invalid_runs[run][1] > start)
+        self._last_peak = (index, value)
+
+    def _extend_spectrum_signal(self, masked_flow):
+        """Appends newly settled masked flow to the running spectrum's signal, one bin mean per _bin_samples."""
+        pending = np.concatenate((self._bin_remainder, masked_flow))
+        whole = len(pending) // self._bin_samples * self._bin_samples
+        if whole > 0:
+            self._spectrum_signal.append(pending[:whole].reshape(-1, self._bin_samples).mean(axis=1))
+            self._spectrum_bins += whole // self._bin_samples
+        self._bin_remainder = pending[whole:]
+
+    def _update_period(self, force=False, min_period_sec=30, max_period_sec=90):
+        """
+        Estimates the dominant period from the running spectrum, the first time and then once every
+        PERIOD_UPDATE_SEC of newly settled data (or now, when forced). Re-tagging picks it up.
+        """
+        update_bins = int(PERIOD_UPDATE_SEC * self.sampling_rate / self._bin_samples)
+        if self._spectrum_bins == 0 or (not force and self._period_estimated_bins is not None
+                                        and self._spectrum_bins < self._period_estimated_bins + update_bins):
+            return
+        self._spectrum_signal = [np.concatenate(self._spectrum_signal)]
+        frequency = dominant_frequency(self._spectrum_signal[0], self.sampling_rate / self._bin_samples,
+                                       min_period_sec, max_period_sec)
+        self._period_estimated_bins = self._spectrum_bins
+        if frequency is not None and 1 / frequency != self.dominant_period_sec:
+            self.dominant_period_sec = 1 / frequency
+            print(f"DEBUG: Live dominant period now {self.dominant_period_sec:.2f} seconds.")
+
+    def _tag_segments(self):
+        extrema = np.asarray(self._extrema, dtype=np.int32)
+        is_peak = np.asarray(self._extrema_is_peak, dtype=bool)
+        self.peaks, self.troughs = extrema[is_peak], extrema[~is_peak]
+
+        # Flags are re-derived over the whole cycle table because the amplitude threshold follows
+        # the running mean; that is a few hundred rows a night, not a pass over the samples.
+        starts = np.asarray(self._cycle_start, dtype=np.int64)
+        ends = np.asarray(self._cycle_end, dtype=np.int64)
+        depth = np.asarray(self._cycle_depth, dtype=float)
+        period = (ends - starts) / self.sampling_rate
+        lower = self.dominant_period_sec * (1 - self.period_tolerance_percent / 100.0)
+        upper = self.dominant_period_sec * (1 + self.period_tolerance_percent / 100.0)
+        mean_envelope = self._valid_envelope_sum / max(self._valid_envelope_count, 1)
+        min_amplitude = mean_envelope * (self.amplitude_threshold_percent / 100.0)
+        flags = cycle_flags(period, depth, np.ones(len(starts), dtype=bool), min_amplitude, lower, upper,
+                            np.asarray(self._cycle_invalid, dtype=bool))
+
+        self.cycles = np.zeros(len(starts), dtype=CYCLE_DTYPE)
+        self.cycles['start'] = starts
+        self.cycles['end'] = ends
+        self.cycles['period'] = period
+        self.cycles['depth'] = depth
+        self.cycles['flags'] = flags
+
+        # A segment is closed once a failing cycle follows it; the one reaching the last peak is still open.
+        segments = []
+        for a, b in passing_runs(flags, self.min_cycles):
+            self.cycles['in_segment'][a:b] = True
+            segments.append((int(starts[a]), int(ends[b - 1]), int(b - a), bool(b != len(starts))))
+        return segments
+
+    def _emit(self, event_type, start_idx, end_idx, cycles):
+        if self.on_event is not None:
+            self.on_event({
+                'type': event_type,
+                'start_sec': start_idx / self.sampling_rate,
+                'end_sec': end_idx / self.sampling_rate,
+                'cycles': cycles,
+            })
+
+    def poll(self):
+        """Processes whatever has been appended since the last call. Returns the number of new samples."""
+        if self._header is None and not self._open_header():
+            return 0
+
+        new_flow = self._read_new_records()
+        if len(new_flow) == 0:
+            return 0
+        self._append(new_flow)
+        if self._typical_flow is None:
+            if self.n_samples / self.sampling_rate < PERIOD_ESTIMATE_AFTER_SEC:
+                return len(new_flow)
+            self._typical_flow = float(np.percentile(np.abs(self._flow[:self.n_samples]), 95))
+        self._update_validity()
+        self._update_envelope()
+        self._report()
+        return len(new_flow)
+
+    def finish(self):
+        """
+        Treats what has been read as the whole night, as when streaming a finished file: settles
+        the samples the stages were still waiting on, lets the end of the data confirm the last
+        extremum, the way extrema._zigzag_signal does for a whole night, and re-estimates the
+        period from all of it. Segments reported open that no longer exist are closed.
+        """
+        if self._header is None or self._typical_flow is None:
+            return
+        self._update_validity(final=True)
+        self._update_envelope(final=True)
+        last = self.n_samples - 1
+        if self._last_candidate_is_peak is not None and (self._tracked is None or self._tracked[0] < last):
+            self._walk(np.array([last]), np.array([self._envelope[last - self._buffer_start]]),
+                       np.array([not self._last_candidate_is_peak]))
+        if not self._period_given:
+            self._update_period(force=True)
+        self._report()
+        current_starts = {start_idx for start_idx, end_idx, cycles, closed in self.segments}
+        for start_idx, (state, end_idx) in list(self._announced.items()):
+            if state == 'open' and start_idx not in current_starts:
+                self._emit('pb_close', start_idx, end_idx, 0)
+                self._announced[start_idx] = ('closed', end_idx)
+
+    def _report(self):
+        """
+        Re-tags PB segments with the current period, once there is one, and reports the ones that
+        opened or closed. When the period has changed, segments it splits, merges or drops are
+        handled like any other revision of the cycle flags.
+        """
+        self._trim_buffers()
+        if not self._period_given:
+            self._update_period()
+        if self.dominant_period_sec is None:
+            return
+
+        self.segments = self._tag_segments()
+        current_starts = {start_idx for start_idx, end_idx, cycles, closed in self.segments}
+        for start_idx, (state, end_idx) in list(self._announced.items()):
+            if state == 'open' and start_idx not in current_starts:
+                # The cycle flags were revised; hand the open state to the segment replacing it. One
+                # that vanished without a replacement stays open, as a new period often brings it
+                # back, and is closed by finish() if it never returns.
+                for new_start, new_end, cycles, closed in self.segments:
+                    if new_start <= end_idx and new_end >= start_idx and new_start not in self._announced:
+                        del self._announced[start_idx]
+                        self._announced[new_start] = ('open', new_end)
+                        break
+
+        for start_idx, end_idx, cycles, closed in self.segments:
+            state = self._announced.get(start_idx, (None, end_idx))[0]
+            if state is None:
+                self._emit('pb_open', start_idx, end_idx, cycles)
+                state = 'open'
+            if closed and state == 'open':
+                self._emit('pb_close', start_idx, end_idx, cycles)
+                state = 'closed'
+            self._announced[start_idx] = (state, end_idx)
+
+    @property
+    def periodic_percentage(self):
+        """Share of the valid recording so far that lies inside PB segments, open ones included."""
+        valid_samples = self.n_samples - self._invalid_samples
+        if valid_samples <= 0:
+            return 0
+        periodic_samples = sum(end_idx - start_idx for start_idx, end_idx, cycles, closed in self.segments)
+        return periodic_samples / valid_samples * 100
+
+    def follow(self, poll_interval_sec=DEFAULT_POLL_INTERVAL_SEC, idle_timeout_sec=None):
+        """Polls until the file stops growing for idle_timeout_sec (forever when None)."""
+        idle_sec = 0
+        while idle_timeout_sec is None or idle_sec < idle_timeout_sec:
+            if self.poll() > 0:
+                idle_sec = 0
+                print(f"DEBUG: {self.n_samples / self.sampling_rate:.0f}s decoded, periodic so far: {self.periodic_percentage:.2f}%")
+            else:
+                idle_sec += poll_interval_sec
+            time.sleep(poll_interval_sec)
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        print(f"\nFollowing file: {os.path.basename(filepath)} (Ctrl+C to stop)")
+        follower = EdfFollower(filepath)
+        try:
+            follower.follow()
+        except KeyboardInterrupt:
+            print(f"\nStopped. Periodic so far: {follower.periodic_percentage:.2f}%")
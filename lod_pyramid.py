@@ -0,0 +1,154 @@
+import numpy as np
+import os
+
+# Buckets per tile; clients cache tiles by (level, tile index).
+TILE_SIZE = 1024
+# Coarsest level keeps at least this many buckets so a full-night view is never a single point.
+MIN_TOP_LEVEL_BUCKETS = 512
+LOD_SUFFIX = '.lod.npz'
+
+
+def build_pyramid(signal, sampling_rate, keep_raw=True):
+    """
+    Min/max/mean level-of-detail pyramid. Level k summarizes buckets of 2**k samples and is made
+    from level k-1 by pairing neighbouring buckets, so the whole pyramid costs about two passes
+    over the signal. Level 0 is the raw signal when keep_raw is True.
+    """
+    signal = np.asarray(signal, dtype=np.float32)
+    pyramid = {
+        'sampling_rate': float(sampling_rate),
+        'n_samples': len(signal),
+        'levels': [],
+    }
+    pyramid['levels'].append((signal, signal, signal) if keep_raw else None)
+
+    mins, maxs, means = signal, signal, signal
+    while len(mins) >= 2 * MIN_TOP_LEVEL_BUCKETS:
+        if len(mins) % 2:
+            # Repeat the last bucket so the pairs come out even; min and max are unaffected.
+            mins, maxs, means = (np.append(a, a[-1]) for a in (mins, maxs, means))
+        mins = np.minimum(mins[0::2], mins[1::2])
+        maxs = np.maximum(maxs[0::2], maxs[1::2])
+        means = (means[0::2] + means[1::2]) * np.float32(0.5)
+        pyramid['levels'].append((mins, maxs, means))
+    return pyramid
+
+
+def choose_level(pyramid, t0, t1, pixel_width):
+    """Finest level that puts at most two buckets on each pixel of the requested range."""
+    n_in_range = max((t1 - t0) * pyramid['sampling_rate'], 1)
+    level = int(np.ceil(np.log2(max(n_in_range / (2 * pixel_width), 1))))
+    level = min(level, len(pyramid['levels']) - 1)
+    if level == 0 and pyramid['levels'][0] is None:
+        level = 1 if len(pyramid['levels']) > 1 else 0
+    return level
+
+
+def tiles_for_range(pyramid, t0, t1, pixel_width):
+    """(level, tile indices) covering the time range [t0, t1) seconds at pixel_width pixels."""
+    level = choose_level(pyramid, t0, t1, pixel_width)
+    bucket_sec = (2 ** level) / pyramid['sampling_rate']
+    n_buckets = len(pyramid['levels'][level][0])
+    first = int(max(t0, 0) // bucket_sec) // TILE_SIZE
+    last = int(min(max(t1, 0) // bucket_sec, n_buckets - 1)) // TILE_SIZE
+    return level, list(range(first, last + 1))
+
+
+def get_tile(pyramid, level, tile):
+    """(times, mins, maxs, means) of one tile; times are bucket starts in seconds."""
+    mins, maxs, means = pyramid['levels'][level]
+    lo = tile * TILE_SIZE
+    hi = min(lo + TILE_SIZE, len(mins))
+    times = np.arange(lo, hi) * (2 ** level) / pyramid['sampling_rate']
+    return times, mins[lo:hi], maxs[lo:hi], means[lo:hi]
+
+
+def query_range(pyramid, t0, t1, pixel_width):
+    """The tiles covering [t0, t1) joined into one (times, mins, maxs, means) tuple."""
+    level, tiles = tiles_for_range(pyramid, t0, t1, pixel_width)
+    parts = [get_tile(pyramid, level, tile) for tile in tiles]
+    if not parts:
+        return tuple(np.empty(0) for _ in range(4))
+    return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+
+def save_pyramid(path, pyramid):
+    arrays = {}
+    for level, arrays_at_level in enumerate(pyramid['levels']):
+        if arrays_at_level is None or level == 0:
+            continue
+        arrays[f'min_{level}'], arrays[f'max_{level}'], arrays[f'mean_{level}'] = arrays_at_level
+    if pyramid['levels'][0] is not None:
+        arrays['raw'] = pyramid['levels'][0][0]
+    np.savez(path, sampling_rate=pyramid['sampling_rate'], n_samples=pyramid['n_samples'],
+             n_levels=len(pyramid['levels']), **arrays)
+
+
+def load_pyramid(path):
+    with np.load(path) as stored:
+        n_levels = int(stored['n_levels'])
+        raw = stored['raw'] if 'raw' in stored.files else None
+        levels = [(raw, raw, raw) if raw is not None else None]
+        for level in range(1, n_levels):
+            levels.append((stored[f'min_{level}'], stored[f'max_{level}'], stored[f'mean_{level}']))
+        return {
+            'sampling_rate': float(stored['sampling_rate']),
+            'n_samples': int(stored['n_samples']),
+            'levels': levels,
+        }
+
+
+def attach_to_axes(ax, pyramid, color='blue', label=None):
+    """
+    Draws the pyramid on a matplotlib Axes as a min/max band plus mean line and redraws from the
+    matching level whenever the x-limits change, so zooming never replots the full night.
+    """
+    artists = {}
+
+    def redraw(axes):
+        t0, t1 = axes.get_xlim()
+        pixel_width = max(int(axes.bbox.width), 1)
+        times, mins, maxs, means = query_range(pyramid, t0, t1, pixel_width)
+        if 'band' in artists:
+            artists['band'].remove()
+        artists['band'] = axes.fill_between(times, mins, maxs, color=color, alpha=0.3, lw=0)
+        if 'line' in artists:
+            artists['line'].set_data(times, means)
+        else:
+            artists['line'], = axes.plot(times, means, color=color, label=label)
+
+    ax.set_xlim(0, pyramid['n_samples'] / pyramid['sampling_rate'])
+    redraw(ax)
+    ax.callbacks.connect('xlim_changed', redraw)
+    return artists
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    from process_flow import select_single_file
+    from recording import Recording
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_edf(filepath)
+        if recording is None:
+            print(f"Failed to process {filename}.")
+        else:
+            pyramid = build_pyramid(recording.flow_data, recording.sampling_rate)
+            out_path = os.path.splitext(filepath)[0] + LOD_SUFFIX
+            save_pyramid(out_path, pyramid)
+            print(f"Saved {len(pyramid['levels'])} levels to {out_path}")
+
+            fig, ax = plt.subplots(figsize=(15, 6))
+            attach_to_axes(ax, pyramid, label='Flow')
+            ax.set_title(f'Flow for {filename} (zoomable)')
+            ax.set_xlabel('Time (seconds)')
+            ax.set_ylabel('Flow (L/s)')
+            ax.grid(True)
+            plt.show()
@@ -0,0 +1,173 @@
+import numpy as np
+import os
+
+from breath_metrics import breath_table
+from recording import Recording, envelope_detector
+
+# Breath-by-breath ventilation is resampled to this rate before fitting.
+VENTILATION_RATE_HZ = 1.0
+# Range of chemoreflex delays tried for each cycle (circulation time from lung to chemoreceptor).
+DELAY_RANGE_SEC = (5, 45)
+# Loop gain is also reported at one cycle per minute (LG1), the convention of Terrill et al. (2015).
+LG1_PERIOD_SEC = 60
+MIN_FIT_SAMPLES = 10
+
+LOOP_GAIN_DTYPE = np.dtype([
+    ('start', np.int32),        # flow sample indices, as in the cycle table
+    ('end', np.int32),
+    ('delay_sec', np.float32),
+    ('a', np.float32),          # ventilation carried over from the previous second
+    ('b', np.float32),          # chemoreflex response to ventilation delay_sec ago
+    ('loop_gain', np.float32),  # |open-loop gain| at the cycle's own period
+    ('loop_gain_1', np.float32),
+    ('r2', np.float32),
+])
+
+
+def ventilation_signal(flow_data, sampling_rate, rate=VENTILATION_RATE_HZ):
+    """Breath-by-breath ventilation (VT / Ttot, in flow units x 60) interpolated onto a regular grid."""
+    table = breath_table(flow_data, sampling_rate)
+    n_out = int(len(flow_data) / sampling_rate * rate)
+    if len(table['start']) < 2 or n_out == 0:
+        return np.zeros(n_out)
+    breath_times = (table['start'] + table['end']) / 2 / sampling_rate
+    return np.interp(np.arange(n_out) / rate, breath_times, table['vt'] / table['ttot'] * 60)
+
+
+def _window_sums(prefix, starts, ends):
+    return prefix[ends] - prefix[starts]
+
+
+def fit_cycles(ventilation, starts, ends, delays):
+    """
+    Fits v[n] = a * v[n-1] + b * v[n-D] (+ a per-cycle constant) over rows n in [start, end) of
+    every cycle at once, for each delay D in samples, and keeps each cycle's best delay.
+
+    The normal equations of all cycles come from prefix sums of the lagged products, so each delay
+    costs a few passes over the night and a closed-form 2x2 solve per cycle; no per-cycle loop.
+    Returns (a, b, delay, r2), NaN for cycles that start before the longest delay or are too short.
+    """
+    n_cycles = len(starts)
+    best_rss = np.full(n_cycles, np.inf)
+    a_best, b_best, delay_best, r2_best = (np.full(n_cycles, np.nan) for _ in range(4))
+    counts = (ends - starts).astype(float)
+    usable = (starts >= max(delays)) & (counts >= MIN_FIT_SAMPLES) & (ends <= len(ventilation))
+    if not np.any(usable):
+        return a_best, b_best, delay_best, r2_best
+    starts, ends = np.where(usable, starts, 0), np.where(usable, ends, MIN_FIT_SAMPLES)
+    counts = (ends - starts).astype(float)
+
+    def prefix(values):
+        return np.concatenate(([0.0], np.cumsum(values)))
+
+    def centred(p, q, sum_p, sum_q):
+        return _window_sums(prefix(p * q), starts, ends) - sum_p * sum_q / counts
+
+    y = ventilation
+    x1 = np.concatenate(([0.0], ventilation[:-1]))
+    sum_y = _window_sums(prefix(y), starts, ends)
+    sum_x1 = _window_sums(prefix(x1), starts, ends)
+    c_yy = centred(y, y, sum_y, sum_y)
+    c_11 = centred(x1, x1, sum_x1, sum_x1)
+    c_y1 = centred(y, x1, sum_y, sum_x1)
+
+    for delay in delays:
+        xd = np.concatenate((np.zeros(delay), ventilation[:-delay]))
+        sum_xd = _window_sums(prefix(xd), starts, ends)
+        c_dd = centred(xd, xd, sum_xd, sum_xd)
+        c_1d = centred(x1, xd, sum_x1, sum_xd)
+        c_yd = centred(y, xd, sum_y, sum_xd)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = c_11 * c_dd - c_1d * c_1d
+            a = (c_y1 * c_dd - c_yd * c_1d) / det
+            b = (c_11 * c_yd - c_1d * c_y1) / det
+            rss = c_yy - a * c_y1 - b * c_yd
+        better = usable & np.isfinite(rss) & (rss < best_rss)
+        best_rss[better] = rss[better]
+        a_best[better] = a[better]
+        b_best[better] = b[better]
+        delay_best[better] = delay
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2_best = np.where(np.isfinite(best_rss), 1 - best_rss / c_yy, np.nan)
+    return a_best, b_best, delay_best, r2_best
+
+
+def open_loop_gain(a, b, period_samples):
+    """|b| / |1 - a e^(-i w)| at w = 2 pi / period: the chemoreflex gain after the carry-over term."""
+    omega = 2 * np.pi / np.asarray(period_samples, dtype=float)
+    return np.abs(b) / np.abs(1 - a * np.exp(-1j * omega))
+
+
+def estimate_loop_gain(recording, cycles=None):
+    """
+    Per-cycle and per-night loop gain for one Recording. Cycles default to the envelope detector's
+    cycle table. Fits where the feedback is not negative (b >= 0) or the carry-over is unstable
+    (|a| >= 1) describe no chemoreflex and get NaN loop gain.
+
+    Returns (table, summary): a LOOP_GAIN_DTYPE row per cycle and the medians over cycles inside PB
+    segments (over all cycles when there are none), or (table, None) when nothing could be fitted.
+    """
+    if cycles is None:
+        cycles = envelope_detector(recording).get('cycles')
+    table = np.zeros(0 if cycles is None else len(cycles), dtype=LOOP_GAIN_DTYPE)
+    if cycles is None or len(cycles) == 0:
+        return table, None
+
+    rate = VENTILATION_RATE_HZ
+    ventilation = ventilation_signal(recording.flow_data, recording.sampling_rate, rate)
+    scale = rate / recording.sampling_rate
+    starts = (cycles['start'] * scale).astype(np.int64)
+    ends = np.minimum((cycles['end'] * scale).astype(np.int64), len(ventilation))
+    delays = np.arange(int(DELAY_RANGE_SEC[0] * rate), int(DELAY_RANGE_SEC[1] * rate) + 1)
+    a, b, delay, r2 = fit_cycles(ventilation, starts, ends, delays)
+
+    physiological = (b < 0) & (np.abs(a) < 1)
+    table['start'] = cycles['start']
+    table['end'] = cycles['end']
+    table['delay_sec'] = delay / rate
+    table['a'] = a
+    table['b'] = b
+    table['r2'] = r2
+    table['loop_gain'] = np.where(physiological, open_loop_gain(a, b, np.maximum(ends - starts, 1)), np.nan)
+    table['loop_gain_1'] = np.where(physiological, open_loop_gain(a, b, LG1_PERIOD_SEC * rate), np.nan)
+
+    fitted = ~np.isnan(table['loop_gain'])
+    selected = fitted & cycles['in_segment'] if np.any(fitted & cycles['in_segment']) else fitted
+    if not np.any(selected):
+        return table, None
+    summary = {
+        'cycles_fitted': int(np.count_nonzero(fitted)),
+        'cycles_used': int(np.count_nonzero(selected)),
+        'pb_cycles_only': bool(np.any(fitted & cycles['in_segment'])),
+        'loop_gain': float(np.median(table['loop_gain'][selected])),
+        'loop_gain_1': float(np.median(table['loop_gain_1'][selected])),
+        'delay_sec': float(np.median(table['delay_sec'][selected])),
+        'r2': float(np.median(table['r2'][selected])),
+    }
+    return table, summary
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_edf(filepath)
+        if recording is None:
+            print(f"Failed to process {filename}.")
+        else:
+            table, summary = estimate_loop_gain(recording)
+            if summary is None:
+                print("No cycles could be fitted for loop gain.")
+            else:
+                scope = "PB cycles" if summary['pb_cycles_only'] else "all cycles (no PB segments)"
+                print(f"\n--- Loop Gain ({summary['cycles_used']} of {summary['cycles_fitted']} fitted cycles, {scope}) ---")
+                print(f"Loop gain at cycle period: {summary['loop_gain']:.2f}")
+                print(f"LG1 (1 cycle/min): {summary['loop_gain_1']:.2f}")
+                print(f"Chemoreflex delay: {summary['delay_sec']:.0f}s, median fit R^2 {summary['r2']:.2f}")
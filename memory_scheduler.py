@@ -0,0 +1,263 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import os
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, wait
+
+from analysis_service import analyze_night
+from chunked import DEFAULT_BLOCK_SEC
+from job_queue import _expand_paths
+from fft_engine import dominant_frequency
+from live_tail import EdfFollower
+from process_flow import read_edf_header, signal_scaling
+
+# Peak resident memory of analyze_night per flow sample, measured on 2-8 h nights at 25 Hz: the
+# per-record decode into a Python list, float64 flow, its absolute value, the envelope, the padded
+# FFT buffer, the negated copy for trough search and the masks all coexist at the peak.
+PIPELINE_BYTES_PER_SAMPLE = 80
+# Streaming decodes one block of records at a time, and the follower drops settled samples once
+# they fill half its buffers, so flow, validity and the envelope stay a few blocks long whatever
+# the night's length: measured at 14-15 MiB for 8-48 h nights at 25 Hz.
+STREAMING_BASE_BYTES = 16 * 2**20
+# What streaming still keeps for the whole night, per second of recording: the decimated flow and
+# its FFT buffers from the period pass, and the follower's extrema and cycle rows.
+STREAMING_BYTES_PER_SEC = 32
+# Resident size of an idle worker with numpy and scipy imported; paid once per pool process.
+WORKER_BASE_BYTES = 128 * 2**20
+# Rate of the decimated flow a streamed night's dominant period is estimated from.
+DECIMATED_RATE_HZ = 1.0
+# Share of physical memory used when no budget is given.
+DEFAULT_BUDGET_FRACTION = 0.75
+MODES = ('pipeline', 'streaming')
+
+
+def physical_memory_bytes():
+    """Total physical memory, or None where sysconf does not report it."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def flow_extent(path):
+    """
+    Flow samples and seconds of recording in an EDF from its header and file size alone; the record
+    count is taken from the size, so files still being written or truncated are sized by what is
+    actually on disk.
+    """
+    with open(path, 'rb') as f:
+        header = read_edf_header(f, path)
+        data_offset = f.tell()
+    signal_headers = header['signal_headers']
+    record_bytes = sum(max(h['num_samples_in_data_record'], 0) for h in signal_headers) * 2
+    if record_bytes == 0:
+        return 0, 0.0
+    n_records = max(os.path.getsize(path) - data_offset, 0) // record_bytes
+    return n_records * max(signal_headers[0]['num_samples_in_data_record'], 0), n_records * header['duration_data_record']
+
+
+def _block_records(header):
+    """Records per streaming block: one chunked.DEFAULT_BLOCK_SEC block."""
+    duration = header['duration_data_record']
+    return max(int(DEFAULT_BLOCK_SEC / duration), 1) if duration > 0 else 1
+
+
+def decimated_flow(path, rate=DECIMATED_RATE_HZ):
+    """
+    Flow averaged into bins of 1 / rate seconds, decoded one block of records at a time, with its
+    rate. Breathing and the 30-90 s PB band both sit well below the decimated Nyquist frequency,
+    so the dominant PB period of this signal matches that of full-rate flow.
+    """
+    with open(path, 'rb') as f:
+        header = read_edf_header(f, path)
+        signal_headers = header['signal_headers']
+        record_samples = sum(max(h['num_samples_in_data_record'], 0) for h in signal_headers)
+        flow_samples = signal_headers[0]['num_samples_in_data_record']
+        if record_samples == 0 or flow_samples <= 0 or header['duration_data_record'] <= 0:
+            raise ValueError(f"{os.path.basename(path)} has no flow samples.")
+        gain, offset = signal_scaling(signal_headers[0])
+        bins = max(int(round(header['duration_data_record'] * rate)), 1)
+        edges = (np.arange(bins) * flow_samples) // bins
+        block_records = _block_records(header)
+        blocks = []
+        while True:
+            raw = np.fromfile(f, dtype='<i2', count=block_records * record_samples)
+            records = raw[:len(raw) // record_samples * record_samples].reshape(-1, record_samples)
+            if len(records) == 0:
+                break
+            sums = np.add.reduceat(records[:, :flow_samples].astype(float), edges, axis=1)
+            blocks.append((sums / np.diff(np.append(edges, flow_samples))).ravel() * gain + offset)
+    return np.concatenate(blocks) if blocks else np.empty(0), bins / header['duration_data_record']
+
+
+def estimate_peak_bytes(path, mode='pipeline'):
+    """Estimated peak memory of one night above the worker's base footprint, or None if unreadable."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode '{mode}'; expected one of {MODES}.")
+    try:
+        n_samples, duration_sec = flow_extent(path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not size {os.path.basename(path)}: {e}")
+        return None
+    if mode == 'pipeline':
+        return n_samples * PIPELINE_BYTES_PER_SAMPLE
+    return STREAMING_BASE_BYTES + int(duration_sec * STREAMING_BYTES_PER_SEC)
+
+
+def stream_night(path, job_id, progress_queue, min_cycles=2, amplitude_threshold_percent=0.1,
+                 period_tolerance_percent=80):
+    """
+    Runs one night through the incremental live-tail detector, one block of records per poll, for
+    nights too long for the whole-night pipeline to fit the memory budget. The dominant period comes
+    from a first pass over decimated flow rather than the follower's first ten minutes, so it is
+    the whole night's, as in analyze_night. Returns the subset of analyze_night's result that the
+    live detector produces.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        with open(path, 'rb') as f:
+            block_records = _block_records(read_edf_header(f, path))
+        frequency = dominant_frequency(*decimated_flow(path))
+        if progress_queue is not None:
+            progress_queue.put((job_id, 'spectrum'))
+        if frequency is None:
+            return {'dominant_period_sec': None}
+        follower = EdfFollower(path, dominant_period_sec=1 / frequency, on_event=lambda event: None,
+                               min_cycles=min_cycles, amplitude_threshold_percent=amplitude_threshold_percent,
+                               period_tolerance_percent=period_tolerance_percent,
+                               max_records_per_poll=block_records)
+        while follower.poll() > 0:
+            if progress_queue is not None:
+                progress_queue.put((job_id, 'block'))
+        # The file is complete, so its end settles what the follower would otherwise wait on.
+        follower.finish()
+    if follower.sampling_rate is None or follower.n_samples == 0:
+        raise ValueError(f"Could not read {os.path.basename(path)}: no flow data")
+
+    return {
+        'duration_sec': follower.n_samples / follower.sampling_rate,
+        'sampling_rate': follower.sampling_rate,
+        'dominant_period_sec': follower.dominant_period_sec,
+        'periodic_percentage': float(follower.periodic_percentage),
+        'segments_sec': [[start_idx / follower.sampling_rate, end_idx / follower.sampling_rate]
+                         for start_idx, end_idx, cycles, closed in follower.segments],
+    }
+
+
+def plan_jobs(paths, budget_bytes):
+    """
+    Sizes every night and picks how it runs. Nights whose pipeline estimate exceeds the budget are
+    switched to streaming; a streaming night that still does not fit is kept and will run alone.
+    Returns job dicts ('path', 'mode', 'bytes') largest first, the order first-fit admission wants.
+    """
+    jobs = []
+    for path in paths:
+        peak = estimate_peak_bytes(path)
+        if peak is None:
+            # Unreadable headers fail quickly in the worker, which reports the real error.
+            jobs.append({'path': path, 'mode': 'pipeline', 'bytes': 0})
+            continue
+        mode = 'pipeline'
+        if peak > budget_bytes:
+            mode, peak = 'streaming', estimate_peak_bytes(path, 'streaming')
+            if peak > budget_bytes:
+                print(f"Warning: {os.path.basename(path)} needs about {peak / 2**20:.0f} MiB even when streamed; "
+                      f"it will run alone over the {budget_bytes / 2**20:.0f} MiB budget.")
+        jobs.append({'path': path, 'mode': mode, 'bytes': peak})
+    jobs.sort(key=lambda job: job['bytes'], reverse=True)
+    return jobs
+
+
+class MemoryBudgetScheduler:
+    """
+    Runs nights in a process pool while keeping the sum of their estimated peak memory under a
+    budget. Pending nights are admitted largest first whenever a worker is free, and any that fits
+    what is left of the budget is started, so short nights fill the room beside long ones. A night
+    larger than the remaining budget waits until the pool drains and then runs alone.
+    """
+
+    def __init__(self, budget_bytes=None, max_workers=None):
+        if budget_bytes is None:
+            total = physical_memory_bytes()
+            if total is None:
+                raise ValueError("Physical memory size is unavailable on this platform; give a budget explicitly.")
+            budget_bytes = int(total * DEFAULT_BUDGET_FRACTION)
+        max_workers = max_workers or os.cpu_count() or 1
+        # Every pool process costs its base footprint whether or not it is busy.
+        self.max_workers = max(min(max_workers, budget_bytes // (2 * WORKER_BASE_BYTES)), 1)
+        self.budget_bytes = budget_bytes
+        self.job_budget_bytes = max(budget_bytes - self.max_workers * WORKER_BASE_BYTES, 0)
+
+    def run(self, paths, task=analyze_night, streaming_task=stream_night):
+        """
+        Yields (path, mode, result, error) as nights finish; exactly one of result and error is None.
+        A worker that dies (killed for memory, or a crash in native code) breaks the whole pool: the
+        nights running in it are reported failed with the BrokenExecutor error and the rest run in a
+        new pool.
+        """
+        pending = plan_jobs(paths, self.job_budget_bytes)
+        in_flight = {}
+        used_bytes = 0
+        executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or in_flight:
+                for job in list(pending):
+                    if len(in_flight) >= self.max_workers:
+                        break
+                    if in_flight and used_bytes + job['bytes'] > self.job_budget_bytes:
+                        continue
+                    run_task = task if job['mode'] == 'pipeline' else streaming_task
+                    try:
+                        future = executor.submit(run_task, job['path'], os.path.basename(job['path']), None)
+                    except BrokenExecutor:
+                        # The nights in flight fail below; this one waits for the new pool.
+                        executor = self._replace_executor(executor)
+                        break
+                    in_flight[future] = (job, executor)
+                    used_bytes += job['bytes']
+                    pending.remove(job)
+                if not in_flight:
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, pool = in_flight.pop(future)
+                    used_bytes -= job['bytes']
+                    error = future.exception()
+                    if isinstance(error, BrokenExecutor) and pool is executor:
+                        executor = self._replace_executor(executor)
+                    yield job['path'], job['mode'], None if error else future.result(), error
+        finally:
+            executor.shutdown()
+
+    def _replace_executor(self, broken):
+        """Shuts down a broken pool and returns a fresh one."""
+        broken.shutdown(wait=False)
+        print("Warning: A worker process died; starting a new pool.")
+        return ProcessPoolExecutor(max_workers=self.max_workers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch PB analysis under a RAM budget.")
+    parser.add_argument('paths', nargs='+', help="EDF files or directories searched for *BRP.edf")
+    parser.add_argument('--budget-gb', type=float, default=None,
+                        help=f"RAM budget in GiB (default: {DEFAULT_BUDGET_FRACTION:.0%} of physical memory)")
+    parser.add_argument('--workers', type=int, default=None, help="Pool size (default: one per CPU)")
+    args = parser.parse_args()
+
+    paths = list(_expand_paths(args.paths))
+    if not paths:
+        print("No files found. Exiting script.")
+    else:
+        budget_bytes = int(args.budget_gb * 2**30) if args.budget_gb is not None else None
+        scheduler = MemoryBudgetScheduler(budget_bytes, args.workers)
+        print(f"Budget {scheduler.budget_bytes / 2**30:.1f} GiB across {scheduler.max_workers} workers, "
+              f"{len(paths)} nights.")
+        for path, mode, result, error in scheduler.run(paths):
+            filename = os.path.basename(path)
+            if error is not None:
+                print(f"{filename}: failed ({error})")
+            elif 'periodic_percentage' not in result:
+                print(f"{filename} [{mode}]: no PB analysis (dominant period {result['dominant_period_sec']})")
+            else:
+                print(f"{filename} [{mode}]: {result['periodic_percentage']:.2f}% periodic, "
+                      f"{len(result['segments_sec'])} segments")
@@ -5,6 +5,8 @@ from scipy.signal import butter, filtfilt, find_peaks
 import tkinter as tk
 from tkinter import filedialog
 
+from fft_engine import rfft_magnitudes
+
 # --- NEW FUNCTION TO PROMPT FOR FILE ---
 def prompt_for_file():
     """Opens a file dialog to select an EDF file."""
@@ -38,7 +40,7 @@ def inspect_and_repair_edf_header(filepath):
                 clean_signals[clean_name] = {
                     'ch_index': i,
                     'label': signal_labels[i],
-                    'sample_rate': int(sample_rates[i])
+                    'sample_rate': float(sample_rates[i])
                 }
                 break
     edf_file.close()
@@ -61,8 +63,7 @@ def find_pb_frequency(signal_data, sample_rate):
     if n_points == 0: return None
 
     print("\nRunning FFT to find dominant cycle frequency...")
-    yf = np.fft.rfft(signal_data)
-    xf = np.fft.rfftfreq(n_points, 1 / sample_rate)
+    xf, yf = rfft_magnitudes(signal_data, sample_rate)
 
     min_freq, max_freq = 1 / 90, 1 / 40
     idx_of_interest = np.where((xf >= min_freq) & (xf <= max_freq))
@@ -70,31 +71,27 @@ def find_pb_frequency(signal_data, sample_rate):
         print("No significant frequencies found in the periodic breathing range.")
         return None
 
-    peak_idx_in_slice = np.argmax(np.abs(yf[idx_of_interest]))
+    peak_idx_in_slice = np.argmax(yf[idx_of_interest])
     peak_idx_in_full = idx_of_interest[0][peak_idx_in_slice]
     dominant_freq = xf[peak_idx_in_full]
     print(f"--- 🚀 Dominant PB-range frequency found: {dominant_freq:.4f} Hz (~{1/dominant_freq:.1f}s period) ---")
     return dominant_freq
 
-def analyze_pb_events(signal_data, sample_rate, pb_freq):
-    """Filters signal around the PB freq and calculates final metrics."""
+def measure_pb_events(signal_data, sample_rate, pb_freq, height_threshold=1.0):
+    """Filters signal around the PB freq and returns (filtered_signal, peaks, metrics), or None if too few events."""
     if pb_freq is None:
-        return
+        return None
 
-    print("\nFiltering signal and analyzing PB events...")
     lowcut = pb_freq - 0.005
     highcut = pb_freq + 0.005
     b, a = butter(2, [lowcut, highcut], btype='band', fs=sample_rate)
     filtered_signal = filtfilt(b, a, signal_data)
 
-    height_threshold = 1.0
     distance_threshold = 30 * sample_rate 
     peaks, _ = find_peaks(filtered_signal, height=height_threshold, distance=distance_threshold)
     
     if len(peaks) < 3:
-        print("\nNot enough consecutive periodic breathing events found to analyze.")
-        print("Try lowering the 'height_threshold' in the script if you think this is wrong.")
-        return
+        return None
 
     periods = np.diff(peaks) / sample_rate
     avg_period = np.mean(periods)
@@ -110,11 +107,35 @@ def analyze_pb_events(signal_data, sample_rate, pb_freq):
     total_duration_seconds = len(signal_data) / sample_rate
     pb_percentage = (pb_duration_seconds / total_duration_seconds) * 100
 
+    metrics = {
+        'avg_period': avg_period,
+        'avg_depth': avg_depth,
+        'pb_percentage': pb_percentage,
+        'num_cycles': len(peaks),
+    }
+    return filtered_signal, peaks, metrics
+
+def analyze_pb_events(signal_data, sample_rate, pb_freq):
+    """Filters signal around the PB freq and calculates final metrics."""
+    if pb_freq is None:
+        return
+
+    print("\nFiltering signal and analyzing PB events...")
+    height_threshold = 1.0
+    measured = measure_pb_events(signal_data, sample_rate, pb_freq, height_threshold)
+    
+    if measured is None:
+        print("\nNot enough consecutive periodic breathing events found to analyze.")
+        print("Try lowering the 'height_threshold' in the script if you think this is wrong.")
+        return
+
+    filtered_signal, peaks, metrics = measured
+
     print("\n--- ✅ FINAL ANALYSIS COMPLETE ---")
-    print(f"  Average Period: {avg_period:.2f} s")
-    print(f"  Average Depth: {avg_depth:.2f} L/min")
-    print(f"  Time in PB: {pb_percentage:.2f}% of the night")
-    print(f"  Number of Cycles Detected: {len(peaks)}")
+    print(f"  Average Period: {metrics['avg_period']:.2f} s")
+    print(f"  Average Depth: {metrics['avg_depth']:.2f} L/min")
+    print(f"  Time in PB: {metrics['pb_percentage']:.2f}% of the night")
+    print(f"  Number of Cycles Detected: {metrics['num_cycles']}")
     print("---------------------------------")
 
     time_axis = np.arange(len(signal_data)) / sample_rate
@@ -4,9 +4,11 @@ from tkinter import Tk, filedialog
 import os
 import struct
 import re
-from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 
+from extrema import find_alternating_extrema, split_extrema
+from fft_engine import rfft_magnitudes
+
 def select_single_file():
     root = Tk()
     root.withdraw()
@@ -55,19 +57,31 @@ def read_edf(filepath):
                 print(f"Warning: Could not parse num_signals from general header. Assuming 1 for {os.path.basename(filepath)}")
                 num_signals = 1
 
+            # The signal header stores each field for every signal in turn (all labels, then all transducer
+            # types, ...), so slice field by field rather than signal by signal.
+            signal_header_bytes = f.read(256 * num_signals)
+            field_widths = (('label', 16), ('transducer_type', 80), ('physical_dimension', 8), ('physical_minimum', 8),
+                            ('physical_maximum', 8), ('digital_minimum', 8), ('digital_maximum', 8), ('prefiltering', 80),
+                            ('num_samples', 8), ('reserved', 32))
+            fields = {}
+            position = 0
+            for name, width in field_widths:
+                fields[name] = [signal_header_bytes[position + k * width:position + (k + 1) * width].decode('ascii').strip()
+                                for k in range(num_signals)]
+                position += width * num_signals
+
             signal_headers = []
             for i in range(num_signals):
-                signal_header_bytes = f.read(256)
-                label = signal_header_bytes[0:16].decode('ascii').strip()
-                transducer_type = signal_header_bytes[16:80].decode('ascii').strip()
-                physical_dimension = signal_header_bytes[80:88].decode('ascii').strip()
-                prefiltering = signal_header_bytes[120:168].decode('ascii').strip()
-                
-                raw_phys_min_str = signal_header_bytes[88:96].decode('ascii').strip()
-                raw_phys_max_str = signal_header_bytes[96:104].decode('ascii').strip()
-                raw_dig_min_str = signal_header_bytes[104:112].decode('ascii').strip()
-                raw_dig_max_str = signal_header_bytes[112:120].decode('ascii').strip()
-                raw_num_samples_str = signal_header_bytes[216:224].decode('ascii').strip()
+                label = fields['label'][i]
+                transducer_type = fields['transducer_type'][i]
+                physical_dimension = fields['physical_dimension'][i]
+                prefiltering = fields['prefiltering'][i]
+
+                raw_phys_min_str = fields['physical_minimum'][i]
+                raw_phys_max_str = fields['physical_maximum'][i]
+                raw_dig_min_str = fields['digital_minimum'][i]
+                raw_dig_max_str = fields['digital_maximum'][i]
+                raw_num_samples_str = fields['num_samples'][i]
                 print(f"DEBUG RAW SIGNAL {i} '{label}': phys_min='{raw_phys_min_str}', phys_max='{raw_phys_max_str}', dig_min='{raw_dig_min_str}', dig_max='{raw_dig_max_str}', num_samples='{raw_num_samples_str}'")
 
                 try:
@@ -116,6 +130,7 @@ def read_edf(filepath):
 
                 signal_headers.append({
                     'label': label,
+                    'physical_dimension': physical_dimension,
                     'physical_minimum': physical_minimum,
                     'physical_maximum': physical_maximum,
                     'digital_minimum': digital_minimum,
@@ -221,13 +236,11 @@ def run_fft_and_find_dominant_frequency(data, sampling_rate, min_period_sec=30,
         print("Data length too short for FFT.")
         return None, None
 
-    N = len(data)
-    yf = np.fft.fft(data)
-    xf = np.fft.fftfreq(N, 1 / sampling_rate)
+    xf, yf = rfft_magnitudes(data, sampling_rate)
 
     positive_freq_idx = np.where(xf > 0)
     xf_positive = xf[positive_freq_idx]
-    yf_positive = np.abs(yf[positive_freq_idx])
+    yf_positive = yf[positive_freq_idx]
 
     min_freq_hz = 1 / max_period_sec
     max_freq_hz = 1 / min_period_sec
@@ -277,11 +290,13 @@ def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
     if min_dist_peak_samples < 1:
         min_dist_peak_samples = 1
 
-    # ADJUSTED: Prominence for peak finding reduced to 0.01 (was 0.05)
+    # Prominence in L/s of envelope (flow is in physical units). Steady breathing's 30 s envelope
+    # wanders by a few mL/s and PB cycles swing by 0.1-0.3 L/s; results on PB nights are unchanged
+    # anywhere from 0.005 to 0.02, so 0.01 sits in the middle of that plateau.
     peak_prominence_val = 0.01
 
-    peaks, _ = find_peaks(smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
-    troughs, _ = find_peaks(-smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
+    extrema, first_is_peak = find_alternating_extrema(smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
+    peaks, troughs = split_extrema(extrema, first_is_peak)
 
     print(f"DEBUG: Peak finding distance threshold: {min_dist_peak_samples} samples ({min_dist_peak_samples/sampling_rate:.2f}s)")
     print(f"DEBUG: Peak finding prominence threshold: {peak_prominence_val:.2f}")
@@ -291,25 +306,12 @@ def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
         print("Not enough peaks or troughs detected for robust depth/period calculation. Returning defaults.")
         return 0, dominant_period_sec, smoothed_abs_flow, peaks, troughs
 
-    matched_depths = []
-    for p_idx in peaks:
-        t_after_indices = troughs[troughs > p_idx]
-        if len(t_after_indices) > 0:
-            potential_trough_idx = t_after_indices[0] 
-            if (potential_trough_idx - p_idx) / sampling_rate < (dominant_period_sec * 1.5):
-                depth = smoothed_abs_flow[p_idx] - smoothed_abs_flow[potential_trough_idx]
-                if depth > 0:
-                    matched_depths.append(depth)
-        
-        t_before_indices = troughs[troughs < p_idx]
-        if len(t_before_indices) > 0:
-            potential_trough_idx = t_before_indices[-1]
-            if (p_idx - potential_trough_idx) / sampling_rate < (dominant_period_sec * 1.5):
-                depth = smoothed_abs_flow[p_idx] - smoothed_abs_flow[potential_trough_idx]
-                if depth > 0:
-                    matched_depths.append(depth)
-
-    if not matched_depths:
+    # Extrema strictly alternate, so each peak's nearest troughs are simply its neighbours in the sequence.
+    extrema_gaps_sec = np.diff(extrema) / sampling_rate
+    extrema_depths = np.abs(np.diff(smoothed_abs_flow[extrema]))
+    matched_depths = extrema_depths[(extrema_gaps_sec < dominant_period_sec * 1.5) & (extrema_depths > 0)]
+
+    if len(matched_depths) == 0:
         print("No valid peak-trough depths could be matched based on proximity. Calculating depth as (max_smoothed - min_smoothed).")
         if len(smoothed_abs_flow) > 0:
             average_depth = np.max(smoothed_abs_flow) - np.min(smoothed_abs_flow)
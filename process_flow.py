@@ -4,9 +4,14 @@ from tkinter import Tk, filedialog
 import os
 import struct
 import re
-from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 
+from extrema import find_alternating_extrema, split_extrema
+from valid_regions import detect_valid_regions
+from chunked import chunk_layout, chunked_alternating_extrema
+from cycle_table import build_cycle_table, FAIL_PERIOD, FAIL_AMPLITUDE, NO_TROUGH, INVALID_REGION
+from fft_engine import rfft_magnitudes
+
 def select_single_file():
     root = Tk()
     root.withdraw()
@@ -14,131 +19,216 @@ def select_single_file():
     root.destroy()
     return filepath
 
-def read_edf(filepath):
+def read_edf_header(f, filepath):
+    """Parses the general and per-signal EDF headers from an open file positioned at byte 0."""
+    header = f.read(256)
+    
+    version = header[0:8].decode('ascii').strip()
+    patient_id = header[8:88].decode('ascii').strip()
+    record_id = header[88:168].decode('ascii').strip()
+    start_date = header[168:176].decode('ascii').strip()
+    start_time = header[176:184].decode('ascii').strip()
+    num_bytes_in_header = int(header[184:192].decode('ascii').strip())
+    
+    raw_num_data_records_str = header[236:244].decode('ascii').strip()
+    raw_duration_data_record_str = header[244:252].decode('ascii').strip()
+    raw_num_signals_str = header[252:256].decode('ascii').strip()
+    print(f"DEBUG RAW GENERAL HEADER: num_data_records='{raw_num_data_records_str}', duration_data_record='{raw_duration_data_record_str}', num_signals='{raw_num_signals_str}'")
+
+    try:
+        num_data_records = int(raw_num_data_records_str)
+    except ValueError:
+        print(f"Warning: Could not parse num_data_records from general header. Assuming 1 for {os.path.basename(filepath)}")
+        num_data_records = 1
+    
+    try:
+        duration_data_record = float(raw_duration_data_record_str)
+        if duration_data_record <= 0:
+            print(f"Warning: Invalid duration_data_record ({duration_data_record}) found. Setting to 1.0 for {os.path.basename(filepath)}")
+            duration_data_record = 1.0
+    except ValueError:
+        print(f"Warning: Could not parse duration_data_record from general header. Assuming 1.0 for {os.path.basename(filepath)}")
+        duration_data_record = 1.0
+    
+    try:
+        num_signals = int(raw_num_signals_str)
+    except ValueError:
+        print(f"Warning: Could not parse num_signals from general header. Assuming 1 for {os.path.basename(filepath)}")
+        num_signals = 1
+
+    # The signal header stores each field for every signal in turn (all labels, then all transducer
+    # types, ...), so slice field by field rather than signal by signal.
+    signal_header_bytes = f.read(256 * num_signals)
+    field_widths = (('label', 16), ('transducer_type', 80), ('physical_dimension', 8), ('physical_minimum', 8),
+                    ('physical_maximum', 8), ('digital_minimum', 8), ('digital_maximum', 8), ('prefiltering', 80),
+                    ('num_samples', 8), ('reserved', 32))
+    fields = {}
+    position = 0
+    for name, width in field_widths:
+        fields[name] = [signal_header_bytes[position + k * width:position + (k + 1) * width].decode('ascii').strip()
+                        for k in range(num_signals)]
+        position += width * num_signals
+
+    signal_headers = []
+    for i in range(num_signals):
+        label = fields['label'][i]
+        transducer_type = fields['transducer_type'][i]
+        physical_dimension = fields['physical_dimension'][i]
+        prefiltering = fields['prefiltering'][i]
+
+        raw_phys_min_str = fields['physical_minimum'][i]
+        raw_phys_max_str = fields['physical_maximum'][i]
+        raw_dig_min_str = fields['digital_minimum'][i]
+        raw_dig_max_str = fields['digital_maximum'][i]
+        raw_num_samples_str = fields['num_samples'][i]
+        print(f"DEBUG RAW SIGNAL {i} '{label}': phys_min='{raw_phys_min_str}', phys_max='{raw_phys_max_str}', dig_min='{raw_dig_min_str}', dig_max='{raw_dig_max_str}', num_samples='{raw_num_samples_str}'")
+
+        try:
+            physical_minimum = float(raw_phys_min_str)
+        except ValueError:
+            print(f"Warning: Could not parse physical_minimum for signal '{label}'. Setting to 0.0.")
+            physical_minimum = 0.0
+        
+        try:
+            physical_maximum = float(raw_phys_max_str)
+        except ValueError:
+            print(f"Warning: Could not parse physical_maximum for signal '{label}'. Setting to 1.0.")
+            physical_maximum = 1.0
+
+        try:
+            digital_minimum = int(raw_dig_min_str)
+        except ValueError:
+            print(f"Warning: Could not parse digital_minimum for signal '{label}'. Setting to 0.")
+            digital_minimum = 0
+
+        try:
+            digital_maximum = int(raw_dig_max_str)
+        except ValueError:
+            print(f"Warning: Could not parse digital_maximum for signal '{label}'. Setting to 1000.")
+            digital_maximum = 1000
+        
+        try:
+            num_samples_in_data_record = int(raw_num_samples_str)
+            if num_samples_in_data_record <= 0:
+                 print(f"Warning: num_samples_in_data_record for signal '{label}' is zero or negative ({num_samples_in_data_record}).")
+                 if label == 'Flow.40ms':
+                     num_samples_in_data_record = 1500
+                     print(f"Specific default for 'Flow.40ms' applied: {num_samples_in_data_record}.")
+                 else:
+                     num_samples_in_data_record = 50
+                     print(f"General default applied: {num_samples_in_data_record}.")
+        except ValueError:
+            print(f"Warning: Could not parse num_samples_in_data_record for signal '{label}'.")
+            if label == 'Flow.40ms':
+                num_samples_in_data_record = 1500
+                print(f"Specific default for 'Flow.40ms' applied: {num_samples_in_data_record}.")
+            else:
+                num_samples_in_data_record = 50
+                print(f"General default applied: {num_samples_in_data_record}.")
+
+
+        signal_headers.append({
+            'label': label,
+            'physical_dimension': physical_dimension,
+            'physical_minimum': physical_minimum,
+            'physical_maximum': physical_maximum,
+            'digital_minimum': digital_minimum,
+            'digital_maximum': digital_maximum,
+            'num_samples_in_data_record': num_samples_in_data_record
+        })
+
+    if not signal_headers:
+        raise ValueError("No signal headers found in EDF file.")
+    
+    if num_signals == 0:
+        raise ValueError("Number of signals parsed as zero. Cannot proceed.")
+
+    return {
+        'start_date': start_date,
+        'start_time': start_time,
+        'num_bytes_in_header': num_bytes_in_header,
+        'num_data_records': num_data_records,
+        'duration_data_record': duration_data_record,
+        'num_signals': num_signals,
+        'signal_headers': signal_headers,
+    }
+
+def signal_scaling(signal_info):
+    """(gain, offset) mapping a signal's digital values to physical units."""
+    gain = (signal_info['physical_maximum'] - signal_info['physical_minimum']) / \
+           (signal_info['digital_maximum'] - signal_info['digital_minimum'])
+    offset = signal_info['physical_minimum'] - gain * signal_info['digital_minimum']
+    return gain, offset
+
+def signal_limits(signal_info):
+    """(low, high) physical values of a signal's digital minimum and maximum, where its samples clip."""
+    gain, offset = signal_scaling(signal_info)
+    return tuple(sorted(signal_info[key] * gain + offset for key in ('digital_minimum', 'digital_maximum')))
+
+def find_signal_index(edf_header, label):
+    """Index of the first signal whose label contains label (case-insensitive), or None."""
+    for i, signal_info in enumerate(edf_header['signal_headers']):
+        if label.lower() in signal_info['label'].lower():
+            return i
+    return None
+
+def read_edf_signal(filepath, signal=0):
+    """
+    Raw digital samples of one signal, chosen by index or by label (see find_signal_index), decoded
+    from all complete data records at once. Returns (digital int16 array, signal_info, edf_header),
+    or (None, None, None) if the file or signal cannot be read.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            edf_header = read_edf_header(f, filepath)
+            raw = f.read()
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        print(f"Critical error reading EDF file {filepath}: {e}")
+        return None, None, None
+
+    signal_headers = edf_header['signal_headers']
+    signal_index = find_signal_index(edf_header, signal) if isinstance(signal, str) else signal
+    if signal_index is None or not 0 <= signal_index < len(signal_headers):
+        print(f"Error: Signal {signal!r} not found in {os.path.basename(filepath)}. Labels: {[h['label'] for h in signal_headers]}")
+        return None, None, None
+
+    samples_per_record = [max(h['num_samples_in_data_record'], 0) for h in signal_headers]
+    record_samples = sum(samples_per_record)
+    n_records = len(raw) // (2 * record_samples)
+    if 0 <= edf_header['num_data_records'] < n_records:
+        n_records = edf_header['num_data_records']
+    elif n_records < edf_header['num_data_records']:
+        print(f"Warning: Header lists {edf_header['num_data_records']} records but only {n_records} are complete in {os.path.basename(filepath)}.")
+
+    records = np.frombuffer(raw, dtype='<i2', count=n_records * record_samples).reshape(n_records, record_samples)
+    first = sum(samples_per_record[:signal_index])
+    digital = records[:, first:first + samples_per_record[signal_index]].ravel()
+    return digital, signal_headers[signal_index], edf_header
+
+def read_edf(filepath, return_limits=False):
+    """
+    Flow (physical units) and its sampling rate from the first signal, or (None, None). With
+    return_limits, also the flow's clip limits (see signal_limits) for valid_regions.
+    """
     flow_data = None
     sampling_rate = None
 
     try:
         with open(filepath, 'rb') as f:
-            header = f.read(256)
-            
-            version = header[0:8].decode('ascii').strip()
-            patient_id = header[8:88].decode('ascii').strip()
-            record_id = header[88:168].decode('ascii').strip()
-            start_date = header[168:176].decode('ascii').strip()
-            start_time = header[176:184].decode('ascii').strip()
-            num_bytes_in_header = int(header[184:192].decode('ascii').strip())
-            
-            raw_num_data_records_str = header[236:244].decode('ascii').strip()
-            raw_duration_data_record_str = header[244:252].decode('ascii').strip()
-            raw_num_signals_str = header[252:256].decode('ascii').strip()
-            print(f"DEBUG RAW GENERAL HEADER: num_data_records='{raw_num_data_records_str}', duration_data_record='{raw_duration_data_record_str}', num_signals='{raw_num_signals_str}'")
-
-            try:
-                num_data_records = int(raw_num_data_records_str)
-            except ValueError:
-                print(f"Warning: Could not parse num_data_records from general header. Assuming 1 for {os.path.basename(filepath)}")
-                num_data_records = 1
-            
-            try:
-                duration_data_record = float(raw_duration_data_record_str)
-                if duration_data_record <= 0:
-                    print(f"Warning: Invalid duration_data_record ({duration_data_record}) found. Setting to 1.0 for {os.path.basename(filepath)}")
-                    duration_data_record = 1.0
-            except ValueError:
-                print(f"Warning: Could not parse duration_data_record from general header. Assuming 1.0 for {os.path.basename(filepath)}")
-                duration_data_record = 1.0
-            
-            try:
-                num_signals = int(raw_num_signals_str)
-            except ValueError:
-                print(f"Warning: Could not parse num_signals from general header. Assuming 1 for {os.path.basename(filepath)}")
-                num_signals = 1
-
-            signal_headers = []
-            for i in range(num_signals):
-                signal_header_bytes = f.read(256)
-                label = signal_header_bytes[0:16].decode('ascii').strip()
-                transducer_type = signal_header_bytes[16:80].decode('ascii').strip()
-                physical_dimension = signal_header_bytes[80:88].decode('ascii').strip()
-                prefiltering = signal_header_bytes[120:168].decode('ascii').strip()
-                
-                raw_phys_min_str = signal_header_bytes[88:96].decode('ascii').strip()
-                raw_phys_max_str = signal_header_bytes[96:104].decode('ascii').strip()
-                raw_dig_min_str = signal_header_bytes[104:112].decode('ascii').strip()
-                raw_dig_max_str = signal_header_bytes[112:120].decode('ascii').strip()
-                raw_num_samples_str = signal_header_bytes[216:224].decode('ascii').strip()
-                print(f"DEBUG RAW SIGNAL {i} '{label}': phys_min='{raw_phys_min_str}', phys_max='{raw_phys_max_str}', dig_min='{raw_dig_min_str}', dig_max='{raw_dig_max_str}', num_samples='{raw_num_samples_str}'")
-
-                try:
-                    physical_minimum = float(raw_phys_min_str)
-                except ValueError:
-                    print(f"Warning: Could not parse physical_minimum for signal '{label}'. Setting to 0.0.")
-                    physical_minimum = 0.0
-                
-                try:
-                    physical_maximum = float(raw_phys_max_str)
-                except ValueError:
-                    print(f"Warning: Could not parse physical_maximum for signal '{label}'. Setting to 1.0.")
-                    physical_maximum = 1.0
-
-                try:
-                    digital_minimum = int(raw_dig_min_str)
-                except ValueError:
-                    print(f"Warning: Could not parse digital_minimum for signal '{label}'. Setting to 0.")
-                    digital_minimum = 0
-
-                try:
-                    digital_maximum = int(raw_dig_max_str)
-                except ValueError:
-                    print(f"Warning: Could not parse digital_maximum for signal '{label}'. Setting to 1000.")
-                    digital_maximum = 1000
-                
-                try:
-                    num_samples_in_data_record = int(raw_num_samples_str)
-                    if num_samples_in_data_record <= 0:
-                         print(f"Warning: num_samples_in_data_record for signal '{label}' is zero or negative ({num_samples_in_data_record}).")
-                         if label == 'Flow.40ms':
-                             num_samples_in_data_record = 1500
-                             print(f"Specific default for 'Flow.40ms' applied: {num_samples_in_data_record}.")
-                         else:
-                             num_samples_in_data_record = 50
-                             print(f"General default applied: {num_samples_in_data_record}.")
-                except ValueError:
-                    print(f"Warning: Could not parse num_samples_in_data_record for signal '{label}'.")
-                    if label == 'Flow.40ms':
-                        num_samples_in_data_record = 1500
-                        print(f"Specific default for 'Flow.40ms' applied: {num_samples_in_data_record}.")
-                    else:
-                        num_samples_in_data_record = 50
-                        print(f"General default applied: {num_samples_in_data_record}.")
-
-
-                signal_headers.append({
-                    'label': label,
-                    'physical_minimum': physical_minimum,
-                    'physical_maximum': physical_maximum,
-                    'digital_minimum': digital_minimum,
-                    'digital_maximum': digital_maximum,
-                    'num_samples_in_data_record': num_samples_in_data_record
-                })
-
-            if not signal_headers:
-                raise ValueError("No signal headers found in EDF file.")
-            
-            if num_signals == 0:
-                raise ValueError("Number of signals parsed as zero. Cannot proceed.")
+            edf_header = read_edf_header(f, filepath)
+            num_data_records = edf_header['num_data_records']
+            duration_data_record = edf_header['duration_data_record']
+            num_signals = edf_header['num_signals']
+            signal_headers = edf_header['signal_headers']
 
             flow_signal_info = signal_headers[0]
             num_samples_for_flow = flow_signal_info['num_samples_in_data_record']
 
             if flow_signal_info['digital_maximum'] == flow_signal_info['digital_minimum']:
                 print(f"Error: Digital min and max are equal for signal '{flow_signal_info['label']}'. Cannot calculate gain.")
-                return None, None
+                return (None, None, None) if return_limits else (None, None)
 
-            gain = (flow_signal_info['physical_maximum'] - flow_signal_info['physical_minimum']) / \
-                   (flow_signal_info['digital_maximum'] - flow_signal_info['digital_minimum'])
-            offset = flow_signal_info['physical_minimum'] - gain * flow_signal_info['digital_minimum']
+            gain, offset = signal_scaling(flow_signal_info)
             
             data_raw_digital = []
             for record_idx in range(num_data_records):
@@ -170,7 +260,7 @@ def read_edf(filepath):
 
             if len(data_raw_digital) == 0:
                 print("Error: No flow data accumulated. Check EDF structure or flow signal index/parameters.")
-                return None, None
+                return (None, None, None) if return_limits else (None, None)
 
             flow_data = np.array(data_raw_digital) * gain + offset
             
@@ -189,11 +279,13 @@ def read_edf(filepath):
                 print("Warning: Insufficient header info or data to reliably determine sampling rate. Setting to default 25 Hz.")
                 sampling_rate = 25.0
 
+            if return_limits:
+                return flow_data, sampling_rate, signal_limits(flow_signal_info)
             return flow_data, sampling_rate
 
     except Exception as e:
         print(f"Critical error reading EDF file {filepath}: {e}")
-        return None, None
+        return (None, None, None) if return_limits else (None, None)
 
 def derive_minute_ventilation(flow_data, sampling_rate):
     if flow_data is None or sampling_rate is None or sampling_rate <= 0:
@@ -221,13 +313,11 @@ def run_fft_and_find_dominant_frequency(data, sampling_rate, min_period_sec=30,
         print("Data length too short for FFT.")
         return None, None
 
-    N = len(data)
-    yf = np.fft.fft(data)
-    xf = np.fft.fftfreq(N, 1 / sampling_rate)
+    xf, yf = rfft_magnitudes(data, sampling_rate)
 
     positive_freq_idx = np.where(xf > 0)
     xf_positive = xf[positive_freq_idx]
-    yf_positive = np.abs(yf[positive_freq_idx])
+    yf_positive = yf[positive_freq_idx]
 
     min_freq_hz = 1 / max_period_sec
     max_freq_hz = 1 / min_period_sec
@@ -255,7 +345,10 @@ def run_fft_and_find_dominant_frequency(data, sampling_rate, min_period_sec=30,
 
     return dominant_frequency_hz, dominant_period_sec
 
-def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
+def smooth_abs_flow(abs_flow, window_size_samples):
+    return pd.Series(abs_flow).rolling(window=window_size_samples, center=True, min_periods=1).mean().values
+
+def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow=None, max_workers=None):
     if dominant_period_sec is None or dominant_period_sec <= 0 or sampling_rate <= 0:
         print("Cannot calculate wave metrics without valid period or sampling rate.")
         return None, None, None, None, None
@@ -268,20 +361,28 @@ def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
     if window_size_samples > len(flow_data):
         window_size_samples = len(flow_data)
 
-    print(f"DEBUG: Smoothing window for ventilation envelope: {smoothing_window_sec:.2f} seconds ({window_size_samples} samples)")
+    # With max_workers > 1 the extremum candidates are searched block by block in a thread pool.
+    chunked = max_workers is not None and max_workers > 1
 
-    smoothed_abs_flow = pd.Series(np.abs(flow_data)).rolling(window=window_size_samples, center=True, min_periods=1).mean().values
+    if smoothed_abs_flow is None:
+        print(f"DEBUG: Smoothing window for ventilation envelope: {smoothing_window_sec:.2f} seconds ({window_size_samples} samples)")
+        smoothed_abs_flow = smooth_abs_flow(np.abs(flow_data), window_size_samples)
 
     # ADJUSTED: Min distance for find_peaks reduced to 5 seconds.
     min_dist_peak_samples = int(5 * sampling_rate) # Minimum 5 seconds between peaks
     if min_dist_peak_samples < 1:
         min_dist_peak_samples = 1
 
-    # ADJUSTED: Prominence for peak finding reduced to 0.01 (was 0.05)
+    # Prominence in L/s of envelope (flow is in physical units). Steady breathing's 30 s envelope
+    # wanders by a few mL/s and PB cycles swing by 0.1-0.3 L/s; results on PB nights are unchanged
+    # anywhere from 0.005 to 0.02, so 0.01 sits in the middle of that plateau.
     peak_prominence_val = 0.01
 
-    peaks, _ = find_peaks(smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
-    troughs, _ = find_peaks(-smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
+    if chunked:
+        extrema, first_is_peak = chunked_alternating_extrema(smoothed_abs_flow, peak_prominence_val, min_dist_peak_samples, chunk_layout(sampling_rate), max_workers)
+    else:
+        extrema, first_is_peak = find_alternating_extrema(smoothed_abs_flow, distance=min_dist_peak_samples, prominence=peak_prominence_val)
+    peaks, troughs = split_extrema(extrema, first_is_peak)
 
     print(f"DEBUG: Peak finding distance threshold: {min_dist_peak_samples} samples ({min_dist_peak_samples/sampling_rate:.2f}s)")
     print(f"DEBUG: Peak finding prominence threshold: {peak_prominence_val:.2f}")
@@ -291,25 +392,12 @@ def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
         print("Not enough peaks or troughs detected for robust depth/period calculation. Returning defaults.")
         return 0, dominant_period_sec, smoothed_abs_flow, peaks, troughs
 
-    matched_depths = []
-    for p_idx in peaks:
-        t_after_indices = troughs[troughs > p_idx]
-        if len(t_after_indices) > 0:
-            potential_trough_idx = t_after_indices[0] 
-            if (potential_trough_idx - p_idx) / sampling_rate < (dominant_period_sec * 1.5):
-                depth = smoothed_abs_flow[p_idx] - smoothed_abs_flow[potential_trough_idx]
-                if depth > 0:
-                    matched_depths.append(depth)
-        
-        t_before_indices = troughs[troughs < p_idx]
-        if len(t_before_indices) > 0:
-            potential_trough_idx = t_before_indices[-1]
-            if (p_idx - potential_trough_idx) / sampling_rate < (dominant_period_sec * 1.5):
-                depth = smoothed_abs_flow[p_idx] - smoothed_abs_flow[potential_trough_idx]
-                if depth > 0:
-                    matched_depths.append(depth)
-
-    if not matched_depths:
+    # Extrema strictly alternate, so each peak's nearest troughs are simply its neighbours in the sequence.
+    extrema_gaps_sec = np.diff(extrema) / sampling_rate
+    extrema_depths = np.abs(np.diff(smoothed_abs_flow[extrema]))
+    matched_depths = extrema_depths[(extrema_gaps_sec < dominant_period_sec * 1.5) & (extrema_depths > 0)]
+
+    if len(matched_depths) == 0:
         print("No valid peak-trough depths could be matched based on proximity. Calculating depth as (max_smoothed - min_smoothed).")
         if len(smoothed_abs_flow) > 0:
             average_depth = np.max(smoothed_abs_flow) - np.min(smoothed_abs_flow)
@@ -337,74 +425,35 @@ def calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec):
 
     return average_depth, average_wave_period_sec, smoothed_abs_flow, peaks, troughs
 
-def find_periodic_segments(flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs, min_cycles=2, amplitude_threshold_percent=20, period_tolerance_percent=30):
+def find_periodic_segments(flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs, min_cycles=2, amplitude_threshold_percent=20, period_tolerance_percent=30, valid_mask=None, return_cycles=False):
     if dominant_period_sec is None or dominant_period_sec <= 0 or dominant_period_sec == np.inf or \
        smoothed_abs_flow is None or len(smoothed_abs_flow) == 0:
         print("Cannot find periodic segments without valid data, period, or smoothed flow.")
+        if return_cycles:
+            return 0, 0, [], build_cycle_table(np.empty(0), [], [], sampling_rate, 0, 0, 0)[0]
         return 0, 0, []
 
     total_duration_sec = len(flow_data) / sampling_rate
     
-    mean_smoothed_flow = np.mean(smoothed_abs_flow)
+    # Invalid (non-breathing) samples leave the denominator, and any cycle touching them fails.
+    if valid_mask is not None:
+        total_duration_sec = np.count_nonzero(valid_mask) / sampling_rate
+    
+    mean_smoothed_flow = np.mean(smoothed_abs_flow) if valid_mask is None else np.mean(smoothed_abs_flow[valid_mask])
     min_amplitude_for_periodicity = mean_smoothed_flow * (amplitude_threshold_percent / 100.0)
 
     period_lower_bound = dominant_period_sec * (1 - period_tolerance_percent / 100.0)
     period_upper_bound = dominant_period_sec * (1 + period_tolerance_percent / 100.0)
 
-    periodic_segments_indices = []
-    
-    current_segment_start_idx = None
-    consecutive_valid_cycles_count = 0
-    
-    peaks = np.sort(peaks)
-    troughs = np.sort(troughs)
-
     print(f"Periodic amplitude threshold (absolute): {min_amplitude_for_periodicity:.2f} (from {amplitude_threshold_percent}% of mean smoothed flow: {mean_smoothed_flow:.2f})")
     print(f"Expected cycle period range: {period_lower_bound:.2f}s to {period_upper_bound:.2f}s (Dominant: {dominant_period_sec:.2f}s, Tolerance: {period_tolerance_percent}%)")
     print(f"Minimum consecutive cycles for tagging: {min_cycles}")
 
-    passed_period_check_count = 0
-    passed_amplitude_check_count = 0
-    passed_both_count = 0
-    
-    debug_cycle_periods = []
-
-    for i in range(len(peaks) - 1):
-        peak_start_idx = peaks[i]
-        peak_end_idx = peaks[i+1]
-
-        current_cycle_period_sec = (peak_end_idx - peak_start_idx) / sampling_rate
-        debug_cycle_periods.append(current_cycle_period_sec) 
-
-        is_period_valid = (period_lower_bound <= current_cycle_period_sec <= period_upper_bound)
-        if is_period_valid:
-            passed_period_check_count += 1
-
-        troughs_in_cycle_indices = troughs[(troughs > peak_start_idx) & (troughs < peak_end_idx)]
-        
-        is_amplitude_valid = False
-        current_cycle_amplitude = 0 
-        if len(troughs_in_cycle_indices) > 0:
-            peak_val = smoothed_abs_flow[peak_start_idx]
-            trough_val = np.min(smoothed_abs_flow[troughs_in_cycle_indices])
-            current_cycle_amplitude = peak_val - trough_val
-            is_amplitude_valid = (current_cycle_amplitude >= min_amplitude_for_periodicity)
-        if is_amplitude_valid:
-            passed_amplitude_check_count += 1
-        
-        if is_period_valid and is_amplitude_valid:
-            passed_both_count += 1
-            consecutive_valid_cycles_count += 1
-            if current_segment_start_idx is None:
-                current_segment_start_idx = peak_start_idx
-        else:
-            if consecutive_valid_cycles_count >= min_cycles:
-                periodic_segments_indices.append((current_segment_start_idx, peaks[i]))
-            consecutive_valid_cycles_count = 0
-            current_segment_start_idx = None
-    
-    if current_segment_start_idx is not None and consecutive_valid_cycles_count >= min_cycles:
-        periodic_segments_indices.append((current_segment_start_idx, peaks[-1]))
+    cycles, periodic_segments_indices = build_cycle_table(
+        smoothed_abs_flow, peaks, troughs, sampling_rate, min_amplitude_for_periodicity,
+        period_lower_bound, period_upper_bound, min_cycles=min_cycles, valid_mask=valid_mask
+    )
+    flags = cycles['flags']
 
     total_periodic_time_sec = 0
     for start_idx, end_idx in periodic_segments_indices:
@@ -416,13 +465,17 @@ def find_periodic_segments(flow_data, sampling_rate, dominant_period_sec, smooth
         periodic_percentage = 0
 
     print(f"DEBUG Summary:")
-    print(f"  Cycles analyzed: {len(peaks) - 1 if len(peaks) > 0 else 0}") # Handle empty peaks list
-    print(f"  Cycles passing period check: {passed_period_check_count}")
-    print(f"  Cycles passing amplitude check: {passed_amplitude_check_count}")
-    print(f"  Cycles passing BOTH checks: {passed_both_count}")
-    print(f"  First 10 calculated cycle periods (sec): {[f'{p:.2f}' for p in debug_cycle_periods[:10]]}") # Format for readability
+    print(f"  Cycles analyzed: {len(cycles)}")
+    print(f"  Cycles passing period check: {np.count_nonzero((flags & FAIL_PERIOD) == 0)}")
+    print(f"  Cycles passing amplitude check: {np.count_nonzero((flags & (FAIL_AMPLITUDE | NO_TROUGH)) == 0)}")
+    if valid_mask is not None:
+        print(f"  Cycles overlapping invalid regions: {np.count_nonzero(flags & INVALID_REGION)}")
+    print(f"  Cycles passing BOTH checks: {np.count_nonzero(flags == 0)}")
+    print(f"  First 10 calculated cycle periods (sec): {[f'{p:.2f}' for p in cycles['period'][:10]]}") # Format for readability
 
 
+    if return_cycles:
+        return total_periodic_time_sec, periodic_percentage, periodic_segments_indices, cycles
     return total_periodic_time_sec, periodic_percentage, periodic_segments_indices
 
 def plot_periodic_segments(flow_data, sampling_rate, smoothed_abs_flow, peaks, troughs, periodic_segments_indices, filename):
@@ -473,7 +526,7 @@ if __name__ == "__main__":
             print(f"Warning: The selected file '{filename}' does not match the expected naming convention (YYYYMMDD_HHMMSS_BRP.edf).")
             print("While processing may proceed, results might be unexpected if it's not a BRP flow file.")
 
-        flow_data, sampling_rate = read_edf(filepath)
+        flow_data, sampling_rate, clip_limits = read_edf(filepath, return_limits=True)
 
         if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
             print(f"\n--- Post-read Data Summary ---")
@@ -489,15 +542,22 @@ if __name__ == "__main__":
             else:
                 print("Could not derive Minute Ventilation.")
 
+            print("\n--- Valid Breathing Regions ---")
+            valid_mask, valid_intervals, invalid_reasons = detect_valid_regions(flow_data, sampling_rate, clip_limits)
+            # Zero the non-breathing stretches so they add nothing to the spectrum or the envelope.
+            analysis_flow = np.where(valid_mask, flow_data, 0.0)
+
             print("\n--- Starting FFT and Periodicity Analysis ---")
             dominant_freq_hz, dominant_period_sec = run_fft_and_find_dominant_frequency(
-                flow_data, sampling_rate, min_period_sec=30, max_period_sec=90
+                analysis_flow, sampling_rate, min_period_sec=30, max_period_sec=90
             )
 
             if dominant_period_sec is not None and dominant_period_sec != np.inf:
                 print(f"Dominant Frequency: {dominant_freq_hz:.4f} Hz (Period: {dominant_period_sec:.2f} seconds)")
                 
-                average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = calculate_wave_metrics(flow_data, sampling_rate, dominant_period_sec)
+                average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = calculate_wave_metrics(
+                    analysis_flow, sampling_rate, dominant_period_sec, max_workers=os.cpu_count()
+                )
                 
                 if average_depth is not None and average_wave_period is not None:
                     print(f"\n--- Wave Metrics (Depth & Average Period) ---")
@@ -509,10 +569,11 @@ if __name__ == "__main__":
                         flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs,
                         min_cycles=2,              
                         amplitude_threshold_percent=0.1, 
-                        period_tolerance_percent=80 
+                        period_tolerance_percent=80,
+                        valid_mask=valid_mask
                     )
                     print(f"Total time tagged as periodic: {total_periodic_time:.2f} seconds")
-                    print(f"Percentage of recording periodic: {periodic_percentage:.2f}%")
+                    print(f"Percentage of valid breathing time periodic: {periodic_percentage:.2f}%")
                     print(f"Found {len(periodic_segments_indices)} periodic segments.")
 
                     plot_periodic_segments(flow_data, sampling_rate, smoothed_abs_flow, peaks, troughs, periodic_segments_indices, filename)
@@ -0,0 +1,290 @@
+import numpy as np
+from functools import cached_property
+import os
+
+from process_flow import (
+    select_single_file,
+    read_edf,
+    signal_limits,
+    smooth_abs_flow,
+    calculate_wave_metrics,
+    find_periodic_segments,
+)
+from hilbert_cycles import analytic_ventilation_signal, cycles_from_phase
+from valid_regions import detect_valid_regions
+from lod_pyramid import build_pyramid
+from fft_engine import rfft_magnitudes
+from signal_archive import SignalArchive, ARCHIVE_SUFFIX
+
+SMOOTHING_WINDOW_SEC = 30
+MINUTE_VENT_RATE_HZ = 1.0
+MINUTE_VENT_WINDOW_SEC = 60
+BREATH_VENT_WINDOW_SEC = 10
+
+
+class Recording:
+    """
+    One decoded night. Derived series are computed the first time a detector asks for them and
+    then kept, so running several detectors on the same night costs one decode and one of each
+    intermediate.
+    """
+
+    def __init__(self, flow_data, sampling_rate, filepath=None, exclude_mask=None, clip_limits=None):
+        self.flow_data = flow_data
+        self.sampling_rate = sampling_rate
+        self.filepath = filepath
+        # Physical (low, high) the flow clips at, from the EDF header; None skips the clipping check.
+        self.clip_limits = clip_limits
+        # Extra samples to treat as invalid (e.g. high leak from another channel), True = exclude.
+        self.exclude_mask = exclude_mask
+        self._dominant_periods = {}
+
+    @classmethod
+    def from_edf(cls, filepath, exclude_mask=None):
+        flow_data, sampling_rate, clip_limits = read_edf(filepath, return_limits=True)
+        if flow_data is None or sampling_rate is None or sampling_rate <= 0:
+            return None
+        return cls(flow_data, sampling_rate, filepath, exclude_mask, clip_limits)
+
+    @classmethod
+    def from_archive(cls, filepath, exclude_mask=None):
+        """
+        Reads flow from a signal archive (see signal_archive) chunk by chunk into one preallocated
+        array, so the night is never held twice and no EDF is decoded.
+        """
+        try:
+            archive = SignalArchive(filepath)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Could not read archive {os.path.basename(filepath)}: {e}")
+            return None
+        if archive.n_samples == 0 or archive.sampling_rate <= 0:
+            print(f"Error: Archive {os.path.basename(filepath)} holds no samples.")
+            return None
+        flow_data = np.empty(archive.n_samples)
+        for start, samples in archive.iter_chunks():
+            flow_data[start:start + len(samples)] = samples
+        return cls(flow_data, archive.sampling_rate, filepath, exclude_mask, signal_limits(archive.signal_info))
+
+    @classmethod
+    def from_file(cls, filepath, exclude_mask=None):
+        """from_archive for .wfa files, from_edf for anything else."""
+        if filepath.lower().endswith(ARCHIVE_SUFFIX):
+            return cls.from_archive(filepath, exclude_mask)
+        return cls.from_edf(filepath, exclude_mask)
+
+    @property
+    def duration_sec(self):
+        return len(self.flow_data) / self.sampling_rate
+
+    @cached_property
+    def analysis_flow(self):
+        """Flow with the invalid stretches (see valid_mask) zeroed, as process_flow analyses it."""
+        return np.where(self.valid_mask, self.flow_data, 0.0)
+
+    @cached_property
+    def abs_flow(self):
+        """Absolute value of analysis_flow, so invalid stretches add nothing to the envelope."""
+        return np.abs(self.analysis_flow)
+
+    @cached_property
+    def envelope(self):
+        """30 s centred rolling mean of absolute flow, as used by calculate_wave_metrics."""
+        window_size_samples = int(SMOOTHING_WINDOW_SEC * self.sampling_rate)
+        window_size_samples = min(max(window_size_samples, 1), len(self.flow_data))
+        return smooth_abs_flow(self.abs_flow, window_size_samples)
+
+    def _binned_ventilation(self, window_sec):
+        """Ventilation (L/min) from |flow| in MINUTE_VENT_RATE_HZ bins, smoothed over window_sec."""
+        samples_per_bin = max(int(round(self.sampling_rate / MINUTE_VENT_RATE_HZ)), 1)
+        n_bins = len(self.flow_data) // samples_per_bin
+        if n_bins == 0:
+            return np.empty(0)
+        # Unmasked, like the device's own 'Minute Vent.' channel the band-pass detector stands in for.
+        # Half of |flow| is inspiratory on average, so 60 * mean(|flow|) / 2 is L/min for flow in L/s.
+        abs_flow = np.abs(self.flow_data[:n_bins * samples_per_bin])
+        binned = abs_flow.reshape(n_bins, samples_per_bin).mean(axis=1)
+        window_bins = max(int(window_sec * MINUTE_VENT_RATE_HZ), 1)
+        return smooth_abs_flow(binned, min(window_bins, n_bins)) * 30.0
+
+    @cached_property
+    def minute_vent(self):
+        """Minute ventilation (L/min) derived from flow, decimated to MINUTE_VENT_RATE_HZ."""
+        return self._binned_ventilation(MINUTE_VENT_WINDOW_SEC)
+
+    @cached_property
+    def breath_vent(self):
+        """
+        Ventilation on the same grid as minute_vent but averaged over BREATH_VENT_WINDOW_SEC (a
+        couple of breaths), so it keeps the shape and timing of each PB cycle for lag estimates.
+        """
+        return self._binned_ventilation(BREATH_VENT_WINDOW_SEC)
+
+    @cached_property
+    def valid_mask(self):
+        """False over mask-off, flatline, clipped and implausible stretches (see valid_regions) and exclude_mask."""
+        valid_mask, intervals, reasons = detect_valid_regions(self.flow_data, self.sampling_rate, self.clip_limits)
+        if self.exclude_mask is not None:
+            valid_mask = valid_mask & ~self.exclude_mask
+        return valid_mask
+
+    @cached_property
+    def spectrum(self):
+        """(freqs, magnitudes) of the real FFT of analysis_flow (padded to a fast length)."""
+        return rfft_magnitudes(self.analysis_flow, self.sampling_rate)
+
+    @cached_property
+    def analytic(self):
+        """(band_signal, amplitude, phase) of the ventilation signal in the 30-90 s band."""
+        return analytic_ventilation_signal(self.analysis_flow, self.sampling_rate)
+
+    @cached_property
+    def pyramid(self):
+        """Min/max/mean level-of-detail pyramid of the flow signal for zoomable plots."""
+        return build_pyramid(self.flow_data, self.sampling_rate)
+
+    def dominant_period(self, min_period_sec=30, max_period_sec=90):
+        """Dominant period (s) within the range, read off the cached spectrum."""
+        key = (min_period_sec, max_period_sec)
+        if key not in self._dominant_periods:
+            freqs, magnitudes = self.spectrum
+            in_range = np.flatnonzero((freqs > 0) & (freqs >= 1 / max_period_sec) & (freqs <= 1 / min_period_sec))
+            if len(in_range) == 0:
+                self._dominant_periods[key] = None
+            else:
+                dominant_frequency_hz = freqs[in_range[np.argmax(magnitudes[in_range])]]
+                self._dominant_periods[key] = 1 / dominant_frequency_hz
+        return self._dominant_periods[key]
+
+
+DETECTORS = {}
+
+
+def register_detector(name):
+    """Decorator adding a detector to DETECTORS. A detector takes a Recording and returns a dict."""
+    def decorator(func):
+        DETECTORS[name] = func
+        return func
+    return decorator
+
+
+@register_detector('spectral')
+def spectral_detector(recording):
+    dominant_period_sec = recording.dominant_period()
+    return {'dominant_period_sec': dominant_period_sec}
+
+
+@register_detector('envelope')
+def envelope_detector(recording, min_cycles=2, amplitude_threshold_percent=0.1, period_tolerance_percent=80):
+    dominant_period_sec = recording.dominant_period()
+    if dominant_period_sec is None:
+        return {'dominant_period_sec': None}
+
+    average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = calculate_wave_metrics(
+        recording.analysis_flow, recording.sampling_rate, dominant_period_sec, smoothed_abs_flow=recording.envelope
+    )
+    if average_depth is None:
+        return {'dominant_period_sec': dominant_period_sec}
+
+    total_periodic_time, periodic_percentage, periodic_segments_indices, cycles = find_periodic_segments(
+        recording.flow_data, recording.sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs,
+        min_cycles=min_cycles,
+        amplitude_threshold_percent=amplitude_threshold_percent,
+        period_tolerance_percent=period_tolerance_percent,
+        valid_mask=recording.valid_mask,
+        return_cycles=True
+    )
+    return {
+        'dominant_period_sec': dominant_period_sec,
+        'average_depth': average_depth,
+        'average_period_sec': average_wave_period,
+        'periodic_percentage': periodic_percentage,
+        'segments': periodic_segments_indices,
+        'cycles': cycles,
+    }
+
+
+@register_detector('bandpass')
+def bandpass_detector(recording):
+    # pb_analyzer pulls in pyedflib at import time, so only load it when this detector runs.
+    try:
+        from pb_analyzer import find_pb_frequency, measure_pb_events
+    except ImportError as e:
+        print(f"Warning: Band-pass detector unavailable ({e}).")
+        return {'dominant_period_sec': None}
+
+    minute_vent = recording.minute_vent
+    pb_freq = find_pb_frequency(minute_vent, MINUTE_VENT_RATE_HZ)
+    if pb_freq is None:
+        return {'dominant_period_sec': None}
+
+    measured = measure_pb_events(minute_vent, MINUTE_VENT_RATE_HZ, pb_freq)
+    if measured is None:
+        return {'dominant_period_sec': 1 / pb_freq}
+
+    # The band-pass metrics span the first to last filtered peak rather than finding separate PB
+    # segments, so this detector reports no 'segments'.
+    filtered_signal, peaks, metrics = measured
+    return {
+        'dominant_period_sec': 1 / pb_freq,
+        'average_depth': metrics['avg_depth'],
+        'average_period_sec': metrics['avg_period'],
+        'periodic_percentage': metrics['pb_percentage'],
+    }
+
+
+@register_detector('hilbert')
+def hilbert_detector(recording, min_period_sec=30, max_period_sec=90):
+    band_signal, amplitude, phase = recording.analytic
+    if band_signal is None:
+        return {'dominant_period_sec': recording.dominant_period()}
+
+    cycle_table = cycles_from_phase(band_signal, amplitude, phase, recording.sampling_rate)
+    periods = cycle_table['period']
+    in_range = (periods >= min_period_sec) & (periods <= max_period_sec)
+    if not np.any(in_range):
+        return {'dominant_period_sec': recording.dominant_period(), 'cycles': cycle_table}
+
+    return {
+        'dominant_period_sec': recording.dominant_period(),
+        'average_depth': np.mean(cycle_table['depth'][in_range]),
+        'average_period_sec': np.mean(periods[in_range]),
+        'cycles': cycle_table,
+    }
+
+
+def run_detectors(recording, names=None):
+    """Runs the named detectors (all registered ones by default) on one Recording."""
+    if names is None:
+        names = list(DETECTORS)
+    results = {}
+    for name in names:
+        if name not in DETECTORS:
+            print(f"Warning: Unknown detector '{name}'. Registered detectors: {', '.join(DETECTORS)}")
+            continue
+        results[name] = DETECTORS[name](recording)
+    return results
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_file(filepath)
+        if recording is None:
+            print(f"Failed to process {filename}.")
+        else:
+            results = run_detectors(recording)
+            print("\n--- Detector Comparison ---")
+            for name, result in results.items():
+                period = result.get('dominant_period_sec')
+                depth = result.get('average_depth')
+                percentage = result.get('periodic_percentage')
+                print(f"{name:>10}: "
+                      f"period={'n/a' if period is None else f'{period:.2f}s'}, "
+                      f"depth={'n/a' if depth is None else f'{depth:.2f}'}, "
+                      f"periodic={'n/a' if percentage is None else f'{percentage:.2f}%'}")
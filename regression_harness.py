@@ -0,0 +1,588 @@
+import numpy as np
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import time
+
+import pb_analyzer2
+import process_flow
+from analysis_service import file_sha256
+from job_queue import _expand_paths
+from valid_regions import detect_valid_regions
+
+try:
+    import pb_analyzer
+except ImportError:
+    # pb_analyzer reads through pyedflib; without it that pipeline is skipped.
+    pb_analyzer = None
+
+BASELINE_FORMAT = 1
+DEFAULT_REPEAT = 3
+# (relative, absolute) tolerance per scalar output; a value passes when
+# |new - baseline| <= abs + rel * |baseline|.
+DEFAULT_TOLERANCES = {
+    'dominant_period_sec': (1e-6, 1e-6),
+    'average_depth': (1e-6, 1e-9),
+    'average_period_sec': (1e-6, 1e-6),
+    'periodic_percentage': (0, 0.01),
+}
+# Segment boundaries may move by this much before a segment counts as changed.
+SEGMENT_TOLERANCE_SEC = 1.0
+OUTPUT_FIELDS = ('dominant_period_sec', 'average_depth', 'average_period_sec', 'periodic_percentage', 'segments_sec')
+
+# Synthetic nights: (name, hours, [(start_h, end_h, PB period s)], [(start_h, end_h) of flat flow]).
+SYNTHETIC_NIGHTS = (
+    ('20240101_220000', 2.0, [], []),
+    ('20240102_220000', 2.0, [(0.0, 2.0, 60)], []),
+    ('20240103_220000', 3.0, [(1.0, 2.0, 75)], [(0.5, 0.6)]),
+    ('20240104_220000', 4.0, [(2.0, 4.0, 45)], []),
+)
+SYNTHETIC_FLOW_RATE_HZ = 25
+SYNTHETIC_MINUTE_VENT_RATE_HZ = 0.5
+SYNTHETIC_RECORD_SEC = 60
+# Ground truth on the synthetic nights: periods may be off by this share of the true PB period,
+# segments may miss or add this much PB time, and the periodic share may be off by this many points.
+GROUND_TRUTH_PERIOD_TOLERANCE = 0.1
+GROUND_TRUTH_SPAN_TOLERANCE_SEC = 120
+GROUND_TRUTH_PERCENT_TOLERANCE = 5
+# Ground-truth checks each pipeline is known to fail on a synthetic night; they are reported but
+# do not fail a run. The flow-spectrum periods miss because an amplitude-modulated breath puts its
+# power at the breathing rate plus and minus the PB rate, leaving the 30-90 s band to noise and to
+# the flat stretch; pb_analyzer's single segment runs from its first to its last filtered peak,
+# which on 20240103 stretches well past the PB hour.
+KNOWN_GROUND_TRUTH_MISSES = {
+    ('20240102_220000', 'process_flow'): ('dominant_period_sec',),
+    ('20240102_220000', 'process_flow_chunked'): ('dominant_period_sec',),
+    ('20240102_220000', 'pb_analyzer2'): ('dominant_period_sec',),
+    ('20240103_220000', 'process_flow'): ('dominant_period_sec', 'average_period_sec'),
+    ('20240103_220000', 'process_flow_chunked'): ('dominant_period_sec', 'average_period_sec'),
+    ('20240103_220000', 'pb_analyzer'): ('average_period_sec', 'segments_outside', 'periodic_percentage'),
+    ('20240104_220000', 'process_flow'): ('dominant_period_sec',),
+    ('20240104_220000', 'process_flow_chunked'): ('dominant_period_sec',),
+    ('20240104_220000', 'pb_analyzer2'): ('dominant_period_sec',),
+}
+# The chunked wave-metrics path runs on this many threads; its outputs must equal process_flow's.
+CHUNKED_MAX_WORKERS = 2
+EQUIVALENT_PIPELINES = (('process_flow', 'process_flow_chunked'),)
+
+
+class StageTimer:
+    """Wall time of consecutive pipeline stages: each lap() closes the stage that was running."""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = now - self._last
+        self._last = now
+
+
+def _segments_sec(segments, sampling_rate):
+    return [[float(start_idx / sampling_rate), float(end_idx / sampling_rate)] for start_idx, end_idx in segments]
+
+
+def run_process_flow(path, timer, max_workers=None):
+    """process_flow's __main__ pipeline: valid regions, spectrum, wave metrics, PB segments."""
+    flow_data, sampling_rate, clip_limits = process_flow.read_edf(path, return_limits=True)
+    timer.lap('read')
+    if flow_data is None or sampling_rate is None or sampling_rate <= 0:
+        raise ValueError("unreadable")
+    valid_mask, valid_intervals, invalid_reasons = detect_valid_regions(flow_data, sampling_rate, clip_limits)
+    analysis_flow = np.where(valid_mask, flow_data, 0.0)
+    timer.lap('valid_regions')
+    dominant_freq_hz, dominant_period_sec = process_flow.run_fft_and_find_dominant_frequency(
+        analysis_flow, sampling_rate, min_period_sec=30, max_period_sec=90
+    )
+    timer.lap('spectrum')
+    outputs = {'dominant_period_sec': dominant_period_sec}
+    if dominant_period_sec is None or dominant_period_sec == np.inf:
+        return outputs
+
+    average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = process_flow.calculate_wave_metrics(
+        analysis_flow, sampling_rate, dominant_period_sec, max_workers=max_workers
+    )
+    timer.lap('wave_metrics')
+    outputs.update(average_depth=average_depth, average_period_sec=average_wave_period)
+    if average_depth is None or average_wave_period is None:
+        return outputs
+
+    total_periodic_time, periodic_percentage, segments = process_flow.find_periodic_segments(
+        flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs,
+        min_cycles=2, amplitude_threshold_percent=0.1, period_tolerance_percent=80, valid_mask=valid_mask
+    )
+    timer.lap('segments')
+    outputs.update(periodic_percentage=periodic_percentage, segments_sec=_segments_sec(segments, sampling_rate))
+    return outputs
+
+
+def run_process_flow_chunked(path, timer):
+    """run_process_flow with the extrema of each block found on CHUNKED_MAX_WORKERS threads."""
+    return run_process_flow(path, timer, max_workers=CHUNKED_MAX_WORKERS)
+
+
+def run_pb_analyzer2(path, timer):
+    """pb_analyzer2's __main__ pipeline: the same stages on raw flow, without valid regions."""
+    flow_data, sampling_rate = pb_analyzer2.read_edf(path)
+    timer.lap('read')
+    if flow_data is None or sampling_rate is None or sampling_rate <= 0:
+        raise ValueError("unreadable")
+    dominant_freq_hz, dominant_period_sec = pb_analyzer2.run_fft_and_find_dominant_frequency(
+        flow_data, sampling_rate, min_period_sec=30, max_period_sec=90
+    )
+    timer.lap('spectrum')
+    outputs = {'dominant_period_sec': dominant_period_sec}
+    if dominant_period_sec is None or dominant_period_sec == np.inf:
+        return outputs
+
+    average_depth, average_wave_period, smoothed_abs_flow, peaks, troughs = pb_analyzer2.calculate_wave_metrics(
+        flow_data, sampling_rate, dominant_period_sec
+    )
+    timer.lap('wave_metrics')
+    outputs.update(average_depth=average_depth, average_period_sec=average_wave_period)
+    if average_depth is None or average_wave_period is None:
+        return outputs
+
+    total_periodic_time, periodic_percentage, segments = pb_analyzer2.find_periodic_segments(
+        flow_data, sampling_rate, dominant_period_sec, smoothed_abs_flow, peaks, troughs,
+        min_cycles=2, amplitude_threshold_percent=0.1, period_tolerance_percent=80
+    )
+    timer.lap('segments')
+    outputs.update(periodic_percentage=periodic_percentage, segments_sec=_segments_sec(segments, sampling_rate))
+    return outputs
+
+
+def run_pb_analyzer(path, timer):
+    """
+    pb_analyzer's pipeline on the session's minute ventilation, read from the PLD file next to the
+    BRP. Its single segment is the span from the first to the last filtered PB peak.
+    """
+    pld_path = os.path.join(os.path.dirname(path), os.path.basename(path).rsplit('_', 1)[0] + '_PLD.edf')
+    if not os.path.exists(pld_path):
+        raise ValueError("no PLD file with minute ventilation")
+    clean_header_map = pb_analyzer.inspect_and_repair_edf_header(pld_path)
+    if not clean_header_map:
+        raise ValueError("no minute ventilation channel")
+    mv_info = clean_header_map['minute_vent']
+    minute_vent = pb_analyzer.read_target_signal(pld_path, mv_info)
+    timer.lap('read')
+    pb_freq = pb_analyzer.find_pb_frequency(minute_vent, mv_info['sample_rate'])
+    timer.lap('spectrum')
+    outputs = {'dominant_period_sec': None if pb_freq is None else 1 / pb_freq}
+    measured = pb_analyzer.measure_pb_events(minute_vent, mv_info['sample_rate'], pb_freq)
+    timer.lap('events')
+    if measured is None:
+        return outputs
+    filtered_signal, peaks, metrics = measured
+    outputs.update(average_depth=metrics['avg_depth'], average_period_sec=metrics['avg_period'],
+                   periodic_percentage=metrics['pb_percentage'],
+                   segments_sec=_segments_sec([(peaks[0], peaks[-1])], mv_info['sample_rate']))
+    return outputs
+
+
+PIPELINES = {
+    'process_flow': run_process_flow,
+    'process_flow_chunked': run_process_flow_chunked,
+    'pb_analyzer2': run_pb_analyzer2,
+    'pb_analyzer': run_pb_analyzer,
+}
+
+
+def available_pipelines():
+    return [name for name in PIPELINES if name != 'pb_analyzer' or pb_analyzer is not None]
+
+
+def _json_safe(outputs):
+    safe = {}
+    for field in OUTPUT_FIELDS:
+        value = outputs.get(field)
+        if field == 'segments_sec' or value is None:
+            safe[field] = value
+        else:
+            value = float(value)
+            safe[field] = value if np.isfinite(value) else None
+    return safe
+
+
+def run_pipeline(name, path, repeat=DEFAULT_REPEAT):
+    """
+    Runs one pipeline over one night `repeat` times with its prints silenced. Returns a dict with the
+    first run's outputs, the fastest time seen for each stage, and the error text if it raised.
+    Differing outputs between repeats are reported as an error, since a baseline would be meaningless.
+    """
+    record = {'outputs': None, 'timings': {}, 'error': None}
+    for attempt in range(max(repeat, 1)):
+        timer = StageTimer()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                outputs = _json_safe(PIPELINES[name](path, timer))
+        except Exception as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            return record
+        if record['outputs'] is None:
+            record['outputs'] = outputs
+        elif outputs != record['outputs']:
+            record['error'] = "outputs differ between repeated runs"
+        for stage, seconds in timer.timings.items():
+            record['timings'][stage] = min(seconds, record['timings'].get(stage, np.inf))
+    return record
+
+
+def run_corpus(paths, pipelines=None, repeat=DEFAULT_REPEAT):
+    """Runs every pipeline over every night. Returns {sha256: {'file', 'pipelines': {name: record}}}."""
+    pipelines = pipelines or available_pipelines()
+    nights = {}
+    for path in paths:
+        night = {'file': os.path.basename(path), 'pipelines': {}}
+        for name in pipelines:
+            night['pipelines'][name] = run_pipeline(name, path, repeat)
+        nights[file_sha256(path)] = night
+    return nights
+
+
+def _close(value, reference, rel, abs_):
+    return abs(value - reference) <= abs_ + rel * abs(reference)
+
+
+def compare_outputs(baseline, current, tolerances=DEFAULT_TOLERANCES, segment_tolerance_sec=SEGMENT_TOLERANCE_SEC):
+    """Differences between two output dicts beyond tolerance, as readable strings; empty when they agree."""
+    differences = []
+    for field in OUTPUT_FIELDS:
+        old, new = baseline.get(field), current.get(field)
+        if old is None or new is None:
+            if old is not None or new is not None:
+                differences.append(f"{field}: {old} -> {new}")
+        elif field == 'segments_sec':
+            if len(old) != len(new):
+                differences.append(f"segments: {len(old)} -> {len(new)}")
+                continue
+            moved = np.abs(np.asarray(new, dtype=float) - np.asarray(old, dtype=float)).reshape(-1, 2).max(axis=1)
+            for i in np.flatnonzero(moved > segment_tolerance_sec):
+                differences.append(f"segment {i}: {old[i][0]:.1f}-{old[i][1]:.1f}s -> {new[i][0]:.1f}-{new[i][1]:.1f}s")
+        else:
+            rel, abs_ = tolerances.get(field, (0, 0))
+            if not _close(new, old, rel, abs_):
+                differences.append(f"{field}: {old:.6g} -> {new:.6g}")
+    return differences
+
+
+def synthetic_night(filename):
+    """The SYNTHETIC_NIGHTS entry a BRP file was written from, or None for any other night."""
+    for night in SYNTHETIC_NIGHTS:
+        if filename == f"{night[0]}_BRP.edf":
+            return night
+    return None
+
+
+def _overlap_sec(spans, others):
+    return sum(max(min(end, other_end) - max(start, other_start), 0)
+               for start, end in spans for other_start, other_end in others)
+
+
+def check_ground_truth(filename, outputs):
+    """
+    Where a synthetic night's outputs contradict the PB it was written with, as (check, readable
+    string) pairs; empty when they agree or the night is not synthetic. Both the spectral and the cycle period
+    must match a night with a single PB period, and the segments and periodic share must match its
+    PB spans, out of the time that is not flat.
+    """
+    night = synthetic_night(filename)
+    if night is None:
+        return []
+    stem, hours, pb_spans, flat_spans = night
+    misses = []
+    periods = {period for start_h, end_h, period in pb_spans}
+    if len(periods) == 1:
+        period = periods.pop()
+        for field in ('dominant_period_sec', 'average_period_sec'):
+            value = outputs.get(field)
+            if value is None or abs(value - period) > GROUND_TRUTH_PERIOD_TOLERANCE * period:
+                misses.append((field, f"{field} {'-' if value is None else f'{value:.4g}'}, true PB period {period}s"))
+
+    truth = [(start_h * 3600, end_h * 3600) for start_h, end_h, period in pb_spans]
+    segments = outputs.get('segments_sec') or []
+    pb_sec = sum(end - start for start, end in truth)
+    overlap = _overlap_sec(truth, segments)
+    if pb_sec - overlap > GROUND_TRUTH_SPAN_TOLERANCE_SEC:
+        misses.append(('segments_missed', f"segments miss {pb_sec - overlap:.0f}s of true PB"))
+    outside = sum(end - start for start, end in segments) - overlap
+    if outside > GROUND_TRUTH_SPAN_TOLERANCE_SEC:
+        misses.append(('segments_outside', f"segments claim {outside:.0f}s outside true PB"))
+
+    percentage = outputs.get('periodic_percentage')
+    expected = pb_sec / (hours * 3600 - sum((end_h - start_h) * 3600 for start_h, end_h in flat_spans)) * 100
+    if percentage is None:
+        if pb_spans:
+            misses.append(('periodic_percentage', f"periodic_percentage -, true {expected:.1f}%"))
+    elif abs(percentage - expected) > GROUND_TRUTH_PERCENT_TOLERANCE:
+        misses.append(('periodic_percentage', f"periodic_percentage {percentage:.1f}%, true {expected:.1f}%"))
+    return misses
+
+
+def _split_known(filename, name, misses, previous_checks=()):
+    """Splits ground-truth misses into (new, known): known ones are listed in KNOWN_GROUND_TRUTH_MISSES or in previous_checks."""
+    known_checks = set(KNOWN_GROUND_TRUTH_MISSES.get((filename.rsplit('_', 1)[0], name), ())) | set(previous_checks)
+    new = [text for check, text in misses if check not in known_checks]
+    known = [text for check, text in misses if check in known_checks]
+    return new, known
+
+
+def ground_truth_lines(nights):
+    """
+    Ground-truth misses of every pipeline on the synthetic nights. Returns (report lines, number of
+    failures); misses listed in KNOWN_GROUND_TRUTH_MISSES are reported without failing.
+    """
+    lines, failures = [], 0
+    for night in nights.values():
+        for name, record in night['pipelines'].items():
+            if record['error'] or synthetic_night(night['file']) is None:
+                continue
+            new, known = _split_known(night['file'], name, check_ground_truth(night['file'], record['outputs']))
+            if new:
+                failures += 1
+                lines.append(f"{night['file']} [{name}]: FAIL ground truth: {'; '.join(new)}")
+            if known:
+                lines.append(f"{night['file']} [{name}]: known ground-truth miss: {'; '.join(known)}")
+    return lines, failures
+
+
+def equivalence_lines(nights):
+    """
+    Where pipelines in EQUIVALENT_PIPELINES disagree on a night beyond tolerance. Returns (report
+    lines, number of failures).
+    """
+    lines, failures = [], 0
+    for night in nights.values():
+        for reference, other in EQUIVALENT_PIPELINES:
+            records = night['pipelines'].get(reference), night['pipelines'].get(other)
+            if None in records or records[0]['error'] or records[1]['error']:
+                continue
+            differences = compare_outputs(records[0]['outputs'], records[1]['outputs'])
+            if differences:
+                failures += 1
+                lines.append(f"{night['file']} [{other}]: FAIL differs from {reference}: {'; '.join(differences)}")
+    return lines, failures
+
+
+def compare_runs(baseline_nights, current_nights, max_slowdown=None):
+    """
+    Compares a run against a baseline. Returns (report lines, number of failures). Result
+    differences and errors that were not in the baseline fail, as do ground-truth misses on
+    synthetic nights that the baseline did not have and KNOWN_GROUND_TRUTH_MISSES does not list;
+    so do pipelines slower than max_slowdown times their baseline total, when one is given.
+    Known ground-truth misses and timings are otherwise reported only.
+    """
+    lines, known_lines, failures = [], [], 0
+    totals = {}
+    for sha, night in current_nights.items():
+        reference = baseline_nights.get(sha)
+        if reference is None:
+            lines.append(f"{night['file']}: not in baseline")
+            continue
+        for name, record in night['pipelines'].items():
+            old = reference['pipelines'].get(name)
+            if old is None:
+                lines.append(f"{night['file']} [{name}]: not in baseline")
+                continue
+            if record['error'] or old['error']:
+                if record['error'] != old['error']:
+                    failures += 1
+                    lines.append(f"{night['file']} [{name}]: FAIL error {old['error']!r} -> {record['error']!r}")
+                continue
+            differences = compare_outputs(old['outputs'], record['outputs'])
+            previous_checks = [check for check, text in check_ground_truth(night['file'], old['outputs'])]
+            new, known = _split_known(night['file'], name, check_ground_truth(night['file'], record['outputs']),
+                                      previous_checks)
+            differences += [f"ground truth: {miss}" for miss in new]
+            if known:
+                known_lines.append(f"{night['file']} [{name}]: {'; '.join(known)}")
+            old_total, new_total = sum(old['timings'].values()), sum(record['timings'].values())
+            totals.setdefault(name, [0.0, 0.0])
+            totals[name][0] += old_total
+            totals[name][1] += new_total
+            speedup = old_total / new_total if new_total > 0 else np.inf
+            status = 'ok'
+            if differences:
+                status = 'FAIL ' + '; '.join(differences)
+            elif max_slowdown is not None and new_total > old_total * max_slowdown:
+                status = f"FAIL slower than {max_slowdown:.2f}x baseline"
+            if status != 'ok':
+                failures += 1
+            stages = ', '.join(
+                f"{stage} {old['timings'][stage] / seconds:.2f}x" if stage in old['timings'] and seconds > 0 else stage
+                for stage, seconds in record['timings'].items()
+            )
+            lines.append(f"{night['file']} [{name}]: {status} ({old_total:.3f}s -> {new_total:.3f}s, "
+                         f"{speedup:.2f}x; {stages})")
+    missing = [night['file'] for sha, night in baseline_nights.items() if sha not in current_nights]
+    if missing:
+        lines.append(f"Baseline nights not in this run: {', '.join(missing)}")
+    for name, (old_total, new_total) in totals.items():
+        if new_total > 0:
+            lines.append(f"Total [{name}]: {old_total:.3f}s -> {new_total:.3f}s ({old_total / new_total:.2f}x)")
+    if known_lines:
+        lines.append("Known ground-truth misses (also in the baseline or expected):")
+        lines += [f"  {line}" for line in known_lines]
+    return lines, failures
+
+
+def cross_pipeline_lines(nights):
+    """One line per night and pipeline, side by side, to show where the pipelines disagree."""
+    lines = []
+    for night in nights.values():
+        lines.append(night['file'])
+        for name, record in night['pipelines'].items():
+            if record['error']:
+                lines.append(f"  {name:13s} error: {record['error']}")
+                continue
+            outputs = record['outputs']
+            values = '  '.join(
+                f"{field}={outputs[field]:.4g}" if outputs.get(field) is not None else f"{field}=-"
+                for field in OUTPUT_FIELDS if field != 'segments_sec'
+            )
+            segments = len(outputs['segments_sec']) if outputs.get('segments_sec') is not None else '-'
+            lines.append(f"  {name:13s} {values}  segments={segments}  "
+                         f"({sum(record['timings'].values()):.3f}s)")
+    return lines
+
+
+def save_baseline(path, nights, repeat):
+    with open(path, 'w') as f:
+        json.dump({'format': BASELINE_FORMAT, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'repeat': repeat, 'nights': nights}, f, indent=1)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get('format') != BASELINE_FORMAT:
+        raise ValueError(f"{path} has baseline format {baseline.get('format')}, expected {BASELINE_FORMAT}.")
+    return baseline['nights']
+
+
+def write_edf(path, signals, start, record_sec=SYNTHETIC_RECORD_SEC):
+    """
+    Writes a plain EDF. signals: (label, unit, physical_min, physical_max, rate_hz, values);
+    all must cover the same number of whole records. start is a datetime.
+    """
+    def field(value, width):
+        return str(value).ljust(width)[:width].encode('ascii')
+
+    n_records = min(int(len(values) // (rate * record_sec)) for _, _, _, _, rate, values in signals)
+    header = (field(0, 8) + field('X X X X', 80) + field('Startdate X X X X', 80)
+              + field(start.strftime('%d.%m.%y'), 8) + field(start.strftime('%H.%M.%S'), 8)
+              + field(256 * (len(signals) + 1), 8) + field('', 44) + field(n_records, 8)
+              + field(record_sec, 8) + field(len(signals), 4))
+    columns = [
+        [(label, 16), ('', 80), (unit, 8), (physical_min, 8), (physical_max, 8), (-32768, 8), (32767, 8),
+         ('', 80), (int(rate * record_sec), 8), ('', 32)]
+        for label, unit, physical_min, physical_max, rate, values in signals
+    ]
+    # The spec interleaves fields: every signal's label, then every signal's transducer, and so on.
+    for i in range(len(columns[0])):
+        header += b''.join(field(*column[i]) for column in columns)
+
+    records = []
+    for label, unit, physical_min, physical_max, rate, values in signals:
+        samples = int(rate * record_sec)
+        gain = (physical_max - physical_min) / 65535
+        values = np.clip(np.asarray(values[:n_records * samples], dtype=float), physical_min, physical_max)
+        records.append(np.round((values - physical_min) / gain - 32768).astype('<i2').reshape(n_records, samples))
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(np.concatenate(records, axis=1).tobytes())
+
+
+def write_synthetic_corpus(directory, seed=0):
+    """
+    Writes SYNTHETIC_NIGHTS as BRP (flow) and PLD (minute ventilation) pairs. Breathing is a
+    15 /min sine whose amplitude is modulated during PB; the same seed gives identical files.
+    Returns the BRP paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for stem, hours, pb_spans, flat_spans in SYNTHETIC_NIGHTS:
+        fs = SYNTHETIC_FLOW_RATE_HZ
+        t = np.arange(int(hours * 3600 * fs)) / fs
+        amplitude = np.full(len(t), 0.4)
+        for start_h, end_h, period in pb_spans:
+            inside = (t >= start_h * 3600) & (t < end_h * 3600)
+            amplitude[inside] = 0.4 + 0.3 * np.sin(2 * np.pi * t[inside] / period)
+        for start_h, end_h in flat_spans:
+            amplitude[(t >= start_h * 3600) & (t < end_h * 3600)] = 0
+        flow = amplitude * np.sin(2 * np.pi * t / 4.0) + 0.02 * rng.standard_normal(len(t))
+        step = int(fs / SYNTHETIC_MINUTE_VENT_RATE_HZ)
+        # Minute ventilation of a sine breath of peak flow A (L/s) is 60 A / pi L/min.
+        minute_vent = 60 * amplitude[::step] / np.pi + 0.1 * rng.standard_normal(len(t[::step]))
+
+        start = datetime.datetime.strptime(stem, '%Y%m%d_%H%M%S')
+        brp_path = os.path.join(directory, f"{stem}_BRP.edf")
+        write_edf(brp_path, [('Flow.40ms', 'L/s', -2, 2, fs, flow)], start)
+        write_edf(os.path.join(directory, f"{stem}_PLD.edf"),
+                  [('Minute Vent.', 'L/min', 0, 30, SYNTHETIC_MINUTE_VENT_RATE_HZ, minute_vent)], start)
+        paths.append(brp_path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and timing regression harness for the PB pipelines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    synth_parser = commands.add_parser('synth', help="Write the synthetic corpus")
+    synth_parser.add_argument('directory')
+    for command, help_text in (('run', "Run the corpus and compare pipelines with each other"),
+                               ('record', "Run the corpus and store the results as the baseline"),
+                               ('compare', "Run the corpus and compare against the baseline")):
+        command_parser = commands.add_parser(command, help=help_text)
+        if command != 'run':
+            command_parser.add_argument('baseline', help="Baseline JSON file")
+        command_parser.add_argument('paths', nargs='+', help="EDF files or directories searched for *BRP.edf")
+        command_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                                    help="Runs per night; timings are the fastest run")
+        command_parser.add_argument('--pipelines', nargs='+', choices=list(PIPELINES), default=None)
+        if command == 'compare':
+            command_parser.add_argument('--max-slowdown', type=float, default=None,
+                                        help="Fail pipelines slower than this factor of their baseline time")
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        paths = write_synthetic_corpus(args.directory)
+        print(f"Wrote {len(paths)} synthetic nights to {args.directory}.")
+        sys.exit(0)
+
+    paths = list(_expand_paths(args.paths))
+    if not paths:
+        print("No files found. Exiting script.")
+        sys.exit(1)
+    if pb_analyzer is None and (args.pipelines is None or 'pb_analyzer' in args.pipelines):
+        print("pyedflib is not installed; skipping the pb_analyzer pipeline.")
+    pipelines = [name for name in (args.pipelines or available_pipelines()) if name in available_pipelines()]
+
+    nights = run_corpus(paths, pipelines, args.repeat)
+    if args.command in ('run', 'record'):
+        if args.command == 'record':
+            save_baseline(args.baseline, nights, args.repeat)
+        print("\n".join(cross_pipeline_lines(nights)))
+        lines, failures = ground_truth_lines(nights)
+        equivalence, mismatches = equivalence_lines(nights)
+        lines += equivalence
+        failures += mismatches
+        if lines:
+            print("\n" + "\n".join(lines))
+        if args.command == 'record':
+            print(f"\nRecorded {len(nights)} nights to {args.baseline}.")
+        print(f"\n{failures} failures." if failures else "\nAll synthetic nights match their ground truth or a known miss.")
+        sys.exit(1 if failures else 0)
+    else:
+        lines, failures = compare_runs(load_baseline(args.baseline), nights, args.max_slowdown)
+        equivalence, mismatches = equivalence_lines(nights)
+        lines += equivalence
+        failures += mismatches
+        print("\n".join(lines))
+        print(f"\n{failures} regressions." if failures else "\nNo regressions.")
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,210 @@
+import numpy as np
+import json
+import os
+import struct
+import sys
+
+from process_flow import select_single_file, read_edf_header
+from recording import Recording, envelope_detector
+from cycle_table import recording_start
+from wat_metrics import browser_metrics, MV_STEP_SEC
+from event_detector import detect_events, event_indices
+from lod_pyramid import TILE_SIZE
+
+# Layout: 'WATB', uint32 version, uint32 header length, UTF-8 JSON header, then the arrays, each
+# little-endian and starting on an 8-byte boundary so the browser can view them as typed arrays
+# without copying. Array offsets in the header are from the start of the file.
+BUNDLE_MAGIC = b'WATB'
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.wat'
+ALIGNMENT = 8
+ENVELOPE_RATE_HZ = 1.0
+# Flow pyramid levels (see lod_pyramid) are stored from the first whose buckets span at least this
+# long: a min/max band a few buckets per breath wide, down to minutes-long views, at a fraction of
+# the size of the raw flow, which the bundle leaves out.
+LOD_MIN_BUCKET_SEC = 1.0
+
+# dtype names as the JS loader knows them.
+_DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float64': np.dtype('<f8'),
+    'int32': np.dtype('<i4'),
+    'uint8': np.dtype('u1'),
+}
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(path, header, arrays):
+    """
+    Writes header (a JSON-serializable dict) and arrays ({name: (dtype name, values)}) to path.
+    The header gets an 'arrays' entry describing where each array sits.
+    """
+    arrays = {name: np.ascontiguousarray(values, dtype=_DTYPES[dtype]) for name, (dtype, values) in arrays.items()}
+
+    descriptors = {}
+    for name, values in arrays.items():
+        dtype_name = next(key for key, dtype in _DTYPES.items() if dtype == values.dtype)
+        descriptors[name] = {'dtype': dtype_name, 'offset': 0, 'length': int(len(values))}
+    header = dict(header, format='WATB', version=BUNDLE_VERSION, arrays=descriptors)
+
+    # Offsets depend on the header length and vice versa; re-lay out until the header stops growing.
+    data_start = 0
+    while True:
+        header_bytes = json.dumps(header).encode('utf-8')
+        new_data_start = _aligned(12 + len(header_bytes))
+        if new_data_start == data_start:
+            break
+        data_start = new_data_start
+        offset = data_start
+        for name, values in arrays.items():
+            descriptors[name]['offset'] = offset
+            offset += _aligned(values.nbytes)
+    header_bytes += b' ' * (data_start - 12 - len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<II', BUNDLE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for values in arrays.values():
+            raw = values.tobytes()
+            f.write(raw)
+            f.write(b'\0' * (_aligned(len(raw)) - len(raw)))
+
+
+def read_bundle(path):
+    """(header, arrays) of a bundle written by write_bundle. Returns (None, None) if it is not one."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != BUNDLE_MAGIC or len(data) < 12:
+        print(f"Error: {os.path.basename(path)} is not a WAT results bundle.")
+        return None, None
+    version, header_length = struct.unpack('<II', data[4:12])
+    if version > BUNDLE_VERSION:
+        print(f"Error: {os.path.basename(path)} is bundle version {version}; this reader knows up to {BUNDLE_VERSION}.")
+        return None, None
+    header = json.loads(data[12:12 + header_length].decode('utf-8'))
+    arrays = {
+        name: np.frombuffer(data, dtype=_DTYPES[d['dtype']], count=d['length'], offset=d['offset'])
+        for name, d in header['arrays'].items()
+    }
+    return header, arrays
+
+
+def _downsample_mean(values, samples_per_bin):
+    n_bins = len(values) // samples_per_bin
+    return values[:n_bins * samples_per_bin].reshape(n_bins, samples_per_bin).mean(axis=1)
+
+
+def pyramid_arrays(pyramid):
+    """
+    Bundle arrays ('lodMin<k>', 'lodMax<k>', 'lodMean<k>') and header entry for the pyramid's
+    levels from the first with LOD_MIN_BUCKET_SEC buckets, or ({}, None) if it has no such level.
+    """
+    n_levels = len(pyramid['levels'])
+    first_level = max(int(np.ceil(np.log2(max(LOD_MIN_BUCKET_SEC * pyramid['sampling_rate'], 1)))), 1)
+    if first_level >= n_levels:
+        return {}, None
+    arrays = {}
+    for level in range(first_level, n_levels):
+        mins, maxs, means = pyramid['levels'][level]
+        arrays.update({
+            f'lodMin{level}': ('float32', mins),
+            f'lodMax{level}': ('float32', maxs),
+            f'lodMean{level}': ('float32', means),
+        })
+    header = {
+        'samplingRate': pyramid['sampling_rate'],
+        'nSamples': pyramid['n_samples'],
+        'firstLevel': first_level,
+        'nLevels': n_levels,
+        'tileSize': TILE_SIZE,
+    }
+    return arrays, header
+
+
+def _finite_or_none(value):
+    return float(value) if value is not None and np.isfinite(value) else None
+
+
+def build_night_bundle(filepath, out_path=None):
+    """Analyzes one EDF and writes its results bundle next to it. Returns the bundle path or None."""
+    recording = Recording.from_edf(filepath)
+    if recording is None:
+        return None
+    with open(filepath, 'rb') as f:
+        edf_header = read_edf_header(f, filepath)
+    start_datetime = recording_start(edf_header)
+    duration_minutes = edf_header['num_data_records'] * edf_header['duration_data_record'] / 60
+
+    metrics, minute_vent = browser_metrics(recording.flow_data, recording.sampling_rate, duration_minutes * 60)
+    pb = envelope_detector(recording)
+    events = detect_events(recording.flow_data, recording.sampling_rate, recording.valid_mask)
+    indices = event_indices(events, recording.valid_mask, recording.sampling_rate)
+    metrics.update({
+        'ahi': indices['ahi'],
+        'apneaIndex': indices['apnea_index'],
+        'hypopneaIndex': indices['hypopnea_index'],
+        'pbPercentage': pb.get('periodic_percentage'),
+        'dominantPeriodSec': pb.get('dominant_period_sec'),
+        'averageDepth': pb.get('average_depth'),
+        'averagePeriodSec': pb.get('average_period_sec'),
+        'validHours': np.count_nonzero(recording.valid_mask) / recording.sampling_rate / 3600,
+    })
+    metrics = {name: _finite_or_none(value) for name, value in metrics.items()}
+
+    samples_per_bin = max(int(round(recording.sampling_rate / ENVELOPE_RATE_HZ)), 1)
+    arrays = {
+        'minuteVent': ('float32', minute_vent),
+        'envelope': ('float32', _downsample_mean(recording.envelope, samples_per_bin)),
+        'eventStart': ('int32', events['start']),
+        'eventEnd': ('int32', events['end']),
+        'eventKind': ('uint8', events['kind']),
+    }
+    cycles = pb.get('cycles')
+    if cycles is not None:
+        arrays.update({
+            'cycleStart': ('int32', cycles['start']),
+            'cycleEnd': ('int32', cycles['end']),
+            'cyclePeriod': ('float32', cycles['period']),
+            'cycleDepth': ('float32', cycles['depth']),
+            'cycleFlags': ('uint8', cycles['flags']),
+            'cycleInSegment': ('uint8', cycles['in_segment']),
+        })
+    lod_arrays, lod_header = pyramid_arrays(recording.pyramid)
+    arrays.update(lod_arrays)
+
+    header = {
+        'filename': os.path.basename(filepath),
+        'date': start_datetime.date().isoformat() if start_datetime is not None else None,
+        'start': start_datetime.isoformat() if start_datetime is not None else None,
+        'durationMinutes': duration_minutes,
+        'samplingRate': recording.sampling_rate,
+        'mvStepSec': MV_STEP_SEC,
+        'envelopeRateHz': recording.sampling_rate / samples_per_bin,
+        'metrics': metrics,
+        'lod': lod_header,
+    }
+    if out_path is None:
+        out_path = os.path.splitext(filepath)[0] + BUNDLE_SUFFIX
+    write_bundle(out_path, header, arrays)
+    return out_path
+
+
+if __name__ == "__main__":
+    filepaths = sys.argv[1:] or [select_single_file()]
+
+    for filepath in filepaths:
+        if not filepath:
+            print("No file selected. Exiting script.")
+            continue
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        out_path = build_night_bundle(filepath)
+        if out_path is None:
+            print(f"Failed to process {filename}.")
+        else:
+            print(f"Wrote {os.path.basename(out_path)} ({os.path.getsize(out_path) / 1024:.0f} KiB)")
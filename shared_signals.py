@@ -0,0 +1,147 @@
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from process_flow import select_single_file
+from recording import Recording, DETECTORS
+
+DEFAULT_SHARED_SERIES = ('flow_data', 'envelope', 'valid_mask')
+
+
+def publish_array(array):
+    """Copies an array into a new shared memory segment. Returns (segment, handle)."""
+    array = np.ascontiguousarray(array)
+    segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+    view[...] = array
+    del view
+    handle = {'name': segment.name, 'shape': array.shape, 'dtype': array.dtype.str}
+    return segment, handle
+
+
+def attach_array(handle):
+    """Maps a published array without copying. Returns (segment, view)."""
+    try:
+        segment = shared_memory.SharedMemory(name=handle['name'], track=False)
+    except TypeError:
+        # Before Python 3.13 attaching also registers the segment, but pool workers share the
+        # owner's resource tracker, so this is a no-op and only the owner ever unlinks.
+        segment = shared_memory.SharedMemory(name=handle['name'])
+    view = np.ndarray(handle['shape'], dtype=np.dtype(handle['dtype']), buffer=segment.buf)
+    return segment, view
+
+
+class SharedRecording:
+    """
+    Owner side of a Recording published to shared memory. Use it as a context manager: segments are
+    created on entry and unlinked on exit, once every consumer has finished.
+    """
+
+    def __init__(self, recording, series=DEFAULT_SHARED_SERIES):
+        self.recording = recording
+        self.series = series
+        self.segments = []
+        self.handle = None
+
+    def open(self):
+        arrays = {}
+        for name in self.series:
+            segment, arrays[name] = publish_array(getattr(self.recording, name))
+            self.segments.append(segment)
+        self.handle = {
+            'sampling_rate': self.recording.sampling_rate,
+            'filepath': self.recording.filepath,
+            'clip_limits': self.recording.clip_limits,
+            'arrays': arrays,
+        }
+        return self.handle
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segments = []
+        self.handle = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_recording(handle):
+    """
+    Worker side: rebuilds a Recording whose arrays are views on the shared segments. Shared derived
+    series are placed straight into the memo so the worker never recomputes them.
+    Returns (recording, segments); close the segments once the recording is no longer referenced.
+    """
+    segments = []
+    views = {}
+    for name, array_handle in handle['arrays'].items():
+        segment, views[name] = attach_array(array_handle)
+        segments.append(segment)
+
+    recording = Recording(views.pop('flow_data'), handle['sampling_rate'], handle['filepath'],
+                          clip_limits=handle['clip_limits'])
+    recording.__dict__.update(views)
+    return recording, segments
+
+
+def _run_attached(handle, func, kwargs):
+    recording, segments = attach_recording(handle)
+    try:
+        result = func(recording, **kwargs)
+    finally:
+        del recording
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            # The result still holds a view on the segment; the mapping goes away with the worker.
+            pass
+    return result
+
+
+def run_shared(recording, tasks, max_workers=None, series=DEFAULT_SHARED_SERIES):
+    """
+    Runs tasks, a list of (func, kwargs) pairs each called as func(recording, **kwargs), across a
+    process pool with the recording's arrays shared rather than pickled. Results come back in
+    task order. Segments are freed when all tasks have finished, even if one of them raises.
+    """
+    with SharedRecording(recording, series) as shared:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_run_attached, shared.handle, func, kwargs) for func, kwargs in tasks]
+            return [future.result() for future in futures]
+
+
+def run_detectors_parallel(recording, names=None, max_workers=None):
+    """Parallel counterpart of recording.run_detectors: one worker task per registered detector."""
+    if names is None:
+        names = list(DETECTORS)
+    names = [name for name in names if name in DETECTORS]
+    results = run_shared(recording, [(DETECTORS[name], {}) for name in names], max_workers=max_workers)
+    return dict(zip(names, results))
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        recording = Recording.from_edf(filepath)
+        if recording is None:
+            print(f"Failed to process {filename}.")
+        else:
+            results = run_detectors_parallel(recording)
+            for name, result in results.items():
+                print(f"{name}: dominant period {result.get('dominant_period_sec')}")
@@ -0,0 +1,172 @@
+import numpy as np
+import json
+import lzma
+import os
+import struct
+import zlib
+
+from process_flow import select_single_file, read_edf_signal, signal_scaling
+
+# Layout: 'WFAR', uint32 version, the compressed chunks back to back, a JSON footer with the
+# metadata and chunk index, then uint64 footer offset, uint32 footer length and 'WFAR' again.
+# The footer sits at the end so chunks can be written as they are encoded.
+ARCHIVE_MAGIC = b'WFAR'
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = '.wfa'
+DEFAULT_CHUNK_SEC = 300
+_TRAILER = struct.Struct('<QI4s')
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def encode_chunk(digital, codec='zlib'):
+    """
+    Delta-codes int16 samples (wrapping, so every delta fits in int16 and decoding is exact),
+    splits the deltas into low and high byte planes and compresses them. Small deltas make the
+    high-byte plane almost all 0x00/0xFF, which is what lets the compressor win.
+    """
+    deltas = np.diff(digital.astype(np.int16), prepend=np.int16(0))
+    planes = deltas.astype('<i2').view(np.uint8).reshape(-1, 2).T
+    return CODECS[codec][0](planes.tobytes())
+
+
+def decode_chunk(payload, n_samples, codec='zlib'):
+    planes = np.frombuffer(CODECS[codec][1](payload), dtype=np.uint8).reshape(2, n_samples)
+    deltas = np.ascontiguousarray(planes.T).view('<i2').ravel()
+    return np.cumsum(deltas, dtype=np.int16)
+
+
+def write_archive(path, digital, sampling_rate, signal_info, start_date='', start_time='',
+                  chunk_sec=DEFAULT_CHUNK_SEC, codec='zlib'):
+    """Writes digital samples as fixed-duration compressed chunks with an offset index."""
+    chunk_samples = max(int(round(chunk_sec * sampling_rate)), 1)
+    chunks = []
+    with open(path, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack('<I', ARCHIVE_VERSION))
+        for start in range(0, len(digital), chunk_samples):
+            block = digital[start:start + chunk_samples]
+            payload = encode_chunk(block, codec)
+            chunks.append([f.tell(), len(payload), len(block)])
+            f.write(payload)
+        footer = json.dumps({
+            'sampling_rate': sampling_rate,
+            'n_samples': int(len(digital)),
+            'chunk_samples': chunk_samples,
+            'codec': codec,
+            'signal': signal_info,
+            'start_date': start_date,
+            'start_time': start_time,
+            'chunks': chunks,
+        }).encode('utf-8')
+        footer_offset = f.tell()
+        f.write(footer)
+        f.write(_TRAILER.pack(footer_offset, len(footer), ARCHIVE_MAGIC))
+
+
+def archive_edf(edf_path, out_path=None, signal=0, chunk_sec=DEFAULT_CHUNK_SEC, codec='zlib'):
+    """Archives one signal of an EDF (flow by default). Returns the archive path or None."""
+    digital, signal_info, edf_header = read_edf_signal(edf_path, signal)
+    if digital is None:
+        return None
+    sampling_rate = signal_info['num_samples_in_data_record'] / edf_header['duration_data_record']
+    if out_path is None:
+        out_path = os.path.splitext(edf_path)[0] + ARCHIVE_SUFFIX
+    write_archive(out_path, digital, sampling_rate, signal_info, edf_header['start_date'],
+                  edf_header['start_time'], chunk_sec, codec)
+    return out_path
+
+
+class SignalArchive:
+    """
+    Random-access reader. Only the footer is read on open; each read decompresses just the chunks
+    overlapping the requested range. Samples come back in physical units unless digital=True.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(4) != ARCHIVE_MAGIC:
+                raise ValueError(f"{os.path.basename(path)} is not a signal archive.")
+            version, = struct.unpack('<I', f.read(4))
+            if version > ARCHIVE_VERSION:
+                raise ValueError(f"{os.path.basename(path)} is archive version {version}; this reader knows up to {ARCHIVE_VERSION}.")
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            footer_offset, footer_length, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError(f"{os.path.basename(path)} has no archive index; it was probably not finished.")
+            f.seek(footer_offset)
+            footer = json.loads(f.read(footer_length).decode('utf-8'))
+
+        self.sampling_rate = footer['sampling_rate']
+        self.n_samples = footer['n_samples']
+        self.chunk_samples = footer['chunk_samples']
+        self.codec = footer['codec']
+        self.signal_info = footer['signal']
+        self.start_date = footer['start_date']
+        self.start_time = footer['start_time']
+        index = np.asarray(footer['chunks'], dtype=np.int64).reshape(-1, 3)
+        self._offsets, self._lengths, self._counts = index[:, 0], index[:, 1], index[:, 2]
+        self.gain, self.offset = signal_scaling(self.signal_info)
+
+    @property
+    def duration_sec(self):
+        return self.n_samples / self.sampling_rate
+
+    def _chunk(self, f, i):
+        f.seek(self._offsets[i])
+        return decode_chunk(f.read(self._lengths[i]), self._counts[i], self.codec)
+
+    def read_samples(self, start, end, digital=False):
+        """Samples [start, end) by index."""
+        start = max(int(start), 0)
+        end = min(int(end), self.n_samples)
+        if end <= start:
+            return np.empty(0, dtype=np.int16 if digital else float)
+        first, last = start // self.chunk_samples, (end - 1) // self.chunk_samples
+        with open(self.path, 'rb') as f:
+            samples = np.concatenate([self._chunk(f, i) for i in range(first, last + 1)])
+        samples = samples[start - first * self.chunk_samples:end - first * self.chunk_samples]
+        return samples if digital else samples * self.gain + self.offset
+
+    def read(self, start_sec, end_sec, digital=False):
+        """Samples between start_sec and end_sec from the start of the recording."""
+        return self.read_samples(round(start_sec * self.sampling_rate), round(end_sec * self.sampling_rate), digital)
+
+    def read_all(self, digital=False):
+        return self.read_samples(0, self.n_samples, digital)
+
+    def iter_chunks(self, digital=False):
+        """Yields (start_sample, samples) chunk by chunk, holding one chunk in memory at a time."""
+        with open(self.path, 'rb') as f:
+            for i in range(len(self._offsets)):
+                samples = self._chunk(f, i)
+                yield i * self.chunk_samples, samples if digital else samples * self.gain + self.offset
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        out_path = archive_edf(filepath)
+        if out_path is None:
+            print(f"Failed to process {filename}.")
+        else:
+            archive = SignalArchive(out_path)
+            digital, signal_info, edf_header = read_edf_signal(filepath)
+            raw_bytes = digital.nbytes
+            archived_bytes = os.path.getsize(out_path)
+            print(f"Archived {archive.duration_sec / 3600:.2f} h of '{signal_info['label']}' in {len(archive._offsets)} chunks: "
+                  f"{raw_bytes / 1024:.0f} KiB -> {archived_bytes / 1024:.0f} KiB ({raw_bytes / archived_bytes:.1f}x)")
+            if np.array_equal(archive.read_all(digital=True), digital):
+                print("Round trip verified: archive decodes to the original samples.")
+            else:
+                print("Error: Archive does not decode to the original samples.")
@@ -0,0 +1,245 @@
+import numpy as np
+import bisect
+import glob
+import json
+import os
+import sys
+from collections import deque
+from datetime import date
+
+from analysis_service import file_sha256
+from results_bundle import read_bundle, BUNDLE_SUFFIX
+
+METRICS = ('flScore', 'periodicityIndex', 'regularityScore', 'eai', 'pbPercentage')
+ROLLING_WINDOWS = (7, 30)
+TREND_STATE_FILE = 'trend_state.json'
+
+
+class _Welford:
+    """Running count, mean and variance, plus their duration-weighted counterparts (West, 1979)."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.weight = 0.0
+        self.weighted_mean = 0.0
+        self.weighted_m2 = 0.0
+
+    def add(self, value, weight):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if weight > 0:
+            self.weight += weight
+            delta = value - self.weighted_mean
+            self.weighted_mean += delta * weight / self.weight
+            self.weighted_m2 += weight * delta * (value - self.weighted_mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def weighted_variance(self):
+        return self.weighted_m2 / self.weight if self.weight > 0 else 0.0
+
+
+class _Rolling:
+    """Mean over the last `size` nights, kept as running sums over a deque."""
+
+    def __init__(self, size):
+        self.values = deque()
+        self.size = size
+        self.total = 0.0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.size:
+            self.total -= self.values.popleft()
+
+    @property
+    def mean(self):
+        return self.total / len(self.values) if self.values else None
+
+
+class TrendStats:
+    """
+    Per-patient trend statistics that take each new night in O(1): running mean and variance,
+    trailing 7- and 30-night means, and duration-weighted prefix sums so the statistics of any date
+    range (the periods ComparisonDatesSection splits the nights into) come from two binary searches.
+    The windows end at the newest night, which is what "the last week" means for a report; the
+    chart's movingAverage is centred on each night instead, so its newest points differ.
+
+    Nights are expected in date order, as nightly ingestion delivers them. A night older than the
+    newest one already seen is still accepted but rebuilds the state, which costs O(n).
+    """
+
+    def __init__(self, metrics=METRICS, windows=ROLLING_WINDOWS):
+        self.metrics = tuple(metrics)
+        self.windows = tuple(windows)
+        self.nights = []
+        # Seen EDF names and bundle hashes, so a night already added is recognised in O(1).
+        self._filenames = set()
+        self._hashes = set()
+        self._reset()
+
+    def _reset(self):
+        self.dates = []
+        self.running = {name: _Welford() for name in self.metrics}
+        self.rolling = {name: {size: _Rolling(size) for size in self.windows} for name in self.metrics}
+        # Prefix sums: entry i covers the first i nights, so a range is one subtraction.
+        self._minutes = [0.0]
+        self._weighted = {name: [0.0] for name in self.metrics}
+        self._weights = {name: [0.0] for name in self.metrics}
+        self._values = {name: [] for name in self.metrics}
+
+    def add_night(self, night_date, duration_minutes, metrics, filename=None, sha256=None):
+        night = {'date': night_date.isoformat(), 'durationMinutes': duration_minutes, 'filename': filename,
+                 'sha256': sha256, 'metrics': {name: metrics.get(name) for name in self.metrics}}
+        self._remember(night)
+        if self.dates and night_date < self.dates[-1]:
+            self.nights.insert(bisect.bisect_right(self.dates, night_date), night)
+            self._rebuild()
+        else:
+            self.nights.append(night)
+            self._ingest(night_date, night)
+
+    def _ingest(self, night_date, night):
+        duration = night['durationMinutes']
+        self.dates.append(night_date)
+        self._minutes.append(self._minutes[-1] + duration)
+        for name, value in night['metrics'].items():
+            # A metric the night lacks (None) adds no weight, so it drops out of every average.
+            present = value is not None
+            self._weighted[name].append(self._weighted[name][-1] + (value * duration if present else 0.0))
+            self._weights[name].append(self._weights[name][-1] + (duration if present else 0.0))
+            self._values[name].append(value if present else np.nan)
+            if present:
+                self.running[name].add(value, duration)
+                for rolling in self.rolling[name].values():
+                    rolling.add(value)
+
+    def _rebuild(self):
+        self._reset()
+        for night in self.nights:
+            self._ingest(date.fromisoformat(night['date']), night)
+
+    def _remember(self, night):
+        if night.get('filename') is not None:
+            self._filenames.add(night['filename'])
+        if night.get('sha256') is not None:
+            self._hashes.add(night['sha256'])
+
+    def add_bundle(self, path):
+        """
+        Adds the night stored in a results bundle. Returns False if unreadable or already added,
+        either as the same bundle content or, when the bundle names its EDF, as a bundle of the same
+        EDF (a re-analysis rewrites the bundle with new content).
+        """
+        header, arrays = read_bundle(path)
+        if header is None or header.get('date') is None:
+            return False
+        sha256 = file_sha256(path)
+        filename = header.get('filename')
+        if sha256 in self._hashes or (filename is not None and filename in self._filenames):
+            return False
+        self.add_night(date.fromisoformat(header['date']), header['durationMinutes'], header['metrics'],
+                       filename, sha256)
+        return True
+
+    def range_stats(self, start_date=None, end_date=None):
+        """
+        Statistics of the nights with start_date <= date < end_date (open-ended when None), in
+        getSummaryStats's terms: count, total hours, duration-weighted means and medians.
+        """
+        lo = 0 if start_date is None else bisect.bisect_left(self.dates, start_date)
+        hi = len(self.dates) if end_date is None else bisect.bisect_left(self.dates, end_date)
+        if hi <= lo:
+            return None
+        stats = {'count': hi - lo, 'totalHours': (self._minutes[hi] - self._minutes[lo]) / 60,
+                 'mean': {}, 'median': {}}
+        for name in self.metrics:
+            weight = self._weights[name][hi] - self._weights[name][lo]
+            stats['mean'][name] = (self._weighted[name][hi] - self._weighted[name][lo]) / weight if weight > 0 else None
+            # Medians do not decompose into prefix sums; take the JS convention sorted[floor(n / 2)].
+            values = np.asarray(self._values[name][lo:hi])
+            values = values[~np.isnan(values)]
+            stats['median'][name] = float(np.partition(values, len(values) // 2)[len(values) // 2]) if len(values) else None
+        return stats
+
+    def compare_periods(self, breakpoints):
+        """
+        Splits the nights at the given dates like ComparisonDatesSection: before the first date,
+        between consecutive dates and from the last date on. Returns [(start, end, stats)], skipping
+        empty periods.
+        """
+        edges = [None] + sorted(breakpoints) + [None]
+        periods = []
+        for start_date, end_date in zip(edges[:-1], edges[1:]):
+            stats = self.range_stats(start_date, end_date)
+            if stats is not None:
+                periods.append((start_date, end_date, stats))
+        return periods
+
+    def summary(self):
+        """
+        Running and trailing-window statistics of every metric as of the newest night; lastN is
+        the mean of the N newest nights, not a window centred on a night as in movingAverage.
+        """
+        return {
+            name: {
+                'count': self.running[name].count,
+                'mean': self.running[name].mean,
+                'std': float(np.sqrt(self.running[name].variance)),
+                'weightedMean': self.running[name].weighted_mean,
+                'weightedStd': float(np.sqrt(self.running[name].weighted_variance)),
+                **{f'last{size}': self.rolling[name][size].mean for size in self.windows},
+            }
+            for name in self.metrics
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'metrics': self.metrics, 'windows': self.windows, 'nights': self.nights}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        trends = cls(state['metrics'], state['windows'])
+        trends.nights = state['nights']
+        for night in trends.nights:
+            trends._remember(night)
+        trends._rebuild()
+        return trends
+
+
+if __name__ == "__main__":
+    # Usage: python trend_stats.py <directory of .wat bundles> [YYYY-MM-DD comparison dates...]
+    if len(sys.argv) < 2:
+        print("Usage: python trend_stats.py <bundle directory> [comparison dates YYYY-MM-DD ...]")
+        sys.exit(1)
+    directory = sys.argv[1]
+    breakpoints = [date.fromisoformat(arg) for arg in sys.argv[2:]]
+
+    state_path = os.path.join(directory, TREND_STATE_FILE)
+    trends = TrendStats.load(state_path) if os.path.exists(state_path) else TrendStats()
+    added = sum(trends.add_bundle(path) for path in sorted(glob.glob(os.path.join(directory, '*' + BUNDLE_SUFFIX))))
+    trends.save(state_path)
+    print(f"Added {added} new nights ({len(trends.nights)} total).")
+
+    for name, stats in trends.summary().items():
+        windows = ", ".join(f"last {size}: {stats[f'last{size}']:.1f}" for size in trends.windows
+                            if stats[f'last{size}'] is not None)
+        if stats['count']:
+            print(f"  {name}: {stats['weightedMean']:.1f} +/- {stats['weightedStd']:.1f} (weighted), {windows}")
+
+    for start_date, end_date, stats in trends.compare_periods(breakpoints) if breakpoints else []:
+        label = f"{start_date or 'start'} to {end_date or 'now'}"
+        print(f"\n{label}: {stats['count']} sessions, {stats['totalHours']:.1f} hours")
+        for name in trends.metrics:
+            if stats['mean'][name] is not None:
+                print(f"  {name}: mean {stats['mean'][name]:.1f}, median {stats['median'][name]:.1f}")
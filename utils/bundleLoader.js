@@ -0,0 +1,132 @@
+/**
+ * Results Bundle Loader
+ * Reads the per-night .wat bundles written by results_bundle.py, so nights analyzed in Python
+ * load without parsing the raw EDF in the browser
+ */
+
+const BUNDLE_MAGIC = 'WATB';
+const SUPPORTED_VERSION = 1;
+
+const TYPED_ARRAYS = {
+  float32: Float32Array,
+  float64: Float64Array,
+  int32: Int32Array,
+  uint8: Uint8Array
+};
+
+export const isBundleFile = (file) => file.name.toLowerCase().endsWith('.wat');
+
+/**
+ * Parses a bundle into its JSON header and typed-array views over the same buffer
+ */
+export const parseBundle = (buffer) => {
+  const view = new DataView(buffer);
+  const decoder = new TextDecoder('utf-8');
+
+  if (buffer.byteLength < 12 || decoder.decode(new Uint8Array(buffer, 0, 4)) !== BUNDLE_MAGIC) {
+    throw new Error('Not a WAT results bundle');
+  }
+
+  const version = view.getUint32(4, true);
+  if (version > SUPPORTED_VERSION) {
+    throw new Error(`Bundle version ${version} is newer than this tool supports (${SUPPORTED_VERSION})`);
+  }
+
+  const headerLength = view.getUint32(8, true);
+  const header = JSON.parse(decoder.decode(new Uint8Array(buffer, 12, headerLength)));
+
+  const arrays = {};
+  for (const [name, { dtype, offset, length }] of Object.entries(header.arrays)) {
+    const TypedArray = TYPED_ARRAYS[dtype];
+    if (!TypedArray) {
+      throw new Error(`Unknown array type ${dtype} for ${name}`);
+    }
+    arrays[name] = new TypedArray(buffer, offset, length);
+  }
+
+  return { header, arrays };
+};
+
+/**
+ * Flow min/max/mean pyramid stored in a bundle (see lod_pyramid.py), or null if it has none.
+ * Level k holds buckets of 2 ** k samples; levels below firstLevel are not stored
+ */
+export const pyramidFromBundle = ({ header, arrays }) => {
+  if (!header.lod) {
+    return null;
+  }
+  const { samplingRate, nSamples, firstLevel, nLevels } = header.lod;
+  const levels = {};
+  for (let level = firstLevel; level < nLevels; level++) {
+    levels[level] = {
+      mins: arrays[`lodMin${level}`],
+      maxs: arrays[`lodMax${level}`],
+      means: arrays[`lodMean${level}`]
+    };
+  }
+  return { samplingRate, nSamples, firstLevel, nLevels, levels };
+};
+
+/**
+ * Buckets covering [t0, t1) seconds from the finest stored level with at most two per pixel,
+ * the level lod_pyramid.choose_level picks. Times are bucket starts in seconds
+ */
+export const queryPyramid = (pyramid, t0, t1, pixelWidth) => {
+  const samplesInRange = Math.max((t1 - t0) * pyramid.samplingRate, 1);
+  const wanted = Math.ceil(Math.log2(Math.max(samplesInRange / (2 * Math.max(pixelWidth, 1)), 1)));
+  const level = Math.min(Math.max(wanted, pyramid.firstLevel), pyramid.nLevels - 1);
+  const { mins, maxs, means } = pyramid.levels[level];
+  const bucketSec = 2 ** level / pyramid.samplingRate;
+  const first = Math.min(Math.max(Math.floor(t0 / bucketSec), 0), mins.length);
+  const last = Math.min(Math.max(Math.ceil(t1 / bucketSec), first), mins.length);
+  const times = Array.from({ length: last - first }, (_, i) => (first + i) * bucketSec);
+  return {
+    level,
+    times,
+    mins: mins.subarray(first, last),
+    maxs: maxs.subarray(first, last),
+    means: means.subarray(first, last)
+  };
+};
+
+/**
+ * Night date from a device file name such as 20240101_220000_BRP.wat, or null if it has none
+ */
+const dateFromFilename = (filename) => {
+  const match = /^(\d{4})(\d{2})(\d{2})_/.exec(filename || '');
+  return match ? new Date(parseInt(match[1]), parseInt(match[2]) - 1, parseInt(match[3])) : null;
+};
+
+/**
+ * Turns a bundle into the per-night result object SleepAnalyzer builds from an EDF
+ */
+export const resultFromBundle = (buffer, filename) => {
+  const bundle = parseBundle(buffer);
+  const { header } = bundle;
+  const { flScore, periodicityIndex, regularityScore, eai } = header.metrics;
+
+  // The date is null when results_bundle.py could not parse the EDF start date
+  let date;
+  if (header.date) {
+    const [year, month, day] = header.date.split('-').map(part => parseInt(part));
+    date = new Date(year, month - 1, day);
+  } else {
+    date = dateFromFilename(header.filename) || dateFromFilename(filename);
+  }
+  if (!date) {
+    throw new Error(`Bundle ${filename} has no recording date and its file name does not start with one`);
+  }
+
+  return {
+    date,
+    filename: header.filename || filename,
+    flScore,
+    periodicityIndex,
+    regularityScore,
+    eai,
+    durationMinutes: header.durationMinutes,
+    pbPercentage: header.metrics.pbPercentage,
+    // Zoomable flow overview; null for bundles written before the pyramid was stored
+    flowPyramid: pyramidFromBundle(bundle)
+  };
+};
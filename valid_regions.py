@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+import os
+
+# Exact digital repeats this long only happen when the device is padding (mask off, no sensor noise).
+CONSTANT_RUN_MIN_SEC = 5
+# Near-zero flow this long is longer than any central apnea inside a PB cycle (max period 90 s).
+FLATLINE_MIN_SEC = 120
+FLATLINE_RELATIVE_LEVEL = 0.05
+# Flatlines are judged on |flow| averaged over about a breath, so sensor noise around zero does not
+# break them up while any breathing, even shallow, stays well above the level.
+FLATLINE_SMOOTHING_SEC = 5
+# Clipped samples only count when they sit on the extreme for a few samples in a row.
+CLIP_RUN_MIN_SAMPLES = 5
+IMPLAUSIBLE_RELATIVE_LEVEL = 10
+# Invalid regions are widened by this much on both sides to drop the transients around them.
+INVALID_MARGIN_SEC = 5
+
+
+def _runs(flags):
+    """Returns (starts, ends) of the True runs in a boolean array; ends are exclusive."""
+    padded = np.concatenate(([False], flags, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[0::2], edges[1::2]
+
+
+def _long_runs(flags, min_length):
+    starts, ends = _runs(flags)
+    keep = (ends - starts) >= min_length
+    return starts[keep], ends[keep]
+
+
+def _merge_intervals(starts, ends):
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    # An interval opens a new group when it starts after every earlier interval has ended.
+    running_end = np.maximum.accumulate(ends)
+    new_group = np.concatenate(([True], starts[1:] > running_end[:-1]))
+    group_starts = starts[new_group]
+    group_ends = np.maximum.reduceat(ends, np.flatnonzero(new_group))
+    return np.column_stack((group_starts, group_ends)).astype(np.int64)
+
+
+def find_invalid_intervals(flow_data, sampling_rate, clip_limits=None, max_abs_flow=None, typical_flow=None):
+    """
+    Flags regions that are not breathing: exact constant runs, long near-zero flatlines, samples
+    clipped at the recording limits and implausibly large flow.
+
+    clip_limits is (low, high) in physical units, the recording's limits from the EDF header (see
+    process_flow.signal_limits); when omitted, clipping is not checked. typical_flow, the level flatlines and implausible flow are judged against, defaults to
+    the 95th percentile of |flow|; max_abs_flow defaults to IMPLAUSIBLE_RELATIVE_LEVEL times it.
+
+    Returns (intervals, reasons): intervals is an (n, 2) int64 array of merged [start, end) sample
+    ranges and reasons maps each criterion to the seconds it flagged before merging.
+    """
+    n_samples = len(flow_data)
+    abs_flow = np.abs(flow_data)
+    if typical_flow is None:
+        typical_flow = np.percentile(abs_flow, 95) if n_samples > 0 else 0.0
+
+    constant = np.concatenate(([False], np.diff(flow_data) == 0))
+    const_starts, const_ends = _long_runs(constant, int(CONSTANT_RUN_MIN_SEC * sampling_rate))
+    # The first sample of each run is where the repeat starts, not the first repeated sample.
+    const_starts = np.maximum(const_starts - 1, 0)
+
+    window = min(max(int(FLATLINE_SMOOTHING_SEC * sampling_rate), 1), max(n_samples, 1))
+    smoothed = pd.Series(abs_flow).rolling(window=window, center=True, min_periods=1).mean().values
+    near_zero = smoothed <= typical_flow * FLATLINE_RELATIVE_LEVEL
+    flat_starts, flat_ends = _long_runs(near_zero, int(FLATLINE_MIN_SEC * sampling_rate))
+
+    if clip_limits is None:
+        clip_starts = clip_ends = np.empty(0, dtype=np.int64)
+    else:
+        clipped = (flow_data <= clip_limits[0]) | (flow_data >= clip_limits[1])
+        clip_starts, clip_ends = _long_runs(clipped, CLIP_RUN_MIN_SAMPLES)
+
+    if max_abs_flow is None:
+        max_abs_flow = typical_flow * IMPLAUSIBLE_RELATIVE_LEVEL
+    implausible = abs_flow > max_abs_flow if max_abs_flow > 0 else np.zeros(n_samples, dtype=bool)
+    big_starts, big_ends = _runs(implausible)
+
+    reasons = {
+        'constant': float(np.sum(const_ends - const_starts) / sampling_rate),
+        'flatline': float(np.sum(flat_ends - flat_starts) / sampling_rate),
+        'clipped': float(np.sum(clip_ends - clip_starts) / sampling_rate),
+        'implausible': float(np.sum(big_ends - big_starts) / sampling_rate),
+    }
+
+    margin = int(INVALID_MARGIN_SEC * sampling_rate)
+    starts = np.concatenate((const_starts, flat_starts, clip_starts, big_starts)) - margin
+    ends = np.concatenate((const_ends, flat_ends, clip_ends, big_ends)) + margin
+    intervals = _merge_intervals(np.clip(starts, 0, n_samples), np.clip(ends, 0, n_samples))
+    return intervals, reasons
+
+
+def intervals_to_mask(intervals, n_samples):
+    """Boolean mask that is False inside the given [start, end) intervals."""
+    # +1 at each start and -1 at each end, then a running sum marks the covered samples.
+    marks = np.zeros(n_samples + 1, dtype=np.int32)
+    np.add.at(marks, intervals[:, 0], 1)
+    np.add.at(marks, intervals[:, 1], -1)
+    return np.cumsum(marks[:-1]) == 0
+
+
+def valid_intervals(valid_mask):
+    """(n, 2) int64 array of the [start, end) runs where valid_mask is True."""
+    starts, ends = _runs(valid_mask)
+    return np.column_stack((starts, ends)).astype(np.int64)
+
+
+def detect_valid_regions(flow_data, sampling_rate, clip_limits=None, max_abs_flow=None):
+    """
+    Convenience wrapper returning (valid_mask, valid_intervals, reasons) and printing a short summary.
+    """
+    invalid, reasons = find_invalid_intervals(flow_data, sampling_rate, clip_limits, max_abs_flow)
+    valid_mask = intervals_to_mask(invalid, len(flow_data))
+    intervals = valid_intervals(valid_mask)
+
+    valid_sec = np.count_nonzero(valid_mask) / sampling_rate
+    total_sec = len(flow_data) / sampling_rate
+    print(f"DEBUG: Valid breathing time: {valid_sec:.2f}s of {total_sec:.2f}s in {len(intervals)} intervals.")
+    print(f"DEBUG: Flagged seconds by reason: " + ", ".join(f"{k}={v:.1f}" for k, v in reasons.items()))
+    return valid_mask, intervals, reasons
+
+
+if __name__ == "__main__":
+    # process_flow imports this module, so only pull it in when run as a script.
+    from process_flow import select_single_file, read_edf
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate, clip_limits = read_edf(filepath, return_limits=True)
+
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            valid_mask, intervals, reasons = detect_valid_regions(flow_data, sampling_rate, clip_limits)
+            for start_idx, end_idx in intervals:
+                print(f"  Valid: {start_idx / sampling_rate:.1f}s - {end_idx / sampling_rate:.1f}s")
+        else:
+            print(f"Failed to process {filename}.")
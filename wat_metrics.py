@@ -0,0 +1,209 @@
+import numpy as np
+import os
+
+from kernels import top_half_bounds, refractory_count
+
+# NumPy ports of the nightly scores in utils/analysisAlgorithms.js, so results bundles carry the
+# same numbers the browser tool computes from a raw EDF. Thresholds are kept identical to the JS.
+MIN_INSPIRATION_SAMPLES = 10
+MIN_PEAK_FLOW = 0.1
+FLATNESS_VARIANCE_LIMIT = 0.05
+MAX_BREATH_SEC = 20
+AROUSAL_BASELINE_SEC = 120
+AROUSAL_MIN_BASELINE_BREATHS = 5
+AROUSAL_RATE_INCREASE = 0.20
+AROUSAL_VOLUME_INCREASE = 0.30
+AROUSAL_REFRACTORY_SEC = 15
+MV_WINDOW_SEC = 60
+MV_STEP_SEC = 5
+PB_BAND_HZ = (0.01, 0.03)
+
+
+def _upward_crossings(flow_data):
+    return np.flatnonzero((flow_data[1:] > 0) & (flow_data[:-1] <= 0)) + 1
+
+
+def find_breaths(flow_data):
+    """
+    (starts, insp_ends) of every breath as analyzeFlowLimitation splits them: a breath starts at an
+    upward zero crossing and its inspiration ends at the next downward one. A breath with no
+    downward crossing after it has insp_end == start.
+    """
+    starts = _upward_crossings(flow_data)
+    downs = np.flatnonzero((flow_data[1:] <= 0) & (flow_data[:-1] > 0)) + 1
+    next_down = np.searchsorted(downs, starts, side='right')
+    insp_ends = starts.copy()
+    has_down = next_down < len(downs)
+    insp_ends[has_down] = downs[next_down[has_down]]
+    return starts, insp_ends
+
+
+def flow_limitation_score(flow_data, starts, insp_ends):
+    """Mean inspiratory flatness (0-100) over breaths with a long enough, strong enough inspiration."""
+    lengths = insp_ends - starts
+    usable = lengths >= MIN_INSPIRATION_SAMPLES
+    starts, insp_ends = starts[usable], insp_ends[usable]
+    if len(starts) == 0:
+        return 0.0
+
+    # Inspirations never overlap, so interleaving starts and ends lets reduceat take each one alone.
+    bounds = np.column_stack((starts, insp_ends)).ravel()
+    peak_flow = np.maximum.reduceat(flow_data, bounds)[0::2]
+    strong = peak_flow >= MIN_PEAK_FLOW
+    starts, insp_ends, peak_flow = starts[strong], insp_ends[strong], peak_flow[strong]
+    if len(starts) == 0:
+        return 0.0
+
+    # Top half of each inspiration: first to last sample above half its peak.
+    first, last = top_half_bounds(flow_data, starts, insp_ends, peak_flow)
+
+    cumulative = np.concatenate(([0.0], np.cumsum(flow_data)))
+    cumulative_sq = np.concatenate(([0.0], np.cumsum(flow_data * flow_data)))
+    n = last - first
+    mean = (cumulative[last] - cumulative[first]) / n / peak_flow
+    variance = (cumulative_sq[last] - cumulative_sq[first]) / n / peak_flow ** 2 - mean ** 2
+    flatness = np.clip((FLATNESS_VARIANCE_LIMIT - variance) / FLATNESS_VARIANCE_LIMIT * 100, 0, 100)
+    return float(np.mean(flatness))
+
+
+def estimated_arousal_index(flow_data, sampling_rate, starts, insp_ends, total_duration_sec):
+    """Breath-pattern arousals per hour, as estimateArousals computes them."""
+    if len(starts) < 10:
+        return 0.0
+
+    start_times = starts / sampling_rate
+    cumulative_abs = np.concatenate(([0.0], np.cumsum(np.abs(flow_data))))
+    durations = np.diff(start_times)
+    keep = (durations > 0) & (durations <= MAX_BREATH_SEC)
+    if np.count_nonzero(keep) < 10:
+        return 0.0
+
+    times = start_times[1:][keep]
+    rates = 60 / durations[keep]
+    volumes = ((cumulative_abs[insp_ends] - cumulative_abs[starts]) / sampling_rate)[1:][keep]
+
+    index = np.arange(len(rates))
+    baseline_start = np.maximum(0, index - np.floor(AROUSAL_BASELINE_SEC / (60 / rates)).astype(np.int64))
+    n_baseline = index - baseline_start
+    rate_sums = np.concatenate(([0.0], np.cumsum(rates)))
+    volume_sums = np.concatenate(([0.0], np.cumsum(volumes)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        baseline_rate = (rate_sums[index] - rate_sums[baseline_start]) / n_baseline
+        baseline_volume = (volume_sums[index] - volume_sums[baseline_start]) / n_baseline
+        rate_increase = (rates - baseline_rate) / baseline_rate
+        volume_increase = (volumes - baseline_volume) / baseline_volume
+        candidates = (n_baseline >= AROUSAL_MIN_BASELINE_BREATHS) & (
+            (rate_increase > AROUSAL_RATE_INCREASE) | (volume_increase > AROUSAL_VOLUME_INCREASE))
+
+    # Candidates within the refractory period of the last counted arousal are dropped.
+    n_arousals = refractory_count(times[candidates], AROUSAL_REFRACTORY_SEC)
+
+    duration_hours = total_duration_sec / 3600
+    return n_arousals / duration_hours if duration_hours > 0 else 0.0
+
+
+def browser_minute_vent(flow_data, sampling_rate):
+    """
+    Minute ventilation series of calculateMinuteVent: 60 s windows every 5 s, each scored as the
+    inspiratory volume of breaths starting inside the window times their count, over 60.
+    """
+    window = int(MV_WINDOW_SEC * sampling_rate)
+    step = int(MV_STEP_SEC * sampling_rate)
+    window_starts = np.arange(0, len(flow_data) - window, max(step, 1))
+    if len(window_starts) == 0:
+        return np.empty(0)
+
+    positive = np.where(flow_data > 0, flow_data, 0.0) / sampling_rate
+    positive_sums = np.concatenate(([0.0], np.cumsum(positive)))
+    up = np.zeros(len(flow_data), dtype=np.int64)
+    up[_upward_crossings(flow_data)] = 1
+    up_counts = np.concatenate(([0], np.cumsum(up)))
+
+    # A positive run already under way at the window start is not an inhalation of that window.
+    n = len(flow_data)
+    next_non_positive = np.where(flow_data <= 0, np.arange(n), n)
+    next_non_positive = np.minimum.accumulate(next_non_positive[::-1])[::-1]
+    window_ends = window_starts + window
+    lead_end = np.minimum(next_non_positive[window_starts], window_ends)
+    tidal_volume = (positive_sums[window_ends] - positive_sums[window_starts]) \
+        - (positive_sums[lead_end] - positive_sums[window_starts])
+    breath_count = up_counts[window_ends] - up_counts[window_starts + 1]
+    return tidal_volume * breath_count / 60
+
+
+def sample_entropy(data, m=2, r=None, block=256):
+    """Sample entropy with calculateSampleEntropy's conventions (population std, 0 when undefined)."""
+    data = np.asarray(data, dtype=float)
+    if r is None:
+        r = 0.2 * np.std(data)
+
+    def count_matches(length):
+        n_templates = len(data) - length
+        if n_templates < 2:
+            return 0
+        templates = np.lib.stride_tricks.sliding_window_view(data, length)[:n_templates]
+        count = 0
+        # Compare blocks of rows against all later templates to bound memory at block * N.
+        for lo in range(0, n_templates, block):
+            rows = templates[lo:lo + block]
+            distance = np.max(np.abs(rows[:, None, :] - templates[None, :, :]), axis=2)
+            matches = distance <= r
+            upper = np.arange(lo, lo + len(rows))[:, None] < np.arange(n_templates)[None, :]
+            count += int(np.count_nonzero(matches & upper))
+        return count
+
+    b = count_matches(m)
+    a = count_matches(m + 1)
+    if a == 0 or b == 0:
+        return 0.0
+    return float(-np.log(a / b))
+
+
+def night_scores(minute_vent):
+    """(periodicity_index, regularity_score) of analyzeNight for a minute ventilation series."""
+    minute_vent = np.asarray(minute_vent, dtype=float)
+    if len(minute_vent) < 2:
+        return None, None
+    regularity_score = float(np.clip(100 - sample_entropy(minute_vent) / 2.5 * 100, 0, 100))
+
+    n = int(2 ** np.ceil(np.log2(len(minute_vent))))
+    power = np.abs(np.fft.rfft(minute_vent - np.mean(minute_vent), n))[:n // 2]
+    freqs = np.arange(n // 2) / (n * MV_STEP_SEC)
+    in_band = (freqs >= PB_BAND_HZ[0]) & (freqs <= PB_BAND_HZ[1])
+    total_power = np.sum(power)
+    periodicity_index = float(min(100, np.sum(power[in_band]) / total_power * 200)) if total_power > 0 else 0.0
+    return periodicity_index, regularity_score
+
+
+def browser_metrics(flow_data, sampling_rate, total_duration_sec):
+    """The per-night numbers SleepAnalyzer shows: flScore, eai, periodicityIndex, regularityScore."""
+    starts, insp_ends = find_breaths(flow_data)
+    minute_vent = browser_minute_vent(flow_data, sampling_rate)
+    periodicity_index, regularity_score = night_scores(minute_vent)
+    metrics = {
+        'flScore': flow_limitation_score(flow_data, starts, insp_ends),
+        'eai': estimated_arousal_index(flow_data, sampling_rate, starts, insp_ends, total_duration_sec),
+        'periodicityIndex': periodicity_index,
+        'regularityScore': regularity_score,
+    }
+    return metrics, minute_vent
+
+
+if __name__ == "__main__":
+    from process_flow import select_single_file, read_edf
+
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        flow_data, sampling_rate = read_edf(filepath)
+        if flow_data is not None and sampling_rate is not None and sampling_rate > 0:
+            metrics, minute_vent = browser_metrics(flow_data, sampling_rate, len(flow_data) / sampling_rate)
+            for name, value in metrics.items():
+                print(f"{name}: {value:.2f}" if value is not None else f"{name}: n/a")
+        else:
+            print(f"Failed to process {filename}.")
@@ -1,6 +1,7 @@
 import React, { useState } from 'react';
 import { LineChart, Line, XAxis, YAxis, CartesianGrid, Tooltip, Legend, ResponsiveContainer, Brush, ReferenceLine } from 'recharts';
 import { Upload } from 'lucide-react';
+import { isBundleFile, resultFromBundle } from './utils/bundleLoader.js';
 
 const SleepAnalyzerBatch = () => {
   const [files, setFiles] = useState([]);
@@ -371,11 +372,18 @@ const SleepAnalyzerBatch = () => {
 
   const handleFileUpload = async (event, minSize = 2 * 1024 * 1024) => {
     const uploadedFiles = Array.from(event.target.files);
-    const validFiles = uploadedFiles.filter(f => f.name.endsWith('BRP.edf') && f.size > minSize);
+    // A night with a precomputed .wat bundle is loaded from the bundle instead of its EDF
+    const bundleNames = new Set(
+      uploadedFiles.filter(isBundleFile).map(f => f.name.slice(0, -'.wat'.length))
+    );
+    const validFiles = uploadedFiles.filter(f =>
+      isBundleFile(f) ||
+      (f.name.endsWith('BRP.edf') && f.size > minSize && !bundleNames.has(f.name.slice(0, -'.edf'.length)))
+    );
 
     if (validFiles.length === 0) {
       const sizeText = minSize === 500 * 1024 ? '500KB' : '1MB';
-      setError(`No valid BRP.edf files over ${sizeText} found`);
+      setError(`No .wat bundles or valid BRP.edf files over ${sizeText} found`);
       return;
     }
 
@@ -391,30 +399,38 @@ const SleepAnalyzerBatch = () => {
       try {
         const file = validFiles[i];
         const buffer = await file.arrayBuffer();
-        const { flowData, samplingRate, recordingDate, durationMinutes } = await parseEDF(buffer);
+        let newResult;
+
+        if (isBundleFile(file)) {
+          newResult = resultFromBundle(buffer, file.name);
+        } else {
+          const { flowData, samplingRate, recordingDate, durationMinutes } = await parseEDF(buffer);
+
+          if (durationMinutes >= minDurationMinutes) {
+            const { flScore, breaths } = analyzeFlowLimitation(flowData, samplingRate);
+            const eai = estimateArousals(breaths, flowData, samplingRate, durationMinutes * 60);
+            const minuteVent = calculateMinuteVent(flowData, samplingRate);
+            const { periodicityIndex, regularityScore } = analyzeNight(minuteVent);
+
+            newResult = {
+              date: recordingDate,
+              filename: file.name,
+              flScore,
+              periodicityIndex,
+              regularityScore,
+              eai,
+              durationMinutes
+            };
+          }
+        }
 
         // Filter by duration
-        if (durationMinutes < minDurationMinutes) {
+        if (!newResult || newResult.durationMinutes < minDurationMinutes) {
           skippedCount++;
           setProgress({ current: i + 1, total: validFiles.length });
           continue;
         }
 
-        const { flScore, breaths } = analyzeFlowLimitation(flowData, samplingRate);
-        const eai = estimateArousals(breaths, flowData, samplingRate, durationMinutes * 60);
-        const minuteVent = calculateMinuteVent(flowData, samplingRate);
-        const { periodicityIndex, regularityScore } = analyzeNight(minuteVent);
-
-        const newResult = {
-          date: recordingDate,
-          filename: file.name,
-          flScore,
-          periodicityIndex,
-          regularityScore,
-          eai,
-          durationMinutes
-        };
-
         nightResults.push(newResult);
 
         // Add result immediately and re-sort
@@ -609,7 +625,7 @@ const SleepAnalyzerBatch = () => {
               <input
                 type="file"
                 className="hidden"
-                accept=".edf"
+                accept=".edf,.wat"
                 multiple
                 webkitdirectory=""
                 directory=""
@@ -628,7 +644,7 @@ const SleepAnalyzerBatch = () => {
               <input
                 type="file"
                 className="hidden"
-                accept=".edf"
+                accept=".edf,.wat"
                 multiple
                 onChange={(e) => handleFileUpload(e, 500 * 1024)}
               />
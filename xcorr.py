@@ -0,0 +1,223 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft as sp_fft
+import os
+
+from process_flow import select_single_file, read_edf_header, find_signal_index, read_edf_signal, signal_scaling
+from fft_engine import FFT_WORKERS, fast_length, _batches
+from recording import Recording, envelope_detector, MINUTE_VENT_RATE_HZ
+
+# ResMed sessions keep pressure and leak in <stamp>_PLD.edf and oximetry in <stamp>_SA2.edf next to
+# the BRP file; labels are matched as substrings in this order of preference.
+COMPANION_SUFFIXES = ('BRP', 'PLD', 'SA2')
+LEAK_LABELS = ('Leak',)
+PRESSURE_LABELS = ('MaskPress', 'Press')
+SPO2_LABELS = ('SpO2',)
+
+LEAK_THRESHOLD_L_PER_MIN = 24
+LEAK_MARGIN_SEC = 30
+XCORR_WINDOW_SEC = 600
+XCORR_STEP_SEC = 300
+COUPLING_MAX_LAG_SEC = 30
+# Circulatory delay from a change in ventilation to the matching change in finger SpO2.
+SPO2_MIN_LAG_SEC = 10
+SPO2_MAX_LAG_SEC = 60
+SPO2_MIN_CORRELATION = 0.3
+SPO2_MIN_VALID_FRACTION = 0.9
+
+
+def sliding_xcorr(x, y, window, step, max_lag, workers=FFT_WORKERS):
+    """
+    Normalized cross-correlation r[k] = corr(x[t], y[t + k]), k = -max_lag..max_lag, within each
+    window of `window` samples every `step` samples. Each batch of windows is one pair of 2-D real
+    FFTs, zero-padded so lags up to max_lag do not wrap around, which keeps a night O(n log n).
+
+    Returns (window_starts, lags, r) with r shaped (n_windows, 2 * max_lag + 1); windows where
+    either signal is flat or has a NaN sample give NaN rows.
+    """
+    n = min(len(x), len(y))
+    max_lag = min(int(max_lag), window - 1)
+    lags = np.arange(-max_lag, max_lag + 1)
+    if window < 2 or n < window:
+        return np.empty(0, dtype=np.int64), lags, np.empty((0, len(lags)))
+
+    x_windows = sliding_window_view(np.asarray(x[:n], dtype=float), window)[::step]
+    y_windows = sliding_window_view(np.asarray(y[:n], dtype=float), window)[::step]
+    window_starts = np.arange(len(x_windows)) * step
+    n_fft = fast_length(window + max_lag)
+    r = np.empty((len(x_windows), len(lags)))
+    for start, end in _batches(len(x_windows), n_fft):
+        xs = x_windows[start:end] - x_windows[start:end].mean(axis=1, keepdims=True)
+        ys = y_windows[start:end] - y_windows[start:end].mean(axis=1, keepdims=True)
+        spectrum = np.conj(sp_fft.rfft(xs, n_fft, axis=1, workers=workers)) * sp_fft.rfft(ys, n_fft, axis=1, workers=workers)
+        circular = sp_fft.irfft(spectrum, n_fft, axis=1, workers=workers)
+        # Negative lags wrap to the end of the circular correlation.
+        correlation = np.concatenate((circular[:, n_fft - max_lag:], circular[:, :max_lag + 1]), axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r[start:end] = correlation / np.sqrt(np.sum(xs * xs, axis=1) * np.sum(ys * ys, axis=1))[:, None]
+    return window_starts, lags, r
+
+
+def resample(values, from_rate, to_rate, n_out):
+    """Linear interpolation of a channel onto an n_out-sample grid at to_rate, both starting at t = 0."""
+    return np.interp(np.arange(n_out) / to_rate, np.arange(len(values)) / from_rate, values)
+
+
+def find_channel(brp_path, labels):
+    """
+    First channel matching one of labels in the session's BRP, PLD or SA2 file.
+    Returns (physical values, sampling_rate, signal_info), or (None, None, None).
+    """
+    stem = os.path.basename(brp_path).rsplit('_', 1)[0]
+    directory = os.path.dirname(brp_path)
+    for suffix in COMPANION_SUFFIXES:
+        path = os.path.join(directory, f"{stem}_{suffix}.edf")
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            edf_header = read_edf_header(f, path)
+        for label in labels:
+            index = find_signal_index(edf_header, label)
+            if index is None:
+                continue
+            digital, signal_info, edf_header = read_edf_signal(path, index)
+            if digital is None:
+                continue
+            gain, offset = signal_scaling(signal_info)
+            sampling_rate = signal_info['num_samples_in_data_record'] / edf_header['duration_data_record']
+            return digital * gain + offset, sampling_rate, signal_info
+    return None, None, None
+
+
+def high_leak_mask(leak, leak_rate, leak_unit, n_samples, sampling_rate):
+    """
+    True for flow samples within LEAK_MARGIN_SEC of leak above LEAK_THRESHOLD_L_PER_MIN. Leak in L/s
+    (ResMed's unit) is converted to L/min; the margin is applied at the leak channel's own rate.
+    """
+    leak_per_min = leak * 60 if leak_unit.strip().lower() == 'l/s' else leak
+    high = leak_per_min > LEAK_THRESHOLD_L_PER_MIN
+    margin = int(LEAK_MARGIN_SEC * leak_rate)
+    high_prefix = np.concatenate(([0], np.cumsum(high)))
+    index = np.arange(len(high))
+    dilated = high_prefix[np.minimum(index + margin + 1, len(high))] - high_prefix[np.maximum(index - margin, 0)] > 0
+    leak_index = np.minimum((np.arange(n_samples) / sampling_rate * leak_rate).astype(np.int64), len(high) - 1)
+    return dilated[leak_index]
+
+
+def coupling(envelope, channel, rate, max_lag_sec=COUPLING_MAX_LAG_SEC):
+    """
+    Per window, the strongest |r| between the ventilation envelope and a channel within +/-max_lag_sec
+    and the lag (s) where it occurs. Strong coupling to leak or pressure suggests that the envelope's
+    oscillation follows the machine rather than the patient.
+    """
+    window_starts, lags, r = sliding_xcorr(envelope, channel, int(XCORR_WINDOW_SEC * rate),
+                                           int(XCORR_STEP_SEC * rate), int(max_lag_sec * rate))
+    magnitude = np.abs(r)
+    valid = ~np.all(np.isnan(magnitude), axis=1)
+    best = np.zeros(len(r), dtype=np.int64)
+    best[valid] = np.nanargmax(magnitude[valid], axis=1)
+    peak = np.where(valid, magnitude[np.arange(len(r)), best], np.nan)
+    return window_starts / rate, peak, np.where(valid, lags[best] / rate, np.nan)
+
+
+def spo2_lag(envelope, spo2, rate):
+    """
+    Circulatory delay per window: the lag in [SPO2_MIN_LAG_SEC, SPO2_MAX_LAG_SEC] where SpO2 best
+    follows ventilation (largest positive r). Dropouts (SpO2 outside 1-100%) are bridged by linear
+    interpolation; windows with less than SPO2_MIN_VALID_FRACTION real readings, or with r below
+    SPO2_MIN_CORRELATION, give NaN. Returns (window_start_sec, lag_sec, r).
+    """
+    valid_reading = (spo2 > 0) & (spo2 <= 100)
+    if not np.any(valid_reading):
+        return np.empty(0), np.empty(0), np.empty(0)
+    index = np.arange(len(spo2))
+    spo2 = np.interp(index, index[valid_reading], spo2[valid_reading])
+    window = int(XCORR_WINDOW_SEC * rate)
+    window_starts, lags, r = sliding_xcorr(envelope, spo2, window, int(XCORR_STEP_SEC * rate), int(SPO2_MAX_LAG_SEC * rate))
+    valid_prefix = np.concatenate(([0], np.cumsum(valid_reading)))
+    valid_fraction = (valid_prefix[window_starts + window] - valid_prefix[window_starts]) / window
+    r[valid_fraction < SPO2_MIN_VALID_FRACTION] = np.nan
+    in_range = lags >= SPO2_MIN_LAG_SEC * rate
+    r = r[:, in_range]
+    valid = ~np.all(np.isnan(r), axis=1)
+    best = np.zeros(len(r), dtype=np.int64)
+    best[valid] = np.nanargmax(r[valid], axis=1)
+    peak = np.where(valid, r[np.arange(len(r)), best], np.nan)
+    lag_sec = np.where(valid & (peak >= SPO2_MIN_CORRELATION), lags[in_range][best] / rate, np.nan)
+    return window_starts / rate, lag_sec, peak
+
+
+def channel_analysis(brp_path):
+    """
+    Joins flow with the session's leak, pressure and SpO2 channels: PB tagging with high-leak
+    stretches masked (and without, for comparison), envelope coupling to leak and pressure, and the
+    median ventilation-to-SpO2 delay. Returns None if the flow recording cannot be read.
+    """
+    recording = Recording.from_edf(brp_path)
+    if recording is None:
+        return None
+    rate = MINUTE_VENT_RATE_HZ
+    # A minute-long average smears a 45-75 s cycle and shifts its phase, so coupling and the SpO2
+    # delay are measured on the breath-scale envelope.
+    envelope = recording.breath_vent
+    result = {'filename': os.path.basename(brp_path), 'channels': []}
+
+    unmasked = envelope_detector(recording)
+    result['periodic_percentage_unmasked'] = unmasked.get('periodic_percentage')
+
+    leak, leak_rate, leak_info = find_channel(brp_path, LEAK_LABELS)
+    if leak is not None:
+        result['channels'].append(leak_info['label'])
+        exclude = high_leak_mask(leak, leak_rate, leak_info['physical_dimension'],
+                                 len(recording.flow_data), recording.sampling_rate)
+        result['high_leak_sec'] = np.count_nonzero(exclude) / recording.sampling_rate
+        masked = Recording(recording.flow_data, recording.sampling_rate, brp_path, exclude_mask=exclude,
+                           clip_limits=recording.clip_limits)
+        result['periodic_percentage'] = envelope_detector(masked).get('periodic_percentage')
+        window_sec, peak, lag = coupling(envelope, resample(leak, leak_rate, rate, len(envelope)), rate)
+        result['leak_coupling'] = float(np.nanmedian(peak)) if np.any(~np.isnan(peak)) else None
+    else:
+        result['periodic_percentage'] = result['periodic_percentage_unmasked']
+
+    pressure, pressure_rate, pressure_info = find_channel(brp_path, PRESSURE_LABELS)
+    if pressure is not None:
+        result['channels'].append(pressure_info['label'])
+        window_sec, peak, lag = coupling(envelope, resample(pressure, pressure_rate, rate, len(envelope)), rate)
+        result['pressure_coupling'] = float(np.nanmedian(peak)) if np.any(~np.isnan(peak)) else None
+
+    spo2, spo2_rate, spo2_info = find_channel(brp_path, SPO2_LABELS)
+    if spo2 is not None:
+        result['channels'].append(spo2_info['label'])
+        # Dropout markers must not be interpolated into neighbouring samples, so take the nearest one.
+        nearest = np.minimum(np.round(np.arange(len(envelope)) / rate * spo2_rate).astype(np.int64), len(spo2) - 1)
+        window_sec, lag_sec, peak = spo2_lag(envelope, spo2[nearest], rate)
+        result['spo2_lag_sec'] = float(np.nanmedian(lag_sec)) if np.any(~np.isnan(lag_sec)) else None
+        result['spo2_lag_windows'] = int(np.count_nonzero(~np.isnan(lag_sec)))
+    return result
+
+
+if __name__ == "__main__":
+    filepath = select_single_file()
+
+    if not filepath:
+        print("No file selected. Exiting script.")
+    else:
+        filename = os.path.basename(filepath)
+        print(f"\nSelected file: {filename}")
+
+        result = channel_analysis(filepath)
+        if result is None:
+            print(f"Failed to process {filename}.")
+        else:
+            print(f"\n--- Multi-Channel Analysis ---")
+            print(f"Channels found: {', '.join(result['channels']) or 'flow only'}")
+            if 'high_leak_sec' in result:
+                print(f"High leak (> {LEAK_THRESHOLD_L_PER_MIN} L/min, +/-{LEAK_MARGIN_SEC}s): {result['high_leak_sec'] / 60:.1f} min masked")
+            for key, label in (('periodic_percentage_unmasked', 'Periodic (unmasked)'), ('periodic_percentage', 'Periodic (leak-masked)')):
+                if result.get(key) is not None:
+                    print(f"{label}: {result[key]:.2f}%")
+            for key, label in (('leak_coupling', 'leak'), ('pressure_coupling', 'pressure')):
+                if result.get(key) is not None:
+                    print(f"Median envelope coupling to {label}: |r| = {result[key]:.2f}")
+            if result.get('spo2_lag_sec') is not None:
+                print(f"Ventilation-to-SpO2 delay: {result['spo2_lag_sec']:.0f}s (median of {result['spo2_lag_windows']} windows)")